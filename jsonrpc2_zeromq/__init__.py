@@ -14,4 +14,11 @@ from builtins import *  # NOQA
 from .client import *  # NOQA
 from .server import *  # NOQA
 
-from .common import (RPCError, ParseError, InvalidRequest, MethodNotFound, InvalidParams, InternalError, ServerError, ApplicationError, JSON_RPC_VERSION, package_logger as logger)  # NOQA
+try:
+    from .aio import *  # NOQA
+except (ImportError, SyntaxError):
+    # asyncio support needs Python 3 and a pyzmq with zmq.asyncio
+    pass
+
+from .cache import cacheable  # NOQA
+from .common import (RPCError, ParseError, InvalidRequest, MethodNotFound, InvalidParams, InternalError, ServerError, ServerOverloaded, DeadlineExceeded, ApplicationError, JSON_RPC_VERSION, package_logger as logger)  # NOQA
@@ -0,0 +1,84 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# Limits on how much work a server takes on, for RPCServer.
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+
+import contextlib
+import threading
+
+from . import common
+
+
+class AdmissionControl(object):
+
+    # Counts the requests a server has received but not finished handling
+    # (pending: queued or in flight), and of those being handled, how many
+    # are of each method. Requests beyond max_pending, or beyond a method's
+    # limit in method_limits, are shed: answered with ServerOverloaded
+    # without being handled. None means no limit.
+
+    def __init__(self, max_pending=None, method_limits=None):
+        self.max_pending = max_pending
+        self.method_limits = dict(method_limits or {})
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.in_flight = {}
+        self.shed = 0
+        self.shed_by_method = {}
+
+    def admit(self):
+        """Count a newly received request as pending, or return False if
+        it should be shed."""
+        with self.lock:
+            if self.max_pending is not None and \
+                    self.pending >= self.max_pending:
+                self.shed += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    @contextlib.contextmanager
+    def method_slot(self, method):
+        """Count a call of method as in flight while in the with block,
+        raising ServerOverloaded if it's at its limit."""
+        limit = self.method_limits.get(method)
+        if limit is None:
+            yield
+            return
+
+        with self.lock:
+            in_flight = self.in_flight.get(method, 0)
+            if in_flight >= limit:
+                self.shed += 1
+                self.shed_by_method[method] = \
+                    self.shed_by_method.get(method, 0) + 1
+                raise common.ServerOverloaded(
+                    "Too many concurrent calls of {0}".format(method))
+            self.in_flight[method] = in_flight + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight[method] -= 1
+
+    def stats(self):
+        with self.lock:
+            return dict(pending=self.pending, max_pending=self.max_pending,
+                        in_flight=dict(self.in_flight),
+                        method_limits=dict(self.method_limits),
+                        shed=self.shed,
+                        shed_by_method=dict(self.shed_by_method))
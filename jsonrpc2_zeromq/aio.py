@@ -0,0 +1,641 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# asyncio versions of the clients and servers. Python 3 only.
+
+import asyncio
+import contextvars
+import inspect
+import itertools
+import logging
+import time
+
+import zmq
+import zmq.asyncio
+
+from . import common
+from .client import NotifierProxy, StreamCallProxy, TimeoutError
+from .server import response_from_exception
+
+
+# The codec to reply with, for the request a server task is handling
+_reply_codec = contextvars.ContextVar('reply_codec', default=None)
+# And the compressor, if the client accepts the server's
+_reply_compressor = contextvars.ContextVar('reply_compressor', default=None)
+# The request a server task is handling
+_current_request = contextvars.ContextVar('current_request', default=None)
+# And its trace, shared with the tasks handling the items of a batch
+_current_trace = contextvars.ContextVar('current_trace',
+                                        default=common.null_trace)
+
+
+def _asyncio_context(context):
+    # Shadow the given (or global) context so inproc endpoints are shared
+    # with the threaded classes.
+    context = context or zmq.Context.instance()
+    if isinstance(context, zmq.asyncio.Context):
+        return context
+    return zmq.asyncio.Context.shadow(context)
+
+
+class AsyncRPCClient(common.Endpoint):
+
+    # Talks to a ROUTER server, like RPCNotifierClient. Calls return
+    # awaitables, and any number of them can be in flight at once: responses
+    # are matched back to their callers by request id.
+    #
+    # client.stream.method(...) returns an AsyncResultStream, to iterate over
+    # with async for.
+    #
+    # Calls carry their deadline if send_deadlines is set, and are traced, as
+    # with RPCClient.
+
+    default_socket_type = zmq.DEALER
+    error_code_exceptions = None
+    request_method_class = common.RequestMethod
+    stream_window = 8  # chunks
+    send_deadlines = False
+
+    socket = None
+
+    def __init__(self, endpoint, context=None, timeout=5000,
+                 socket_type=None, logger=None, codec=None,
+                 compression=None):
+        super(AsyncRPCClient, self).__init__(endpoint, socket_type, timeout,
+                                             _asyncio_context(context),
+                                             logger, codec, compression)
+        self.notify = NotifierProxy(self)
+        self.stream = StreamCallProxy(self)
+        self.pending = {}
+        self.receiver = None
+        self.socket = self.context.socket(self.socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.endpoint)
+
+    async def request(self, request):
+        give_up = time.time() + self.timeout / 1000.0
+        if self.send_deadlines and request.id is not None:
+            request.deadline = give_up
+        trace = self._start_trace('request')
+        trace.method = request.method
+        trace.id = request.id
+        if request.id is None:
+            try:
+                await self._send(request, trace)
+            finally:
+                self._finish_trace(trace)
+            return  # We don't get a response for notifications
+
+        # Waiting before it's sent, as the response could arrive while
+        # sending yields to the event loop
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request.id] = future
+        try:
+            await self._send(request, trace)
+            response, received, parsed = await asyncio.wait_for(
+                future, max(0, give_up - time.time()))
+            trace.mark('recv', received)
+            trace.mark('parse', parsed)
+            if response.is_error:
+                trace.error_code = response.error['code']
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                "Timed out while getting response to {method} on "
+                "{endpoint}".format(method=request.method,
+                                    endpoint=self.endpoint))
+        finally:
+            self.pending.pop(request.id, None)
+            self._finish_trace(trace)
+
+        if response.is_error:
+            raise response.error_exception(self.error_code_exceptions)
+        return response.result
+
+    def request_stream(self, request):
+        # The request is sent when iteration starts
+        request.stream = self.stream_window
+        return AsyncResultStream(self, request)
+
+    async def _send(self, request, trace=common.null_trace):
+        frames = self._encode_request(request)
+        trace.mark('serialize')
+        await self.socket.send_multipart(frames,
+                                         copy=common.should_copy(frames))
+        trace.mark('send')
+        if request.id is not None and \
+                (self.receiver is None or self.receiver.done()):
+            self.receiver = asyncio.ensure_future(self._receive_responses())
+
+    async def _receive_responses(self):
+        while True:
+            msg_parts = await self.socket.recv_multipart(copy=False)
+            received = time.time()
+            try:
+                response = self._decode(msg_parts)
+            except ValueError:
+                self.logger.warning("v_v Client received unparseable "
+                                    "message on %s", self.endpoint)
+                continue
+            if not isinstance(response, common.Response):
+                self.logger.warning("v_v Client received a non-response "
+                                    "on %s", self.endpoint)
+                continue
+
+            future = self.pending.get(response.id)
+            if future is None:
+                # Caller has already timed out
+                continue
+            if isinstance(future, AsyncResultStream):
+                future.chunks.put_nowait(response)
+            elif not future.done():
+                # Along with when it arrived and was parsed, for its trace
+                future.set_result((response, received, time.time()))
+
+    def get_request_method(self, method, notify=False):
+        return self.request_method_class(method, client=self, notify=notify)
+
+    def __getattr__(self, method):
+        return self.get_request_method(method)
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        super(AsyncRPCClient, self).close()
+
+
+class AsyncResultStream(object):
+
+    # The asyncio version of client.ResultStream: iterates over the items of
+    # a streamed result, granting the server credit to send more chunks as
+    # they're consumed. aclose() (or leaving an async with block) stops the
+    # stream early.
+
+    started = False
+    finished = False
+
+    def __init__(self, client, request):
+        self.client = client
+        self.request = request
+        self.window = request.stream
+        self.chunks = asyncio.Queue()
+        self.items = iter(())
+        self.unacknowledged = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                return next(self.items)
+            except StopIteration:
+                if self.finished:
+                    raise StopAsyncIteration()
+            if not self.started:
+                self.started = True
+                self.client.pending[self.request.id] = self
+                try:
+                    await self.client._send(self.request)
+                except Exception:
+                    self._finish()
+                    raise
+            self.items = iter(await self._next_chunk())
+
+    async def _next_chunk(self):
+        try:
+            response = await asyncio.wait_for(self.chunks.get(),
+                                              self.client.timeout / 1000.0)
+        except asyncio.TimeoutError:
+            await self.aclose()
+            raise TimeoutError(
+                "Timed out while getting stream from {method} on "
+                "{endpoint}".format(method=self.request.method,
+                                    endpoint=self.client.endpoint))
+
+        if response.stream != common.STREAM_MORE:
+            self._finish()
+        if response.is_error:
+            raise response.error_exception(self.client.error_code_exceptions)
+
+        if response.stream is None:
+            # Not streamed
+            result = response.result
+            return result if isinstance(result, list) else [result]
+
+        if not self.finished:
+            await self._grant_credit()
+        return response.result
+
+    async def _grant_credit(self):
+        self.unacknowledged += 1
+        if self.unacknowledged >= max(1, self.window // 2):
+            await self.client.request(common.Request(
+                common.STREAM_CREDIT_METHOD,
+                [self.request.id, self.unacknowledged], notify=True))
+            self.unacknowledged = 0
+
+    def _finish(self):
+        self.finished = True
+        self.items = iter(())
+        self.client.pending.pop(self.request.id, None)
+
+    async def aclose(self):
+        if self.finished:
+            return
+        self._finish()
+        if self.started:
+            await self.client.request(common.Request(
+                common.STREAM_CANCEL_METHOD, [self.request.id], notify=True))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+
+class AsyncRPCServer(common.Endpoint):
+
+    # Runs in an asyncio event loop: await run() to serve. Each request is
+    # handled in its own task, with at most max_concurrency at once.
+    # handle_{method}_method handlers can be coroutine functions, which are
+    # awaited; plain functions are called directly, blocking the loop.
+    #
+    # Listens on a ROUTER socket, so that requests can be handled
+    # concurrently, keeping any REQ envelope so RPCClient can be used with
+    # it as well as DEALER clients.
+    #
+    # Handlers can also be generators or async generators, streamed as with
+    # RPCServer. Each stream is sent from its own task, which doesn't count
+    # towards max_concurrency.
+    #
+    # Expired requests are dropped, handlers can call time_remaining(), and
+    # trace hooks are called, as with RPCServer.
+
+    default_socket_type = zmq.ROUTER
+    allow_methods = True
+    allow_notifications = False
+    default_max_concurrency = 100
+    stream_chunk_size = 100  # items
+    max_stream_window = 64  # chunks
+    stream_idle_timeout = 60  # seconds without credit before giving up
+
+    reserved_methods = {
+        common.STREAM_CREDIT_METHOD: '_handle_stream_credit',
+        common.STREAM_CANCEL_METHOD: '_handle_stream_cancel',
+    }
+
+    drop_expired = True
+    deadline_grace = 0.0  # seconds
+    should_stop = False
+
+    def __init__(self, endpoint, context=None, timeout=1000, socket_type=None,
+                 logger=None, max_concurrency=None, codec=None,
+                 compression=None):
+        super(AsyncRPCServer, self).__init__(endpoint, socket_type, timeout,
+                                             _asyncio_context(context),
+                                             logger=logger, codec=codec,
+                                             compression=compression)
+        self.max_concurrency = max_concurrency or self.default_max_concurrency
+        self.tasks = set()
+        self.streams = {}
+        self.socket = self.context.socket(self.socket_type)
+        self.socket.bind(self.endpoint)
+
+    def stop(self):
+        self.should_stop = True
+
+    def time_remaining(self):
+        """Seconds until the caller of the request being handled gives up
+        waiting for its response, or None if it didn't say."""
+        req = _current_request.get()
+        return req.time_remaining() if req is not None else None
+
+    def _expired(self, req):
+        if not self.drop_expired:
+            return False
+        remaining = req.time_remaining()
+        return remaining is not None and remaining < -self.deadline_grace
+
+    async def run(self):
+        self.logger.info("^_^ Server now listening on %s", self.endpoint)
+        slots = asyncio.Semaphore(self.max_concurrency)
+
+        def task_done(task):
+            self.tasks.discard(task)
+            slots.release()
+
+        while not self.should_stop:
+            # Only take messages off the socket when a slot is free, so
+            # excess requests wait in ZeroMQ's queues.
+            await slots.acquire()
+            if not await self.socket.poll(self.timeout):
+                slots.release()
+                continue
+            req_parts = await self.socket.recv_multipart(copy=False)
+            task = asyncio.ensure_future(
+                self._handle_message_parts(req_parts, time.time()))
+            self.tasks.add(task)
+            task.add_done_callback(task_done)
+
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        streams = [stream.task for stream in self.streams.values()]
+        for task in streams:
+            task.cancel()
+        if streams:
+            await asyncio.wait(streams)
+
+    def _split_envelope(self, req_parts):
+        if self.socket_type != zmq.ROUTER:
+            return [], req_parts
+        # REQ clients delimit their envelope with an empty frame
+        body_start = 2 if len(req_parts) > 2 and not len(req_parts[1]) else 1
+        return ([common.frame_bytes(f) for f in req_parts[:body_start]],
+                req_parts[body_start:])
+
+    async def _handle_message_parts(self, req_parts, received=None):
+        # received is when the message was read off the socket
+        trace = self._start_trace('recv', received)
+        _current_trace.set(trace)
+        envelope, req_parts = self._split_envelope(req_parts)
+        req = None
+
+        try:
+            try:
+                req, codec = common.decode_frames(req_parts, self.codec)
+            except ValueError:
+                raise common.ParseError()
+            _reply_codec.set(codec)
+            _reply_compressor.set(common.reply_compressor(self.compression,
+                                                          req))
+            trace.mark('parse')
+
+            if isinstance(req, list):
+                await self._handle_batch(envelope, req)
+                return
+
+            if not isinstance(req, common.Request):
+                raise common.InvalidRequest()
+
+            trace.method = req.method
+            trace.id = req.id
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    "<_< Server received {req_type} \"{method}\" on "
+                    "{endpoint} with params:\n{params}".format(
+                        req_type=("method call" if req.id
+                                  else "notification"),
+                        method=req.method, endpoint=self.endpoint,
+                        params=common.debug_log_object_dump(req.params)))
+
+            _current_request.set(req)
+            if self._is_reserved(req):
+                await self._handle_reserved(envelope, req)
+
+            elif self._expired(req):
+                raise common.DeadlineExceeded()
+
+            elif (req.is_method and self.allow_methods) or \
+                    (req.is_notification and self.allow_notifications):
+                await self._handle_method_and_response(envelope, req)
+
+            elif req.is_method and not self.allow_methods:
+                raise common.InvalidRequest(
+                    "Methods not accepted by this server")
+
+        except Exception as e:
+            if not isinstance(req, common.Request):
+                req = None
+            await self._send_response(
+                envelope, req,
+                response_from_exception(e, req.id if req else None))
+            if not isinstance(e, common.RPCError):
+                self.logger.exception("Exception handling message in %s",
+                                      self.__class__.__name__)
+
+        finally:
+            self._finish_trace(trace)
+
+    async def _handle_method(self, req):
+        trace = _current_trace.get()
+        trace.mark('dispatch')
+        result = common.handle_request(self, 'handle_{method}_method', req)
+        if inspect.isawaitable(result):
+            result = await result
+        trace.mark('handler')
+        return result
+
+    async def _handle_method_and_response(self, envelope, req):
+        result = await self._handle_method(req)
+        if _is_generator(result):
+            if req.stream and req.is_method and \
+                    self.socket_type == zmq.ROUTER:
+                self._start_stream(envelope, req, result)
+                return
+            result = await _collect(result)
+        await self._send_response(envelope, req,
+                                  common.Response(result, None, req.id))
+
+    def _is_reserved(self, req):
+        try:
+            return req.method in self.reserved_methods
+        except TypeError:
+            return False
+
+    async def _handle_reserved(self, envelope, req):
+        params = req.params if isinstance(req.params, list) else []
+        try:
+            result = getattr(self, self.reserved_methods[req.method])(
+                envelope, *params)
+        except TypeError as e:
+            raise common.InvalidParams(str(e))
+        await self._send_response(envelope, req,
+                                  common.Response(result, None, req.id))
+
+    def _start_stream(self, envelope, req, generator):
+        try:
+            window = max(1, min(int(req.stream), self.max_stream_window))
+        except (TypeError, ValueError):
+            window = 1
+        stream = AsyncServerStream(envelope, req.id, generator,
+                                   _reply_codec.get(),
+                                   _reply_compressor.get(), window)
+        self.streams[stream.key] = stream
+        stream.task = asyncio.ensure_future(self._run_stream(stream))
+
+    def _handle_stream_credit(self, envelope, id_, credit):
+        stream = self.streams.get((tuple(envelope), id_))
+        if stream is not None:
+            stream.credit += int(credit)
+            stream.credit_available.set()
+
+    def _handle_stream_cancel(self, envelope, id_):
+        stream = self.streams.get((tuple(envelope), id_))
+        if stream is not None:
+            stream.task.cancel()
+
+    async def _run_stream(self, stream):
+        try:
+            while True:
+                if stream.credit <= 0:
+                    stream.credit_available.clear()
+                    try:
+                        await asyncio.wait_for(stream.credit_available.wait(),
+                                               self.stream_idle_timeout)
+                    except asyncio.TimeoutError:
+                        self.logger.warning("v_v Server dropping idle stream "
+                                            "%s on %s", stream.id,
+                                            self.endpoint)
+                        return
+
+                try:
+                    items = await _next_items(stream.generator,
+                                              self.stream_chunk_size)
+                except Exception as e:
+                    if not isinstance(e, common.RPCError):
+                        self.logger.exception("Exception streaming from %s",
+                                              self.__class__.__name__)
+                    resp = response_from_exception(e, stream.id)
+                    finished = True
+                else:
+                    finished = len(items) < self.stream_chunk_size
+                    resp = common.Response(
+                        items, None, stream.id,
+                        stream=common.STREAM_END if finished
+                        else common.STREAM_MORE)
+
+                stream.credit -= 1
+                await self._send_multipart(
+                    stream.envelope + self._encode(resp, stream.codec,
+                                                   stream.compressor))
+                if finished:
+                    return
+        finally:
+            self.streams.pop(stream.key, None)
+            if inspect.isasyncgen(stream.generator):
+                await stream.generator.aclose()
+            else:
+                stream.generator.close()
+
+    async def _handle_batch(self, envelope, reqs):
+        if not reqs:
+            raise common.InvalidRequest("Empty batch")
+
+        self.logger.debug("<_< Server received batch of %d on %s",
+                          len(reqs), self.endpoint)
+
+        resps = await asyncio.gather(
+            *[self._handle_batch_item(req) for req in reqs])
+        resps = [resp for resp in resps if resp is not None]
+
+        # A batch of only notifications gets no response at all
+        if resps:
+            self.logger.debug(">_> Server sending batch of %d responses on "
+                              "%s", len(resps), self.endpoint)
+            await self._send_reply(envelope, resps)
+
+    async def _handle_batch_item(self, req):
+        if not isinstance(req, common.Request):
+            return common.InvalidRequest().to_response()
+
+        # Batch items are gathered into tasks, each with its own context
+        _current_request.set(req)
+        try:
+            if self._expired(req):
+                raise common.DeadlineExceeded()
+
+            elif (req.is_method and self.allow_methods) or \
+                    (req.is_notification and self.allow_notifications):
+                result = await self._handle_method(req)
+                if _is_generator(result):
+                    result = await _collect(result)
+                if req.is_method:
+                    return common.Response(result, None, req.id)
+
+            elif req.is_method and not self.allow_methods:
+                raise common.InvalidRequest(
+                    "Methods not accepted by this server")
+
+        except Exception as e:
+            if not isinstance(e, common.RPCError):
+                self.logger.exception("Exception handling message in %s",
+                                      self.__class__.__name__)
+            if req.is_method:
+                return response_from_exception(e, req.id)
+
+    async def _send_response(self, envelope, req, resp):
+        # Notifications must not return anything
+        if req and req.is_notification:
+            return
+
+        if resp.is_error:
+            _current_trace.get().error_code = resp.error['code']
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(">_> Server sending {0} {1}on {2}:\n{3}".format(
+                "error" if resp.is_error else "return",
+                "from \"{0}\" ".format(req.method) if req else "",
+                self.endpoint,
+                "{indent}{0} {1}".format(
+                    resp.error['code'], resp.error['message'],
+                    indent=common.debug_log_object_indent)
+                if resp.is_error
+                else common.debug_log_object_dump(resp.result)))
+
+        await self._send_reply(envelope, resp)
+
+    async def _send_reply(self, envelope, resp):
+        trace = _current_trace.get()
+        frames = self._encode(resp, _reply_codec.get(),
+                              _reply_compressor.get())
+        trace.mark('serialize')
+        await self._send_multipart(envelope + frames)
+        trace.mark('send')
+
+    async def _send_multipart(self, parts):
+        await self.socket.send_multipart(parts,
+                                         copy=common.should_copy(parts))
+
+
+class AsyncRPCNotificationServer(AsyncRPCServer):
+
+    allow_notifications = True
+
+
+class AsyncServerStream(object):
+
+    def __init__(self, envelope, id_, generator, codec, compressor, credit):
+        self.envelope = envelope
+        self.id = id_
+        self.key = (tuple(envelope), id_)
+        self.generator = generator
+        self.codec = codec
+        self.compressor = compressor
+        self.credit = credit
+        self.credit_available = asyncio.Event()
+        self.task = None
+
+
+def _is_generator(result):
+    return inspect.isgenerator(result) or inspect.isasyncgen(result)
+
+
+async def _next_items(generator, count):
+    if not inspect.isasyncgen(generator):
+        return list(itertools.islice(generator, count))
+    items = []
+    while len(items) < count:
+        try:
+            items.append(await generator.__anext__())
+        except StopAsyncIteration:
+            break
+    return items
+
+
+async def _collect(generator):
+    if not inspect.isasyncgen(generator):
+        return list(generator)
+    return [item async for item in generator]
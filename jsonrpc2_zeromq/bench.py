@@ -0,0 +1,328 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# Benchmarks. Run with:
+#
+#     python -m jsonrpc2_zeromq.bench [benchmark ...]
+#
+# Results are printed as JSON, one object per line, so runs can be compared.
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+from future.utils import bytes_to_native_str
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import zmq
+
+from . import common
+from . import client
+from . import server
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def deep_payload(depth=200):
+    payload = {"leaf": True}
+    for i in range(depth):
+        payload = {"level": i, "child": payload, "values": [i, i + 0.5]}
+    return payload
+
+
+def wide_payload(rows=5000):
+    return [{"id": i, "name": "row {0}".format(i),
+             "tags": {"even": i % 2 == 0, "values": [i, -i]}}
+            for i in range(rows)]
+
+
+def _times_per_call(fns, min_time=0.5, repeat=10):
+    """Seconds per call of each of fns: the best of repeat runs of it, each
+    taking about min_time / repeat. Anything else the machine's doing only
+    slows runs down, so the fastest is the most accurate, and the fns take
+    turns to run so that they're compared under the same conditions."""
+    run_time = min_time / repeat
+    runs = []
+    for fn in fns:
+        t = timeit.Timer(fn, timer=timer)
+        # Find how many calls make a run, warming up meanwhile
+        number = 1
+        while t.timeit(number) < run_time:
+            number *= 2
+        runs.append((t, number))
+
+    best = [None] * len(runs)
+    for i in range(repeat):
+        for j, (t, number) in enumerate(runs):
+            seconds = t.timeit(number) / number
+            if best[j] is None or seconds < best[j]:
+                best[j] = seconds
+    return best
+
+
+def _object_hook_loads(data):
+    # How messages were parsed before only the envelope was looked at: every
+    # nested object went through _parse_rpc_message.
+    return json.loads(bytes_to_native_str(data),
+                      object_hook=common._parse_rpc_message)
+
+
+def bench_parse(args):
+    """Time parsing large responses, by codec."""
+    payloads = [("deep", deep_payload()), ("wide", wide_payload())]
+    parsers = [(name, codec.loads) for name, codec
+               in sorted(common.codecs.items())]
+    parsers.append(("json-object-hook", _object_hook_loads))
+
+    for payload_name, payload in payloads:
+        messages = []
+        for parser_name, loads in parsers:
+            codec = common.get_codec(
+                "json" if parser_name == "json-object-hook" else parser_name)
+            messages.append(codec.dumps(common.Response(payload, None, "1")))
+        times = _times_per_call(
+            [(lambda loads=loads, data=data: loads(data))
+             for (parser_name, loads), data in zip(parsers, messages)],
+            args.min_time * len(parsers), args.repeat)
+        for (parser_name, loads), data, seconds in zip(parsers, messages,
+                                                       times):
+            yield dict(benchmark="parse", payload=payload_name,
+                       parser=parser_name, bytes=len(data),
+                       msgs_per_sec=1 / seconds,
+                       ms_per_msg=seconds * 1000)
+
+
+class EchoHandlers(object):
+
+    def handle_echo_method(self, payload):
+        return payload
+
+
+class EchoServer(server.RPCServer, EchoHandlers):
+    pass
+
+
+class EchoNotificationServer(server.RPCNotificationServer, EchoHandlers):
+    pass
+
+
+class SinkServer(server.NotificationOnlyPullServer):
+
+    # Notifications get no reply, so it's the server that times them, from
+    # when they were sent.
+
+    def __init__(self, *args, **kwargs):
+        super(SinkServer, self).__init__(*args, **kwargs)
+        self.latencies = []
+
+    def handle_sink_method(self, payload, sent):
+        self.latencies.append(timer() - sent)
+
+
+# Server and client classes to run, by socket pattern
+patterns = {
+    "req-rep": (EchoServer, client.RPCClient),
+    "router-dealer": (EchoNotificationServer, client.RPCNotifierClient),
+    "push-pull": (SinkServer, client.NotifierOnlyPushClient),
+}
+
+transports = ["inproc", "ipc", "tcp"]
+
+
+def _bind_address(transport, temp_dir):
+    if transport == "inproc":
+        return "inproc://jsonrpc2-bench-%x" % id(temp_dir)
+    elif transport == "ipc":
+        return "ipc://{0}/bench".format(temp_dir)
+    else:
+        return "tcp://127.0.0.1:*"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(fraction * len(sorted_values)))]
+
+
+def _call_until(rpc_client, payload, stop_time, latencies):
+    echo = rpc_client.echo
+    while True:
+        start = timer()
+        if start >= stop_time:
+            return
+        echo(payload)
+        latencies.append(timer() - start)
+
+
+def _notify_until(rpc_client, payload, stop_time, counts):
+    sink = rpc_client.notify.sink
+    sent = 0
+    while True:
+        now = timer()
+        if now >= stop_time:
+            break
+        sink(payload, now)
+        sent += 1
+    counts.append(sent)
+
+
+def run_rpc(pattern, transport, payload_size, concurrency, min_time=0.5):
+    """Call a server over the given transport from concurrency clients, each
+    in its own thread, for min_time seconds. Returns the number of calls,
+    the seconds they took, and each one's latency."""
+    server_class, client_class = patterns[pattern]
+    temp_dir = tempfile.mkdtemp(prefix="jsonrpc2-bench-")
+    rpc_server = server_class(_bind_address(transport, temp_dir),
+                              timeout=100)
+    endpoint = rpc_server.socket.getsockopt(zmq.LAST_ENDPOINT)
+    if isinstance(endpoint, bytes):
+        endpoint = endpoint.decode("ascii")
+    rpc_server.daemon = True
+    rpc_server.start()
+    clients = [client_class(endpoint) for i in range(concurrency)]
+    payload = "x" * payload_size
+    notify = pattern == "push-pull"
+
+    try:
+        for rpc_client in clients:
+            # Connect before timing anything
+            if notify:
+                rpc_client.notify.sink(payload, timer())
+            else:
+                rpc_client.echo(payload)
+        if notify:
+            while len(rpc_server.latencies) < concurrency:
+                time.sleep(0.01)
+            del rpc_server.latencies[:]
+
+        results = [[] for c in clients]
+        start = timer()
+        stop_time = start + min_time
+        threads = [threading.Thread(
+            target=_notify_until if notify else _call_until,
+            args=(rpc_client, payload, stop_time, result))
+            for rpc_client, result in zip(clients, results)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if notify:
+            # Done when the server has received everything sent
+            sent = sum(sum(r) for r in results)
+            give_up = timer() + 10
+            while len(rpc_server.latencies) < sent and timer() < give_up:
+                time.sleep(0.001)
+            latencies = list(rpc_server.latencies)
+        else:
+            latencies = [latency for r in results for latency in r]
+        return len(latencies), timer() - start, latencies
+
+    finally:
+        for rpc_client in clients:
+            rpc_client.close()
+        rpc_server.stop()
+        rpc_server.join()
+        rpc_server.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_rpc(args):
+    """Time calls end to end, by socket pattern, transport, payload size and
+    number of concurrent clients."""
+    for pattern in args.patterns:
+        for transport in args.transports:
+            if transport == "ipc" and not zmq.has("ipc"):
+                continue
+            for payload_size in args.sizes:
+                for concurrency in args.concurrency:
+                    calls, seconds, latencies = run_rpc(
+                        pattern, transport, payload_size, concurrency,
+                        args.min_time)
+                    latencies.sort()
+                    yield dict(
+                        benchmark="rpc", pattern=pattern,
+                        transport=transport, payload_bytes=payload_size,
+                        concurrency=concurrency, calls=calls,
+                        msgs_per_sec=calls / seconds,
+                        p50_ms=_ms(percentile(latencies, 0.5)),
+                        p99_ms=_ms(percentile(latencies, 0.99)),
+                        p999_ms=_ms(percentile(latencies, 0.999)))
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+benchmarks = {
+    "parse": bench_parse,
+    "rpc": bench_rpc,
+}
+
+
+def _list_of(item_type, choices=None):
+    def parse(value):
+        items = [item_type(v) for v in value.split(",") if v]
+        for item in items:
+            if choices is not None and item not in choices:
+                raise argparse.ArgumentTypeError(
+                    "{0!r} is not one of {1}".format(item, ", ".join(choices)))
+        return items
+    return parse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m jsonrpc2_zeromq.bench",
+        description="Benchmark jsonrpc2_zeromq, printing JSON results.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="Which to run: {0} (default all)".format(
+                            ", ".join(sorted(benchmarks))))
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="Seconds to repeat each measurement for")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="Runs to take the best of, for parse")
+    parser.add_argument("--patterns", default=sorted(patterns),
+                        type=_list_of(str, sorted(patterns)),
+                        help="Comma-separated socket patterns for rpc "
+                        "(default all)")
+    parser.add_argument("--transports", default=transports,
+                        type=_list_of(str, transports),
+                        help="Comma-separated transports for rpc "
+                        "(default all)")
+    parser.add_argument("--sizes", default=[16, 1024, 65536],
+                        type=_list_of(int),
+                        help="Comma-separated payload sizes in bytes for "
+                        "rpc (default 16,1024,65536)")
+    parser.add_argument("--concurrency", default=[1, 4, 16],
+                        type=_list_of(int),
+                        help="Comma-separated numbers of concurrent clients "
+                        "for rpc (default 1,4,16)")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark {0!r}".format(name))
+
+    for name in args.benchmarks or sorted(benchmarks):
+        for result in benchmarks[name](args):
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
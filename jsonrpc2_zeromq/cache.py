@@ -0,0 +1,177 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# Caching of handler results, for RPCServer.
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+
+import collections
+import json
+import threading
+import time
+
+
+def cacheable(ttl=60, max_size=1000):
+    """Mark a handle_{method}_method handler as safe to cache: its result
+    depends only on its params. Results are kept for ttl seconds, and at
+    most max_size of them, least recently used first out."""
+    def decorate(handler):
+        handler.cache_options = (ttl, max_size)
+        return handler
+    return decorate
+
+
+def cache_key(params):
+    """Params in a canonical form, or None if they can't be cached, e.g.
+    because they include binary attachments."""
+    try:
+        return json.dumps(params, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+
+
+class CacheEntry(object):
+
+    # A result, plus its encodings by codec name, each a (bytes,
+    # attachments) pair to be spliced into responses (see
+    # Codec.dumps_result).
+
+    __slots__ = ('result', 'expires', 'encoded')
+
+    def __init__(self, result, expires):
+        self.result = result
+        self.expires = expires
+        self.encoded = {}
+
+
+class ResponseCache(object):
+
+    # The cached results of one handler, by cache_key of their params.
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Most recently used go to the end
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, result):
+        entry = CacheEntry(result, time.time() + self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(size=len(self.entries), hits=self.hits,
+                        misses=self.misses, evictions=self.evictions)
+
+
+class RecentRequest(object):
+
+    __slots__ = ('expires', 'client_id', 'waiting', 'response')
+
+    def __init__(self, expires, client_id):
+        self.expires = expires
+        self.client_id = client_id
+        self.waiting = []
+        self.response = None
+
+
+class RecentRequests(object):
+
+    # Responses to recent idempotent requests by id, so that retries of them
+    # are answered without handling them again. Requests are remembered for
+    # window seconds from when they arrive, and no more than max_size of
+    # them, oldest first out.
+
+    IN_PROGRESS = object()
+
+    def __init__(self, window=60, max_size=10000):
+        self.window = window
+        self.max_size = max_size
+        self.requests = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def start(self, id_, client_id):
+        """Returns None if id_ is new, in which case the caller should handle
+        the request then call finish(). Otherwise returns the response to
+        send, or IN_PROGRESS if it isn't ready yet, in which case it's sent
+        to client_id by whoever calls finish()."""
+        now = time.time()
+        with self.lock:
+            request = self.requests.get(id_)
+            if request is None or request.expires <= now:
+                self.requests.pop(id_, None)
+                self._prune(now)
+                self.requests[id_] = RecentRequest(now + self.window,
+                                                   client_id)
+                return None
+
+            self.retries += 1
+            if request.response is not None:
+                return request.response
+            if client_id != request.client_id and \
+                    client_id not in request.waiting:
+                request.waiting.append(client_id)
+            return self.IN_PROGRESS
+
+    def response(self, id_):
+        """The recorded response to id_, if there is one yet."""
+        with self.lock:
+            request = self.requests.get(id_)
+            return request.response if request is not None else None
+
+    def _prune(self, now):
+        # Make room for one more
+        while self.requests:
+            oldest = next(iter(self.requests.values()))
+            if oldest.expires > now and len(self.requests) < self.max_size:
+                break
+            self.requests.popitem(last=False)
+
+    def finish(self, id_, response):
+        """Record the response to id_, returning the other clients waiting
+        for it."""
+        with self.lock:
+            request = self.requests.get(id_)
+            if request is None:
+                return []
+            request.response = response
+            waiting, request.waiting = request.waiting, []
+            return waiting
@@ -11,7 +11,15 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import *  # NOQA
 
+import contextlib
+import logging
 import threading
+import heapq
+import itertools
+import queue
+import random
+import time
+from concurrent.futures import Future
 
 import zmq
 
@@ -22,18 +30,36 @@ class TimeoutError(Exception):
     pass
 
 
+def _ms_until(t):
+    return max(0, int((t - time.time()) * 1000))
+
+
 class RPCClient(common.Endpoint):
 
+    # With retries, a call that times out is sent again, with the same id,
+    # up to that many more times. Calls are then marked idempotent, so a
+    # server with enable_idempotent_retries() won't handle them twice.
+    #
+    # With send_deadlines set, calls carry their deadline, when the client
+    # will stop waiting for a response, so servers can skip them if it's
+    # already passed. Only set it for servers whose clocks agree with the
+    # client's, give or take their deadline_grace.
+
     default_socket_type = zmq.REQ
     error_code_exceptions = None
     request_method_class = common.RequestMethod
+    retries = 0
+    send_deadlines = False
 
     socket = None
 
     def __init__(self, endpoint, context=None, timeout=5000,
-                 socket_type=None, logger=None):
+                 socket_type=None, logger=None, codec=None, retries=None,
+                 compression=None):
         super(RPCClient, self).__init__(endpoint, socket_type, timeout,
-                                        context, logger)
+                                        context, logger, codec, compression)
+        if retries is not None:
+            self.retries = retries
         self.notify = NotifierProxy(self)
         self.request_poller = zmq.Poller()
         self._reconnect_socket()
@@ -49,56 +75,140 @@ class RPCClient(common.Endpoint):
         self.request_sock = self.socket
 
     def request(self, request):
-        self.logger.debug(">_> Client calling \"{method}\" on {endpoint} "
-                          "with params:\n{params}".format(
-                              method=request.method, endpoint=self.endpoint,
-                              params=common.debug_log_object_dump(
-                                  request.params)))
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(">_> Client calling \"{method}\" on {endpoint} "
+                              "with params:\n{params}".format(
+                                  method=request.method,
+                                  endpoint=self.endpoint,
+                                  params=common.debug_log_object_dump(
+                                      request.params)))
+
+        retries = self.retries if request.id is not None else 0
+        if retries:
+            request.idempotent = True
+
+        trace = self._start_trace('request')
+        trace.method = request.method
+        trace.id = request.id
+        try:
+            while True:
+                try:
+                    response = self._send_and_receive(
+                        request, request.method, request.id is not None,
+                        trace)
+                    break
+                except TimeoutError:
+                    if not retries:
+                        raise
+                    retries -= 1
+                    self.logger.warning("v_v Client retrying \"%s\" on %s",
+                                        request.method, self.endpoint)
+        finally:
+            self._finish_trace(trace)
+        if response is None:
+            return  # We don't get a response for notifications
+
+        if not isinstance(response, common.Response):
+            raise ValueError("Received a non-response")
+        if request.id != response.id:
+            raise ValueError("Received out-of-order response")
+        if response.is_error:
+            raise response.error_exception(self.error_code_exceptions)
+
+        if debug:
+            self.logger.debug("<_< Client received from call of \"{method}\""
+                              " on {endpoint}:\n{result}".format(
+                                  method=request.method,
+                                  endpoint=self.endpoint,
+                                  result=common.debug_log_object_dump(
+                                      response.result)))
+        return response.result
+
+    def request_batch(self, requests):
+        """Send requests as one batch, returning the Responses to the method
+        calls among them, in the same order."""
+        if not requests:
+            return []
+
+        self.logger.debug(">_> Client calling batch of %d on %s",
+                          len(requests), self.endpoint)
+
+        method_ids = [r.id for r in requests if r.id is not None]
+        trace = self._start_trace('request')
+        try:
+            response = self._send_and_receive(requests, "batch",
+                                              bool(method_ids), trace)
+        finally:
+            self._finish_trace(trace)
+        if response is None:
+            return []  # Only notifications in the batch
+
+        # The server answers with a single error if it can't read the batch
+        if isinstance(response, common.Response) and response.is_error:
+            raise response.error_exception(self.error_code_exceptions)
+        if not isinstance(response, list):
+            raise ValueError("Received a non-response")
+
+        responses = dict((r.id, r) for r in response
+                         if isinstance(r, common.Response))
+        try:
+            return [responses[id_] for id_ in method_ids]
+        except KeyError:
+            raise ValueError("Received incomplete batch response")
+
+    def batch(self):
+        return Batch(self)
+
+    def _set_deadline(self, request, deadline):
+        # Stamp the calls in request (or a batch of them) with deadline
+        if not self.send_deadlines:
+            return
+        for r in (request if isinstance(request, list) else [request]):
+            if r.id is not None:
+                r.deadline = deadline
+
+    def _send_and_receive(self, request, method, expect_response,
+                          trace=common.null_trace):
+        # Sending and receiving share the one timeout, so the client gives
+        # up at the deadline it sends
+        give_up = time.time() + self.timeout / 1000.0
+        self._set_deadline(request, give_up)
+        frames = self._encode_request(request)
+        trace.mark('serialize')
 
         self.request_poller.register(self.request_sock, zmq.POLLOUT)
-        if not self.request_poller.poll(self.timeout):
+        if not self.request_poller.poll(_ms_until(give_up)):
             self.on_timeout(request)
             raise TimeoutError("Timed out while waiting to call {method} on "
-                               "{endpoint}".format(method=request.method,
+                               "{endpoint}".format(method=method,
                                                    endpoint=self.endpoint))
 
         self.request_poller.unregister(self.request_sock)
-        self.request_sock.send(common.json_rpc_dumps(request))
+        self.request_sock.send_multipart(frames,
+                                         copy=common.should_copy(frames))
+        trace.mark('send')
 
-        if request.id is None:
-            return  # We don't get a response for notifications
+        if not expect_response:
+            return
 
-        self.logger.debug("-.- Client waiting for response from {method} "
-                          "on {endpoint}".format(
-                              method=request.method,
-                              endpoint=self.endpoint,
-                              params=common.debug_log_object_dump(
-                                  request.params)))
+        self.logger.debug("-.- Client waiting for response from %s on %s",
+                          method, self.endpoint)
         self.request_poller.register(self.request_sock, zmq.POLLIN)
-        if not self.request_poller.poll(self.timeout):
+        if not self.request_poller.poll(_ms_until(give_up)):
             self.on_timeout(request)
             raise TimeoutError(
                 "Timed out while getting response to {method} on "
-                "{endpoint}".format(method=request.method,
-                                    endpoint=self.endpoint))
+                "{endpoint}".format(method=method, endpoint=self.endpoint))
 
         self.request_poller.unregister(self.request_sock)
-        response = common.json_rpc_loads(self.request_sock.recv())
-
-        if request.id != response.id:
-            raise ValueError("Received out-of-order response")
-        if not isinstance(response, common.Response):
-            raise ValueError("Received a non-response")
-        if response.is_error:
-            raise response.error_exception(self.error_code_exceptions)
-
-        self.logger.debug("<_< Client received from call of \"{method}\""
-                          " on {endpoint}:\n{result}".format(
-                              method=request.method,
-                              endpoint=self.endpoint,
-                              result=common.debug_log_object_dump(
-                                  response.result)))
-        return response.result
+        frames = self.request_sock.recv_multipart(copy=False)
+        trace.mark('recv')
+        response = self._decode(frames)
+        trace.mark('parse')
+        if isinstance(response, common.Response) and response.is_error:
+            trace.error_code = response.error['code']
+        return response
 
     def on_timeout(self, req):
         self._reconnect_socket()  # Drop outgoing message
@@ -119,6 +229,391 @@ class NotifierProxy(object):
         return self.client.get_request_method(method, notify=True)
 
 
+class Batch(object):
+
+    # Collects calls to send together as a JSON-RPC batch. Use through
+    # RPCClient.batch():
+    #
+    #     with client.batch() as b:
+    #         foo = b.foo(1)
+    #         b.notify.bar(2)
+    #     print(foo.result(), b.results)
+
+    def __init__(self, client):
+        self.client = client
+        self.notify = NotifierProxy(self)
+        self.requests = []
+        self.calls = []
+
+    def request(self, request):
+        self.requests.append(request)
+        if request.id is not None:
+            call = BatchCall(self.client)
+            self.calls.append(call)
+            return call
+
+    def send(self):
+        responses = self.client.request_batch(self.requests)
+        for call, response in zip(self.calls, responses):
+            call.response = response
+
+    @property
+    def results(self):
+        return [call.result() for call in self.calls]
+
+    def get_request_method(self, method, notify=False):
+        return self.client.request_method_class(method, client=self,
+                                                notify=notify)
+
+    def __getattr__(self, method):
+        return self.get_request_method(method)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+
+class BatchCall(object):
+
+    response = None
+
+    def __init__(self, client):
+        self.client = client
+
+    def result(self):
+        if self.response is None:
+            raise ValueError("Batch has not been sent")
+        if self.response.is_error:
+            raise self.response.error_exception(
+                self.client.error_code_exceptions)
+        return self.response.result
+
+
+_DefaultTimeout = object()
+
+
+class RPCClientPool(object):
+
+    # A bounded pool of RPCClients, for sharing between threads. Clients are
+    # connected as they're first needed, up to size of them; calls check one
+    # out, waiting up to checkout_timeout milliseconds (or forever, if None)
+    # for one to be free. pool.method(...) works as with a single client, or
+    # use one for several calls with:
+    #
+    #     with pool.connection() as client:
+    #         client.foo()
+    #
+    # A client that times out reconnects its own socket, in the calling
+    # thread, so the rest of the pool carries on meanwhile. One that fails
+    # any other way is discarded, and replaced when next needed.
+
+    client_class = RPCClient
+    request_method_class = common.RequestMethod
+    error_code_exceptions = None
+    default_size = 8
+
+    closed = False
+
+    def __init__(self, endpoint, size=None, context=None, timeout=5000,
+                 socket_type=None, logger=None, codec=None,
+                 checkout_timeout=None, compression=None):
+        self.endpoint = endpoint
+        self.size = size or self.default_size
+        self.checkout_timeout = checkout_timeout
+        self.client_kwargs = dict(context=context, timeout=timeout,
+                                  socket_type=socket_type, logger=logger,
+                                  codec=codec, compression=compression)
+        self.notify = NotifierProxy(self)
+        self.idle = []
+        self.num_clients = 0
+        self.condition = threading.Condition()
+
+    def _new_client(self):
+        client = self.client_class(self.endpoint, **self.client_kwargs)
+        if self.error_code_exceptions is not None:
+            client.error_code_exceptions = self.error_code_exceptions
+        return client
+
+    def checkout(self, timeout=_DefaultTimeout):
+        if timeout is _DefaultTimeout:
+            timeout = self.checkout_timeout
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+
+        with self.condition:
+            while not self.idle and self.num_clients >= self.size:
+                if self.closed:
+                    raise ValueError("Pool is closed")
+                remaining = None if deadline is None \
+                    else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(
+                        "Timed out waiting for a client for {endpoint} from "
+                        "the pool".format(endpoint=self.endpoint))
+                self.condition.wait(remaining)
+            if self.closed:
+                raise ValueError("Pool is closed")
+            if self.idle:
+                return self.idle.pop()
+            self.num_clients += 1
+
+        # Connect outside the lock, so other threads aren't held up
+        try:
+            return self._new_client()
+        except BaseException:
+            self._forget_client()
+            raise
+
+    def checkin(self, client):
+        with self.condition:
+            if not self.closed:
+                self.idle.append(client)
+                self.condition.notify()
+                return
+        self.discard(client)
+
+    def discard(self, client):
+        client.close()
+        self._forget_client()
+
+    def _forget_client(self):
+        with self.condition:
+            self.num_clients -= 1
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=_DefaultTimeout):
+        client = self.checkout(timeout)
+        try:
+            yield client
+        except (common.RPCError, TimeoutError):
+            # The client is still usable after these
+            self.checkin(client)
+            raise
+        except BaseException:
+            self.discard(client)
+            raise
+        else:
+            self.checkin(client)
+
+    def request(self, request):
+        with self.connection() as client:
+            return client.request(request)
+
+    def request_batch(self, requests):
+        with self.connection() as client:
+            return client.request_batch(requests)
+
+    def batch(self):
+        return Batch(self)
+
+    def get_request_method(self, method, notify=False):
+        return self.request_method_class(method, client=self, notify=notify)
+
+    def __getattr__(self, method):
+        return self.get_request_method(method)
+
+    def close(self):
+        # Clients checked out now are closed when they're checked back in
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.num_clients -= len(idle)
+            self.condition.notify_all()
+        for client in idle:
+            client.close()
+
+
+class EndpointState(object):
+
+    # What LoadBalancingRPCClient knows of one of its endpoints. latency is
+    # a moving average of recent calls' durations, in seconds.
+
+    def __init__(self, endpoint, pool):
+        self.endpoint = endpoint
+        self.pool = pool
+        self.in_flight = 0
+        self.latency = None
+        self.benched = False
+        self.failures = 0
+
+    def load(self, default_latency):
+        latency = default_latency if self.latency is None else self.latency
+        return (self.in_flight + 1) * latency
+
+
+class LoadBalancingRPCClient(object):
+
+    # Spreads calls across several servers for the same methods. Each call
+    # goes to the healthy endpoint with the least load, judged by its calls
+    # in flight and recent latency, through an RPCClientPool per endpoint,
+    # so it can be shared between threads.
+    #
+    # An endpoint that times out is benched: it gets no calls until a
+    # background thread, probing it every probe_interval milliseconds, gets
+    # a reply from it. Calls that time out are retried on another endpoint
+    # if retry_on_timeout is set, which is only safe if methods are
+    # idempotent. If every endpoint is benched, calls go to them anyway.
+    # Calls a server sheds with ServerOverloaded weren't handled, so are
+    # always tried on another endpoint.
+
+    pool_class = RPCClientPool
+    request_method_class = common.RequestMethod
+    error_code_exceptions = None
+    latency_weight = 0.2  # of each new call's latency in the average
+    probe_interval = 1000  # milliseconds
+    probe_timeout = 1000  # milliseconds
+    probe_method = 'rpc.ping'
+
+    closed = False
+
+    def __init__(self, endpoints, pool_size=None, context=None,
+                 timeout=5000, socket_type=None, logger=None, codec=None,
+                 retry_on_timeout=False, compression=None):
+        if not endpoints:
+            raise ValueError("No endpoints given")
+        self.client_kwargs = dict(context=context, timeout=timeout,
+                                  socket_type=socket_type, logger=logger,
+                                  codec=codec, compression=compression)
+        self.logger = logger or common.package_logger
+        self.retry_on_timeout = retry_on_timeout
+        self.notify = NotifierProxy(self)
+        self.endpoints = [
+            EndpointState(endpoint, self.pool_class(endpoint, size=pool_size,
+                                                    **self.client_kwargs))
+            for endpoint in endpoints]
+        for state in self.endpoints:
+            state.pool.error_code_exceptions = self.error_code_exceptions
+        self.lock = threading.Lock()
+        self.prober = None
+        self.prober_wakeup = threading.Event()
+
+    def _choose_endpoint(self, exclude=()):
+        with self.lock:
+            candidates = [s for s in self.endpoints
+                          if not s.benched and s not in exclude] or \
+                [s for s in self.endpoints if s not in exclude]
+            if not candidates:
+                return None
+            # Endpoints not called yet look as fast as the fastest
+            latencies = [s.latency for s in candidates
+                         if s.latency is not None]
+            default_latency = min(latencies) if latencies else 1.0
+            state = min(candidates, key=lambda s: (s.load(default_latency),
+                                                   random.random()))
+            state.in_flight += 1
+            return state
+
+    def _call(self, method, call):
+        tried = []
+        overloaded = None
+        while True:
+            state = self._choose_endpoint(tried)
+            if state is None:
+                if overloaded is not None:
+                    raise overloaded
+                raise TimeoutError(
+                    "Timed out calling {method} on every endpoint".format(
+                        method=method))
+            tried.append(state)
+            start = time.time()
+            try:
+                result = call(state.pool)
+            except TimeoutError:
+                self._bench(state)
+                if not self.retry_on_timeout:
+                    raise
+                continue
+            except common.ServerOverloaded as e:
+                overloaded = e
+                continue
+            except common.RPCError:
+                self._record_latency(state, time.time() - start)
+                raise
+            else:
+                self._record_latency(state, time.time() - start)
+                return result
+            finally:
+                with self.lock:
+                    state.in_flight -= 1
+
+    def _record_latency(self, state, latency):
+        with self.lock:
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += self.latency_weight * \
+                    (latency - state.latency)
+
+    def _bench(self, state):
+        with self.lock:
+            state.failures += 1
+            if state.benched or self.closed:
+                return
+            state.benched = True
+            self.logger.warning("v_v Benching %s after a timeout",
+                                state.endpoint)
+            if self.prober is None or not self.prober.is_alive():
+                self.prober = threading.Thread(target=self._probe_benched)
+                self.prober.daemon = True
+                self.prober.start()
+
+    def _probe_benched(self):
+        while not self.closed:
+            with self.lock:
+                benched = [s for s in self.endpoints if s.benched]
+            if not benched:
+                return
+            for state in benched:
+                if self._probe(state.endpoint):
+                    with self.lock:
+                        state.benched = False
+                        state.latency = None
+                    self.logger.info("^_^ Restoring %s", state.endpoint)
+            self.prober_wakeup.wait(self.probe_interval / 1000.0)
+
+    def _probe(self, endpoint):
+        # Any reply, even an error, shows the server is back
+        client = RPCClient(endpoint, **dict(self.client_kwargs,
+                                            timeout=self.probe_timeout))
+        try:
+            client.request(common.Request(self.probe_method, []))
+        except common.RPCError:
+            pass
+        except TimeoutError:
+            return False
+        finally:
+            client.close()
+        return True
+
+    def request(self, request):
+        return self._call(request.method,
+                          lambda pool: pool.request(request))
+
+    def request_batch(self, requests):
+        return self._call("batch",
+                          lambda pool: pool.request_batch(requests))
+
+    def batch(self):
+        return Batch(self)
+
+    def get_request_method(self, method, notify=False):
+        return self.request_method_class(method, client=self, notify=notify)
+
+    def __getattr__(self, method):
+        return self.get_request_method(method)
+
+    def close(self):
+        self.closed = True
+        self.prober_wakeup.set()
+        if self.prober is not None:
+            self.prober.join()
+        for state in self.endpoints:
+            state.pool.close()
+
+
 class RPCNotifierClient(RPCClient):
 
     default_socket_type = zmq.DEALER
@@ -129,7 +624,147 @@ class NotifierOnlyPushClient(RPCClient):
     default_socket_type = zmq.PUSH
 
 
-class NotificationReceiverClient(RPCNotifierClient, threading.Thread):
+class NotificationHandlerMixin(object):
+
+    # Passes notifications received by a client's thread to its
+    # handle_{method}_notification handlers, which run in
+    # notification_workers threads of their own, so slow handlers don't hold
+    # up receiving (and replies to calls). Notifications wait for a worker in
+    # a queue of up to notification_queue_size. Receiving never waits for
+    # room: when the queue's full, notification_overflow_policy says whether
+    # to drop the "drop_oldest" or "drop_newest" notification. Dropped ones
+    # are counted in dropped_notifications.
+    #
+    # A handle_{method}_notifications handler, if there is one, is instead
+    # given a list of the params of as many of that method's notifications as
+    # are waiting in a row, up to notification_batch_size, to handle in bulk.
+    #
+    # With more than one worker, handlers must be thread-safe, and
+    # notifications may be handled out of order.
+
+    notification_workers = 1
+    notification_queue_size = 1000
+    notification_batch_size = 100
+    notification_overflow_policy = 'drop_oldest'
+    dropped_notifications = 0
+
+    def _start_notification_workers(self):
+        self.notification_queue = queue.Queue(self.notification_queue_size)
+        self.notification_threads = [
+            threading.Thread(target=self._run_notification_worker)
+            for i in range(self.notification_workers)]
+        for thread in self.notification_threads:
+            thread.daemon = True
+            thread.start()
+
+    def _stop_notification_workers(self):
+        # Workers finish what's queued, then stop at a None each
+        for thread in self.notification_threads:
+            self.notification_queue.put(None)
+        for thread in self.notification_threads:
+            thread.join()
+
+    def _dispatch_notification(self, msg):
+        while True:
+            try:
+                self.notification_queue.put_nowait(msg)
+                return
+            except queue.Full:
+                pass
+            if self.notification_overflow_policy != 'drop_newest':
+                try:
+                    self.notification_queue.get_nowait()
+                except queue.Empty:
+                    continue  # A worker made room meanwhile
+            self.dropped_notifications += 1
+            self.logger.warning("v_v Client dropping notification from "
+                                "subscription on %s: handlers are behind",
+                                self.endpoint)
+            if self.notification_overflow_policy == 'drop_newest':
+                return
+
+    def _run_notification_worker(self):
+        while True:
+            msg = self.notification_queue.get()
+            if msg is None:
+                return
+            batch = [msg]
+            while len(batch) < self.notification_batch_size:
+                try:
+                    msg = self.notification_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if msg is None:
+                    self._handle_notifications(batch)
+                    return
+                batch.append(msg)
+            self._handle_notifications(batch)
+
+    def _handle_notifications(self, batch):
+        for method, msgs in itertools.groupby(batch, lambda msg: msg.method):
+            try:
+                handler, signature = common.dispatch_table(
+                    self, 'handle_{method}_notifications').lookup(method)
+            except common.MethodNotFound:
+                for msg in msgs:
+                    self._handle_notification(msg)
+                continue
+            try:
+                handler([msg.params for msg in msgs])
+            except Exception:
+                self.logger.exception("Exception handling \"%s\" "
+                                      "notifications from subscription on "
+                                      "%s", method, self.endpoint)
+
+    def _handle_notification(self, msg):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("<_< Client received notification "
+                              "\"{method}\" "
+                              "from subscription on {endpoint}:\n"
+                              "{result}".format(
+                                  endpoint=self.endpoint,
+                                  method=msg.method,
+                                  result=common.debug_log_object_dump(
+                                      msg.params)
+                              ))
+
+        try:
+            common.handle_request(self, 'handle_{method}_notification', msg)
+        except common.MethodNotFound:
+            self.logger.warning(
+                "v_v Client has no handler for "
+                "\"{method}\" notification from "
+                "subscription on {endpoint}".format(
+                    method=msg.method,
+                    endpoint=self.endpoint
+                ))
+        except Exception:
+            self.logger.exception("Exception handling \"%s\" notification "
+                                  "from subscription on %s", msg.method,
+                                  self.endpoint)
+
+    def wait_for_notifications(self):
+        while self.is_alive():
+            try:
+                self.join(self.poll_timeout)
+            except KeyboardInterrupt:
+                break
+
+    def stop(self):
+        self.should_stop = True
+        self.join()
+        self._stop_notification_workers()
+
+
+class NotificationReceiverClient(NotificationHandlerMixin, RPCNotifierClient,
+                                 threading.Thread):
+
+    # Receives notifications sent back to it by the server (see
+    # SubscriptionServer), as well as making calls, from any number of
+    # threads at once. Its own thread owns the socket: calling threads pass
+    # it their requests over an inproc PUSH socket, which they take turns to
+    # use, then wait for it to hand over the response with their request's
+    # id. Anything else received is a notification.
 
     on_notification = None
     should_stop = False
@@ -137,76 +772,491 @@ class NotificationReceiverClient(RPCNotifierClient, threading.Thread):
 
     def __init__(self, *args, **kwargs):
         super(NotificationReceiverClient, self).__init__(*args, **kwargs)
+        self.pending = {}  # request id -> queue to put its response in
+        self.pending_lock = threading.Lock()
 
-        # We use a PAIR socket pair to communicate between the calling
-        # thread and the thread (this class) receiving subscription events.
-        # RPCServer thinks it's talking to the server, but now it's actually
-        # talking to this thread.
-        self.request_sock = self.context.socket(zmq.PAIR)
-        self.request_sock_endpoint = \
+        self.queue_endpoint = \
             "inproc://jsonrpc2-subscription-client-%x" % id(self)
-        self.request_sock.bind(self.request_sock_endpoint)
+        self.queue_sock = self.context.socket(zmq.PULL)
+        self.queue_sock.bind(self.queue_endpoint)
+        self.queue_push_sock = self.context.socket(zmq.PUSH)
+        self.queue_push_sock.setsockopt(zmq.LINGER, 0)
+        self.queue_push_sock.connect(self.queue_endpoint)
+        self.queue_push_lock = threading.Lock()
 
         # This is run automatically, as RPC-style blocking requests will not
         # get a response otherwise.
+        self._start_notification_workers()
         self.start()
 
+    def _send_and_receive(self, request, method, expect_response,
+                          trace=common.null_trace):
+        give_up = time.time() + self.timeout / 1000.0
+        self._set_deadline(request, give_up)
+        frames = self._encode_request(request)
+        trace.mark('serialize')
+
+        # A batch's response is put in the same queue for all its ids
+        ids = _message_ids(request) if expect_response else set()
+        waiter = queue.Queue(1)
+        with self.pending_lock:
+            for id_ in ids:
+                self.pending[id_] = waiter
+        try:
+            with self.queue_push_lock:
+                self.queue_push_sock.send_multipart(
+                    frames, copy=common.should_copy(frames))
+            trace.mark('send')
+            if not expect_response:
+                return
+
+            self.logger.debug("-.- Client waiting for response from %s on "
+                              "%s", method, self.endpoint)
+            try:
+                response = waiter.get(
+                    timeout=max(0, give_up - time.time()))
+            except queue.Empty:
+                self.on_timeout(request)
+                raise TimeoutError(
+                    "Timed out while getting response to {method} on "
+                    "{endpoint}".format(method=method,
+                                        endpoint=self.endpoint))
+        finally:
+            with self.pending_lock:
+                for id_ in ids:
+                    if self.pending.get(id_) is waiter:
+                        del self.pending[id_]
+
+        trace.mark('recv')
+        if isinstance(response, common.Response) and response.is_error:
+            trace.error_code = response.error['code']
+        return response
+
     def run(self):
         poller = zmq.Poller()
-        thread_pair_sock = self.context.socket(zmq.PAIR)
-        thread_pair_sock.connect(self.request_sock_endpoint)
-        poller.register(thread_pair_sock, zmq.POLLIN)
+        poller.register(self.queue_sock, zmq.POLLIN)
         poller.register(self.socket, zmq.POLLIN)
-        request_id = None
 
         while not self.should_stop:
             socks = dict(poller.poll(self.poll_timeout))
-            if thread_pair_sock in socks and \
-                    socks[thread_pair_sock] == zmq.POLLIN:
-                msg = common.json_rpc_loads(thread_pair_sock.recv())
-                request_id = msg.id
-                self.socket.send(common.json_rpc_dumps(msg))
-
-            if self.socket in socks and socks[self.socket] == zmq.POLLIN:
-                msg_parts = self.socket.recv_multipart()
-                msg = common.json_rpc_loads(msg_parts[-1])
-                if msg.id and msg.id == request_id:
-                    thread_pair_sock.send(common.json_rpc_dumps(msg))
-                    request_id = None
-                elif not msg.id:
-                    self.logger.debug("<_< Client received notification "
-                                      "\"{method}\" "
-                                      "from subscription on {endpoint}:\n"
-                                      "{result}".format(
-                                          endpoint=self.endpoint,
-                                          method=msg.method,
-                                          result=common.debug_log_object_dump(
-                                              msg.params)
-                                      ))
 
+            if self.queue_sock in socks:
+                while True:
                     try:
-                        common.handle_request(
-                            self, 'handle_{method}_notification', msg)
-                    except common.MethodNotFound:
-                        self.logger.warning(
-                            "v_v Client has no handler for "
-                            "\"{method}\" notification from "
-                            "subscription on {endpoint}".format(
-                                method=msg.method,
-                                endpoint=self.endpoint
-                            ))
-
-    def on_timeout(self, *args, **kwargs):
-        self.stop()
-        super(NotificationReceiverClient, self).on_timeout(*args, **kwargs)
+                        msg_parts = self.queue_sock.recv_multipart(
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.socket.send_multipart(msg_parts, copy=False)
 
-    def wait_for_notifications(self):
-        while self.is_alive():
+            if self.socket in socks:
+                while True:
+                    try:
+                        msg_parts = self.socket.recv_multipart(
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self._handle_message(msg_parts)
+
+    def _handle_message(self, msg_parts):
+        try:
+            msg = self._decode(msg_parts)
+        except ValueError:
+            self.logger.warning("v_v Client received unparseable message on "
+                                "%s", self.endpoint)
+            return
+
+        with self.pending_lock:
+            waiters = set(self.pending.pop(id_)
+                          for id_ in _message_ids(msg)
+                          if id_ in self.pending)
+        if waiters:
+            for waiter in waiters:
+                waiter.put(msg)
+            return
+
+        # Not a reply to a call we're waiting for, so notifications
+        for notification in (msg if isinstance(msg, list) else [msg]):
+            if isinstance(notification, common.Request) and \
+                    notification.is_notification:
+                self._dispatch_notification(notification)
+
+    def on_timeout(self, req):
+        pass  # A late response is dropped when it arrives
+
+    def close(self):
+        if self.is_alive():
+            self.stop()
+        self.queue_push_sock.close()
+        self.queue_sock.close()
+        super(NotificationReceiverClient, self).close()
+
+
+class NotificationSubscriberClient(NotificationHandlerMixin, common.Endpoint,
+                                   threading.Thread):
+
+    # Receives the notifications a SubscriptionServer publishes on its PUB
+    # socket for the given topics, passing them to
+    # handle_{method}_notification handlers in its own thread, like
+    # NotificationReceiverClient. Notifications are published whether anyone
+    # is listening or not, so any sent before it connects are missed.
+
+    default_socket_type = zmq.SUB
+    should_stop = False
+    poll_timeout = 1000  # milliseconds
+
+    def __init__(self, endpoint, topics, context=None, socket_type=None,
+                 logger=None, codec=None):
+        super(NotificationSubscriberClient, self).__init__(
+            endpoint, socket_type, self.poll_timeout, context, logger, codec)
+        # SUB sockets match topics by prefix, so they're checked again
+        self.topics = set(topic.encode('utf-8') for topic in topics)
+        self.socket = self.context.socket(self.socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        for topic in self.topics:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.socket.connect(self.endpoint)
+        self._start_notification_workers()
+        self.start()
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self.should_stop:
+            if not poller.poll(self.poll_timeout):
+                continue
+            msg_parts = self.socket.recv_multipart(copy=False)
+            if common.frame_bytes(msg_parts[0]) not in self.topics:
+                continue
             try:
-                self.join(self.poll_timeout)
-            except KeyboardInterrupt:
-                break
+                msg = self._decode(msg_parts[1:])
+            except ValueError:
+                self.logger.warning("v_v Client received an unreadable "
+                                    "notification on %s", self.endpoint)
+                continue
+            if isinstance(msg, common.Request) and msg.is_notification:
+                self._dispatch_notification(msg)
+
+    def close(self):
+        if self.is_alive():
+            self.stop()
+        super(NotificationSubscriberClient, self).close()
+
+
+class PipelinedRPCClient(common.Endpoint, threading.Thread):
+
+    # A thread-safe client for ROUTER servers. A background thread owns the
+    # DEALER socket and routes responses to callers by request id, so any
+    # number of calls from any number of threads can be in flight at once.
+    # Calling threads pass their requests to it over an inproc PUSH socket,
+    # which they take turns to use.
+    #
+    # client.call_async.method(...) returns a concurrent.futures.Future;
+    # client.method(...) waits for the result. Each call fails with
+    # TimeoutError after timeout milliseconds without a response.
+    #
+    # client.stream.method(...) returns a ResultStream, iterating over the
+    # items of a generator handler's result as they're sent.
+    #
+    # Calls carry their deadline if send_deadlines is set (see RPCClient).
+
+    default_socket_type = zmq.DEALER
+    error_code_exceptions = None
+    request_method_class = common.RequestMethod
+    send_deadlines = False
+
+    should_stop = False
+    poll_timeout = 1000  # milliseconds
+    stream_window = 8  # chunks
+
+    def __init__(self, endpoint, context=None, timeout=5000,
+                 socket_type=None, logger=None, codec=None,
+                 compression=None):
+        super(PipelinedRPCClient, self).__init__(endpoint, socket_type,
+                                                 timeout, context, logger,
+                                                 codec, compression)
+        self.notify = NotifierProxy(self)
+        self.call_async = AsyncCallProxy(self)
+        self.stream = StreamCallProxy(self)
+        self.pending = {}
+        self.deadlines = []
+        self.pending_lock = threading.Lock()
+
+        self.socket = self.context.socket(self.socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.endpoint)
+
+        self.queue_endpoint = "inproc://jsonrpc2-pipelined-client-%x" % \
+            id(self)
+        self.queue_sock = self.context.socket(zmq.PULL)
+        self.queue_sock.bind(self.queue_endpoint)
+        self.queue_push_sock = self.context.socket(zmq.PUSH)
+        self.queue_push_sock.setsockopt(zmq.LINGER, 0)
+        self.queue_push_sock.connect(self.queue_endpoint)
+        self.queue_push_lock = threading.Lock()
+
+        self.daemon = True
+        self.start()
+
+    def request(self, request):
+        return self.request_async(request).result()
+
+    def request_async(self, request):
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        if request.id is not None:
+            deadline = time.time() + self.timeout / 1000.0
+            if self.send_deadlines:
+                request.deadline = deadline
+            with self.pending_lock:
+                self.pending[request.id] = future
+                heapq.heappush(self.deadlines, (deadline, request.id))
+
+        self._send(request)
+
+        if request.id is None:
+            # We don't get a response for notifications
+            future.set_result(None)
+        return future
+
+    def request_stream(self, request):
+        request.stream = self.stream_window
+        stream = ResultStream(self, request)
+        # No deadline: the stream times out waiting for each chunk instead
+        with self.pending_lock:
+            self.pending[request.id] = stream
+        self._send(request)
+        return stream
+
+    def _send(self, request):
+        frames = self._encode_request(request)
+        with self.queue_push_lock:
+            self.queue_push_sock.send_multipart(
+                frames, copy=common.should_copy(frames))
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.queue_sock, zmq.POLLIN)
+        poller.register(self.socket, zmq.POLLIN)
+
+        while not self.should_stop:
+            socks = dict(poller.poll(self._next_poll_timeout()))
+
+            if self.queue_sock in socks:
+                while True:
+                    try:
+                        msg_parts = self.queue_sock.recv_multipart(
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.socket.send_multipart(msg_parts, copy=False)
+
+            if self.socket in socks:
+                while True:
+                    try:
+                        msg_parts = self.socket.recv_multipart(
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self._handle_response(msg_parts)
+
+            self._expire_requests()
+
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if isinstance(future, ResultStream):
+                future.chunks.put(ClientStopped("Client stopped"))
+            else:
+                future.set_exception(ClientStopped("Client stopped"))
+
+    def _handle_response(self, msg_parts):
+        try:
+            response = self._decode(msg_parts)
+        except ValueError:
+            self.logger.warning("v_v Client received unparseable message on "
+                                "%s", self.endpoint)
+            return
+        if not isinstance(response, common.Response):
+            self.logger.warning("v_v Client received a non-response on %s",
+                                self.endpoint)
+            return
+
+        with self.pending_lock:
+            future = self.pending.get(response.id)
+            # Streams stay pending until their last chunk
+            if future is not None and not (
+                    isinstance(future, ResultStream) and
+                    response.stream == common.STREAM_MORE):
+                del self.pending[response.id]
+        if future is None:
+            return  # Already timed out
+
+        if isinstance(future, ResultStream):
+            future.chunks.put(response)
+        elif response.is_error:
+            future.set_exception(
+                response.error_exception(self.error_code_exceptions))
+        else:
+            future.set_result(response.result)
+
+    def _next_poll_timeout(self):
+        with self.pending_lock:
+            if not self.deadlines:
+                return self.poll_timeout
+            wait = (self.deadlines[0][0] - time.time()) * 1000
+        return max(0, min(self.poll_timeout, int(wait) + 1))
+
+    def _expire_requests(self):
+        now = time.time()
+        expired = []
+        with self.pending_lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, id_ = heapq.heappop(self.deadlines)
+                future = self.pending.pop(id_, None)
+                if future is not None:
+                    expired.append(future)
+        for future in expired:
+            future.set_exception(TimeoutError(
+                "Timed out while getting response on {endpoint}".format(
+                    endpoint=self.endpoint)))
+
+    def get_request_method(self, method, notify=False):
+        return self.request_method_class(method, client=self, notify=notify)
+
+    def __getattr__(self, method):
+        return self.get_request_method(method)
 
     def stop(self):
         self.should_stop = True
         self.join()
+
+    def close(self):
+        if self.is_alive():
+            self.stop()
+        self.queue_push_sock.close()
+        self.queue_sock.close()
+        super(PipelinedRPCClient, self).close()
+
+
+class AsyncCallProxy(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, request):
+        return self.client.request_async(request)
+
+    def __getattr__(self, method):
+        return self.client.request_method_class(method, client=self)
+
+
+class StreamCallProxy(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, request):
+        return self.client.request_stream(request)
+
+    def __getattr__(self, method):
+        return self.client.request_method_class(method, client=self)
+
+
+class ResultStream(object):
+
+    # Iterates over the items of a streamed result, fetching chunks of them
+    # as they arrive. Taking a chunk to consume grants the server credit to
+    # send another, so no more than the client's stream_window chunks are
+    # ever buffered. A handler that isn't a generator, or a server that
+    # can't stream, sends its whole result at once, which is iterated over
+    # the same way.
+    #
+    # close() (or leaving a with block) stops the stream early.
+
+    finished = False
+
+    def __init__(self, client, request):
+        self.client = client
+        self.request = request
+        self.window = request.stream
+        self.chunks = queue.Queue()
+        self.items = iter(())
+        self.unacknowledged = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                return next(self.items)
+            except StopIteration:
+                if self.finished:
+                    raise
+            self.items = iter(self._next_chunk())
+
+    next = __next__
+
+    def _next_chunk(self):
+        try:
+            response = self.chunks.get(timeout=self.client.timeout / 1000.0)
+        except queue.Empty:
+            self.close()
+            raise TimeoutError(
+                "Timed out while getting stream from {method} on "
+                "{endpoint}".format(method=self.request.method,
+                                    endpoint=self.client.endpoint))
+        if isinstance(response, Exception):
+            self.finished = True
+            raise response
+
+        if response.stream != common.STREAM_MORE:
+            self.finished = True
+        if response.is_error:
+            raise response.error_exception(self.client.error_code_exceptions)
+
+        if response.stream is None:
+            # Not streamed
+            result = response.result
+            return result if isinstance(result, list) else [result]
+
+        if not self.finished:
+            self._grant_credit()
+        return response.result
+
+    def _grant_credit(self):
+        # Credit is granted in batches, to save messages
+        self.unacknowledged += 1
+        if self.unacknowledged >= max(1, self.window // 2):
+            self.client.request_async(common.Request(
+                common.STREAM_CREDIT_METHOD,
+                [self.request.id, self.unacknowledged], notify=True))
+            self.unacknowledged = 0
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.items = iter(())
+        with self.client.pending_lock:
+            self.client.pending.pop(self.request.id, None)
+        self.client.request_async(common.Request(
+            common.STREAM_CANCEL_METHOD, [self.request.id], notify=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ClientStopped(Exception):
+    pass
+
+
+def _message_ids(msg):
+    msgs = msg if isinstance(msg, list) else [msg]
+    return set(m.id for m in msgs
+               if isinstance(m, (common.Request, common.Response)) and m.id)
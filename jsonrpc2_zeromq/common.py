@@ -13,14 +13,29 @@ from future.utils import with_metaclass, native_str_to_bytes, \
 standard_library.install_aliases()
 from builtins import *  # NOQA
 
+import os
 import uuid
+import inspect
+import itertools
 import json
 import re
 import logging
 import pprint
+import time
+import zlib
 
 import zmq
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 JSON_RPC_VERSION = '2.0'
 
@@ -51,39 +66,443 @@ def _json_default(o):
 
 
 def _parse_rpc_message(msg):
-    msg_fields = frozenset(list(msg.keys()))
-    if msg_fields.issuperset(frozenset(['jsonrpc', 'method'])):
+    if 'jsonrpc' not in msg:
+        return msg
+    elif 'method' in msg:
         return Request(msg['method'], msg.get('params', None),
-                       id_=msg.get('id', None))
-    elif msg_fields.issuperset(frozenset(['jsonrpc', 'id'])) and \
-            ('result' in msg_fields or 'error' in msg_fields):
+                       id_=msg.get('id', None), stream=msg.get('stream', None),
+                       idempotent=msg.get('idempotent', False),
+                       deadline=msg.get('deadline', None),
+                       accept_compression=msg.get('accept_compression', None))
+    elif 'id' in msg and ('result' in msg or 'error' in msg):
         return Response(msg.get('result', None), msg.get('error', None),
-                        msg['id'])
+                        msg['id'], stream=msg.get('stream', None))
     else:
         return msg
 
 
-def json_rpc_dumps(o):
-    return native_str_to_bytes(json.dumps(o, default=_json_default,
+def _parse_rpc_envelope(o):
+    # Only the top level (or the elements of a batch) can be a message;
+    # anything nested inside params or results is left as plain data.
+    if isinstance(o, dict):
+        return _parse_rpc_message(o)
+    elif isinstance(o, list):
+        return [_parse_rpc_message(m) if isinstance(m, dict) else m
+                for m in o]
+    else:
+        return o
+
+
+def json_rpc_dumps(o, attachments=None):
+    default = _json_default if attachments is None \
+        else _attachment_default(attachments)
+    return native_str_to_bytes(json.dumps(o, default=default,
                                           ensure_ascii=True))
 
 
 def json_rpc_loads(s):
-    return json.loads(bytes_to_native_str(s), object_hook=_parse_rpc_message)
+    return _parse_rpc_envelope(json.loads(bytes_to_native_str(s)))
+
+
+ATTACHMENT_KEY = '$attachment'
+
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+ZERO_COPY_THRESHOLD = 65536  # bytes
+
+
+def _attachment_default(attachments):
+    # Binary values are sent as frames after the message, and replaced in it
+    # with a reference to their frame.
+    def default(o):
+        if isinstance(o, BINARY_TYPES):
+            attachments.append(o)
+            return {ATTACHMENT_KEY: len(attachments) - 1}
+        return _json_default(o)
+    return default
+
+
+def _resolve_attachments(o, attachments):
+    if isinstance(o, dict):
+        if len(o) == 1 and ATTACHMENT_KEY in o:
+            try:
+                return attachments[o[ATTACHMENT_KEY]]
+            except (IndexError, TypeError):
+                raise ValueError("Invalid attachment reference")
+        return dict((k, _resolve_attachments(v, attachments))
+                    for k, v in o.items())
+    elif isinstance(o, list):
+        return [_resolve_attachments(v, attachments) for v in o]
+    else:
+        return o
+
+
+def resolve_attachments(msg, attachments):
+    """Put attachment frames in place of the references to them in msg."""
+    if isinstance(msg, list):
+        return [resolve_attachments(m, attachments) for m in msg]
+    elif isinstance(msg, Request):
+        msg.params = _resolve_attachments(msg.params, attachments)
+    elif isinstance(msg, Response):
+        msg.result = _resolve_attachments(msg.result, attachments)
+    return msg
+
+
+def frame_bytes(frame):
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
+
+
+def frame_buffer(frame):
+    return frame.buffer if isinstance(frame, zmq.Frame) else memoryview(frame)
+
+
+def should_copy(frames):
+    # Large frames, such as attachments, are given to ZeroMQ to send in
+    # place. Small ones are quicker to copy.
+    return all(len(f) < ZERO_COPY_THRESHOLD for f in frames)
+
+
+def decode_frames(frames, default_codec=None):
+    """Decode a message from its frames: any empty delimiter frames, the
+    encoded message, then its attachments. Returns the message and the codec
+    it was encoded with."""
+    body_index = 0
+    while body_index < len(frames) and not len(frames[body_index]):
+        body_index += 1
+    if body_index == len(frames):
+        raise ValueError("No message")
+
+    body = frame_bytes(frames[body_index])
+    compressor = compressors_by_marker.get(bytes(body[:2]))
+    if compressor is not None:
+        body = compressor.decompress_message(body)
+    codec = codec_for_message(body, default_codec)
+    msg = codec.loads(body)
+    if body_index + 1 < len(frames):
+        msg = resolve_attachments(
+            msg, [frame_buffer(f) for f in frames[body_index + 1:]])
+    return msg, codec
+
+
+CODEC_MARKER_PREFIX = b'\x00'
+
+
+class Codec(object):
+
+    # Turns messages into bytes and back. Codecs with a marker start each
+    # message with it, so receivers can tell which codec to decode with.
+    # Markers are a null byte, which JSON text can't start with, then one
+    # byte identifying the codec. Codecs without a marker must produce
+    # plain JSON text, which any peer can read.
+
+    name = None
+    marker = None
+
+    def dumps(self, o, attachments=None):
+        """If attachments is a list, codecs without their own binary type
+        should move binary values into it (see _attachment_default)."""
+        raise NotImplementedError()
+
+    def loads(self, data):
+        """Should raise ValueError if data can't be decoded."""
+        raise NotImplementedError()
+
+    def dumps_result(self, result, attachments=None):
+        """Encode a result on its own, for dumps_response to put in any
+        number of responses. Returns None if the codec can't do this."""
+        return None
+
+    def dumps_response(self, encoded_result, id_):
+        raise NotImplementedError()
+
+
+_response_prefix = b'{"jsonrpc":"2.0","result":'
+
+
+class JSONCodec(Codec):
+
+    name = 'json'
+
+    def dumps(self, o, attachments=None):
+        return json_rpc_dumps(o, attachments)
+
+    def dumps_result(self, result, attachments=None):
+        return json_rpc_dumps(result, attachments)
+
+    def dumps_response(self, encoded_result, id_):
+        return b''.join((_response_prefix, encoded_result, b',"id":',
+                         json_rpc_dumps(id_), b'}'))
+
+    def loads(self, data):
+        return json_rpc_loads(bytes(data))
+
+
+class OrjsonCodec(Codec):
+
+    # Plain JSON, using the faster orjson library.
+
+    name = 'orjson'
+
+    def __init__(self):
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, o, attachments=None):
+        default = _json_default if attachments is None \
+            else _attachment_default(attachments)
+        return orjson.dumps(o, default=default, option=self.options)
+
+    def loads(self, data):
+        return _parse_rpc_envelope(orjson.loads(data))
+
+    dumps_result = dumps
+
+    def dumps_response(self, encoded_result, id_):
+        return b''.join((_response_prefix, encoded_result, b',"id":',
+                         orjson.dumps(id_), b'}'))
+
+
+class MsgpackCodec(Codec):
+
+    name = 'msgpack'
+    marker = CODEC_MARKER_PREFIX + b'M'
+
+    def dumps(self, o, attachments=None):
+        # Binary values are sent inline, as msgpack has a type for them.
+        return self.marker + msgpack.packb(o, default=_json_default,
+                                           use_bin_type=True)
+
+    def dumps_result(self, result, attachments=None):
+        return msgpack.packb(result, default=_json_default, use_bin_type=True)
+
+    def dumps_response(self, encoded_result, id_):
+        # A map of three: jsonrpc, result and id
+        return b''.join((self.marker, b'\x83',
+                         msgpack.packb('jsonrpc'), msgpack.packb('2.0'),
+                         msgpack.packb('result'), encoded_result,
+                         msgpack.packb('id'), msgpack.packb(id_)))
+
+    def loads(self, data):
+        try:
+            return _parse_rpc_envelope(msgpack.unpackb(
+                memoryview(data)[len(self.marker):], raw=False))
+        except Exception as e:
+            raise ValueError(str(e))
+
+
+codecs = {}
+codecs_by_marker = {}
+
+
+def register_codec(codec):
+    if codec.marker is not None and \
+            (len(codec.marker) != 2 or
+             codec.marker[:1] != CODEC_MARKER_PREFIX):
+        raise ValueError("Codec markers must be a null byte and one other")
+    codecs[codec.name] = codec
+    if codec.marker is not None:
+        codecs_by_marker[codec.marker] = codec
+
+
+def get_codec(codec):
+    """Return the registered codec with the given name, or codec if it's
+    already a Codec."""
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return codecs[codec]
+    except KeyError:
+        raise ValueError("Unknown codec {0!r}".format(codec))
+
+
+def codec_for_message(data, default=None):
+    """Return the codec data was encoded with. Unmarked messages are JSON,
+    read with default if that is a JSON codec."""
+    if data[:1] != CODEC_MARKER_PREFIX:
+        return default if default and default.marker is None else json_codec
+    try:
+        return codecs_by_marker[bytes(data[:2])]
+    except KeyError:
+        raise ValueError("Unknown codec marker")
+
+
+json_codec = JSONCodec()
+register_codec(json_codec)
+if orjson is not None:
+    register_codec(OrjsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+class Compressor(object):
+
+    # Compresses encoded messages, whatever their codec. Compressed messages
+    # start with the compressor's marker, in the same form as codec markers,
+    # and are decompressed by decode_frames before their codec is looked at.
+    # Attachments aren't compressed. max_size limits how big a message can
+    # decompress to.
+
+    name = None
+    marker = None
+    max_size = 1 << 30  # bytes
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        """Should raise ValueError if data can't be decompressed, or would
+        be bigger than max_size."""
+        raise NotImplementedError()
+
+    def compress_message(self, data):
+        return self.marker + self.compress(data)
+
+    def decompress_message(self, data):
+        return self.decompress(memoryview(data)[len(self.marker):])
+
+
+class ZlibCompressor(Compressor):
+
+    name = 'zlib'
+    marker = CODEC_MARKER_PREFIX + b'Z'
+    level = 6
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj()
+        try:
+            out = decompressor.decompress(bytes(data), self.max_size)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Message too big when decompressed")
+        return out
+
+
+compressors = {}
+compressors_by_marker = {}
+
+
+def register_compressor(compressor):
+    if len(compressor.marker) != 2 or \
+            compressor.marker[:1] != CODEC_MARKER_PREFIX or \
+            compressor.marker in codecs_by_marker:
+        raise ValueError("Compressor markers must be a null byte and one "
+                         "other, not used by a codec")
+    compressors[compressor.name] = compressor
+    compressors_by_marker[compressor.marker] = compressor
+
+
+def get_compressor(compressor):
+    """Return the registered compressor with the given name, or compressor
+    if it's already a Compressor."""
+    if isinstance(compressor, Compressor):
+        return compressor
+    try:
+        return compressors[compressor]
+    except KeyError:
+        raise ValueError("Unknown compressor {0!r}".format(compressor))
+
+
+register_compressor(ZlibCompressor())
+
+
+def compress_frames(frames, compressor, threshold):
+    """Compress the message in frames if it's at least threshold bytes, and
+    compressing makes it smaller."""
+    body = frames[0]
+    if compressor is None or len(body) < threshold:
+        return frames
+    compressed = compressor.compress_message(body)
+    if len(compressed) >= len(body):
+        return frames
+    return [compressed] + frames[1:]
+
+
+def reply_compressor(compressor, req):
+    """The compressor to reply to req with: compressor, if the client
+    accepts it."""
+    if compressor is None:
+        return None
+    if isinstance(req, list):
+        req = req[0] if req else None
+    accepted = getattr(req, 'accept_compression', None)
+    if isinstance(accepted, list) and compressor.name in accepted:
+        return compressor
+    return None
 
 
 _GenerateID = object()
 
 
+class IDGenerator(object):
+
+    # Request ids unique to this process: a random prefix, then a counter.
+    # Much cheaper than a uuid4 per request. Forked children get a new
+    # prefix, so they don't repeat their parent's ids.
+
+    check_pid = not hasattr(os, 'register_at_fork')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.prefix = uuid.uuid4().hex[:16]
+        self.counter = itertools.count(1)
+
+    def __call__(self):
+        if self.check_pid and self.pid != os.getpid():
+            self.reset()
+        return '%s-%x' % (self.prefix, next(self.counter))
+
+
+generate_id = IDGenerator()
+if not IDGenerator.check_pid:
+    os.register_at_fork(after_in_child=generate_id.reset)
+
+
+# Streamed results. A request with a "stream" member, the number of chunks
+# the client is ready to buffer, may have its result sent as a series of
+# responses with the same id, each with a list of items as its result and
+# "stream": "more", until the last with "stream": "end". The client grants
+# credit for more chunks as it consumes them, with STREAM_CREDIT_METHOD
+# notifications, and can stop the stream early with STREAM_CANCEL_METHOD.
+STREAM_MORE = 'more'
+STREAM_END = 'end'
+STREAM_CREDIT_METHOD = 'rpc.stream.credit'
+STREAM_CANCEL_METHOD = 'rpc.stream.cancel'
+
+# Returns a server's metrics, if it's chosen to expose them
+STATS_METHOD = 'rpc.stats'
+
+
 class Request(object):
 
-    def __init__(self, method, params, id_=_GenerateID, notify=False):
+    # idempotent marks a request that may be sent again, with the same id,
+    # if no response comes (see RPCServer.enable_idempotent_retries).
+    # deadline is when the caller will give up waiting for a response, in
+    # seconds since the epoch. accept_compression lists the names of the
+    # compressors the response may be compressed with.
+
+    __slots__ = ('method', 'params', 'id', 'stream', 'idempotent', 'deadline',
+                 'accept_compression')
+
+    def __init__(self, method, params, id_=_GenerateID, notify=False,
+                 stream=None, idempotent=False, deadline=None,
+                 accept_compression=None):
         self.method = method
         self.params = params
+        self.stream = stream
+        self.idempotent = idempotent
+        self.deadline = deadline
+        self.accept_compression = accept_compression
         if notify:
             self.id = None
-        elif id_ == _GenerateID:
-            self.id = str(uuid.uuid4())
+        elif id_ is _GenerateID:
+            self.id = generate_id()
         else:
             self.id = id_
 
@@ -96,13 +515,28 @@ class Request(object):
         return self.id is None
 
     def to_dict(self):
-        data = dict(jsonrpc=JSON_RPC_VERSION,
-                    method=self.method,
-                    params=self.params)
-        if self.id:
+        data = {'jsonrpc': JSON_RPC_VERSION, 'method': self.method,
+                'params': self.params}
+        if self.id is not None:
             data['id'] = self.id
+        if self.stream:
+            data['stream'] = self.stream
+        if self.idempotent:
+            data['idempotent'] = True
+        if self.deadline is not None:
+            data['deadline'] = self.deadline
+        if self.accept_compression:
+            data['accept_compression'] = self.accept_compression
         return data
 
+    def time_remaining(self):
+        """Seconds until the deadline, or None if there isn't a (valid) one.
+        """
+        if not isinstance(self.deadline, (int, float)) or \
+                isinstance(self.deadline, bool):
+            return None
+        return self.deadline - time.time()
+
     @property
     def method_normalised(self):
         return self.method.lower().replace('-', '_')
@@ -110,6 +544,8 @@ class Request(object):
 
 class Notification(Request):
 
+    __slots__ = ()
+
     def __init__(self, method, params):
         super(Notification, self).__init__(method, params, id_=None)
 
@@ -130,31 +566,165 @@ class RequestMethod(object):
 
 
 def handle_request(handler_obj, handler_attr_format, request):
-    handler_name = handler_attr_format.format(method=request.method_normalised)
-    try:
-        handler = handler_obj.__getattribute__(handler_name)
-    except AttributeError:
-        raise MethodNotFound()
+    return dispatch_table(handler_obj, handler_attr_format).call(request)
 
+
+def dispatch_table(handler_obj, handler_attr_format):
+    # Built on first use and kept on the object. Not going through getattr,
+    # as clients answer any attribute with a RequestMethod.
+    tables = handler_obj.__dict__.setdefault('_dispatch_tables', {})
     try:
-        if isinstance(request.params, (tuple, list)):
-            result = handler(*request.params)
-        elif isinstance(request.params, dict):
-            result = handler(**request.params)
-        else:
-            raise InternalError('Parameters supplied as unexpected type')
-    except TypeError as e:
-        raise InvalidParams(str(e))
+        return tables[handler_attr_format]
+    except KeyError:
+        table = tables[handler_attr_format] = DispatchTable(
+            handler_obj, handler_attr_format)
+        return table
+
+
+class DispatchTable(object):
+
+    # Maps method names to an object's handler methods, found by name with
+    # handler_attr_format (e.g. "handle_{method}_method"), along with what
+    # parameters each handler takes. Handlers must exist by the time the
+    # first request is dispatched.
+
+    def __init__(self, handler_obj, handler_attr_format):
+        prefix, suffix = handler_attr_format.split('{method}')
+        self.handlers = {}
+        for name in dir(handler_obj):
+            if not (name.startswith(prefix) and name.endswith(suffix)) or \
+                    len(name) <= len(prefix) + len(suffix):
+                continue
+            handler = getattr(handler_obj, name)
+            if callable(handler):
+                method = name[len(prefix):len(name) - len(suffix)]
+                self.handlers[method] = (handler,
+                                         HandlerSignature.for_handler(handler))
+
+    def lookup(self, method):
+        try:
+            return self.handlers[method]
+        except (KeyError, TypeError):
+            pass
+        try:
+            return self.handlers[method.lower().replace('-', '_')]
+        except (KeyError, AttributeError):
+            raise MethodNotFound()
+
+    def call(self, request):
+        handler, signature = self.lookup(request.method)
+        params = request.params
+
+        if signature is None:
+            # Can't check parameters first; fall back to guessing from
+            # the error.
+            try:
+                if isinstance(params, (tuple, list)):
+                    return handler(*params)
+                elif isinstance(params, dict):
+                    return handler(**params)
+            except TypeError as e:
+                raise InvalidParams(str(e))
+        elif isinstance(params, (tuple, list)):
+            signature.check_args(params)
+            return handler(*params)
+        elif isinstance(params, dict):
+            signature.check_kwargs(params)
+            return handler(**params)
+
+        raise InternalError('Parameters supplied as unexpected type')
+
+
+class HandlerSignature(object):
+
+    # The parameters a handler accepts, worked out once so that requests can
+    # be checked against them before the handler is called.
+
+    _cache = {}
+
+    def __init__(self, signature):
+        self.min_args = self.max_args = 0
+        self.var_args = self.var_kwargs = False
+        self.named = set()
+        self.required_named = set()
+        # Required parameters that can't be supplied one way or the other
+        self.requires_named = self.requires_positional = False
+
+        for param in signature.parameters.values():
+            required = param.default is param.empty
+            if param.kind in (param.POSITIONAL_ONLY,
+                              param.POSITIONAL_OR_KEYWORD):
+                self.max_args += 1
+                if required:
+                    self.min_args += 1
+            if param.kind in (param.POSITIONAL_OR_KEYWORD,
+                              param.KEYWORD_ONLY):
+                self.named.add(param.name)
+                if required:
+                    self.required_named.add(param.name)
+            if required and param.kind == param.KEYWORD_ONLY:
+                self.requires_named = True
+            if required and param.kind == param.POSITIONAL_ONLY:
+                self.requires_positional = True
+            if param.kind == param.VAR_POSITIONAL:
+                self.var_args = True
+            if param.kind == param.VAR_KEYWORD:
+                self.var_kwargs = True
+
+    @classmethod
+    def for_handler(cls, handler):
+        func = getattr(handler, '__func__', handler)
+        try:
+            return cls._cache[func]
+        except KeyError:
+            pass
+        except TypeError:
+            func = None  # Unhashable
+
+        try:
+            out = cls(inspect.signature(handler))
+        except (AttributeError, ValueError, TypeError):
+            out = None  # Python 2, or can't be inspected
+        if func is not None:
+            cls._cache[func] = out
+        return out
 
-    return result
+    def check_args(self, args):
+        if self.requires_named:
+            raise InvalidParams("Parameters must be given by name")
+        if len(args) < self.min_args or \
+                (len(args) > self.max_args and not self.var_args):
+            raise InvalidParams(
+                "Expected {0}{1} positional parameters, got {2}".format(
+                    self.min_args,
+                    "+" if self.var_args else
+                    ("-" + str(self.max_args)
+                     if self.max_args != self.min_args else ""),
+                    len(args)))
+
+    def check_kwargs(self, kwargs):
+        if self.requires_positional:
+            raise InvalidParams("Parameters must be given by position")
+        missing = self.required_named.difference(kwargs)
+        if missing:
+            raise InvalidParams("Missing parameters: " +
+                                ", ".join(sorted(missing)))
+        if not self.var_kwargs:
+            unexpected = set(kwargs).difference(self.named)
+            if unexpected:
+                raise InvalidParams("Unexpected parameters: " +
+                                    ", ".join(sorted(unexpected)))
 
 
 class Response(object):
 
-    def __init__(self, result, error, id_):
+    __slots__ = ('result', 'error', 'id', 'stream')
+
+    def __init__(self, result, error, id_, stream=None):
         self.result = result
         self.error = error
         self.id = id_
+        self.stream = stream
 
     @property
     def is_error(self):
@@ -166,12 +736,17 @@ class Response(object):
         return cls(self.error['message'], self.error.get('data', None))
 
     def to_dict(self):
-        data = dict(jsonrpc=JSON_RPC_VERSION,
-                    result=self.result,
-                    error=self.error,
-                    id=self.id)
-        return {k: v for k, v in list(data.items()) if k == 'result' or
-                v is not None}
+        # The spec requires a null id when it couldn't be read from the
+        # request, and only one of result and error.
+        if self.error is None:
+            data = {'jsonrpc': JSON_RPC_VERSION, 'result': self.result,
+                    'id': self.id}
+        else:
+            data = {'jsonrpc': JSON_RPC_VERSION, 'error': self.error,
+                    'id': self.id}
+        if self.stream is not None:
+            data['stream'] = self.stream
+        return data
 
 
 class RPCErrorMeta(type):
@@ -240,6 +815,17 @@ class ServerError(RPCError):
     pass
 
 
+class ServerOverloaded(ServerError):
+    # The request wasn't handled, so can safely be tried again, perhaps
+    # elsewhere
+    error_code = -32001
+
+
+class DeadlineExceeded(ServerError):
+    # The request wasn't handled, as its caller had already given up
+    error_code = -32002
+
+
 class ApplicationError(RPCError):
     pass
 
@@ -259,16 +845,84 @@ def rpc_exception_class_for_code(code, extra_code_mapping=None):
         return ApplicationError
 
 
+class Trace(object):
+
+    # Timestamps, from time.time(), of the stages a message went through,
+    # in the order they happened. Servers mark "recv", "parse", "dispatch",
+    # "handler", "serialize" and "send", plus "queue" after "recv" when the
+    # message waited to be handled after being read off the socket (see
+    # ThreadPoolRPCServer); clients mark "request", "serialize", "send",
+    # "recv" and "parse". Stages can appear more than once, e.g. "dispatch"
+    # and "handler" for each call in a batch.
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.method = None
+        self.id = None
+        self.error_code = None
+        self.stages = []
+
+    def mark(self, stage, at=None):
+        self.stages.append((stage, time.time() if at is None else at))
+
+    @property
+    def start(self):
+        return self.stages[0][1]
+
+    @property
+    def duration(self):
+        return self.stages[-1][1] - self.stages[0][1]
+
+    def durations(self):
+        """Time taken to reach each stage from the one before it."""
+        return [(stage, t - prev_t) for (stage, t), (_, prev_t)
+                in zip(self.stages[1:], self.stages)]
+
+
+class NullTrace(Trace):
+
+    # Stands in for a Trace when there are no hooks to report to. There's
+    # one, shared by every thread, so whatever's set on it is ignored.
+
+    endpoint = method = id = error_code = None
+    stages = ()
+
+    def __init__(self):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+    def mark(self, stage, at=None):
+        pass
+
+
+null_trace = NullTrace()
+
+
 class Endpoint(object):
 
+    # With a compression (a Compressor, or its name), clients tell servers
+    # they accept responses compressed with it, and servers compress their
+    # responses with it for clients that do. Only messages of at least
+    # compression_threshold bytes are compressed. Clients compress their own
+    # requests too if compress_requests is set, but only should if the
+    # server is known to have the compressor, as others can't read them.
+    # Compressed messages are always decompressed.
+
     default_socket_type = None
     error_code_exceptions = None
     logger = None
+    trace_hooks = ()
+    codec = json_codec
+    compression = None
+    compression_threshold = 1024  # bytes
+    compress_requests = False
 
     socket = None
 
     def __init__(self, endpoint, socket_type, timeout, context=None,
-                 logger=None):
+                 logger=None, codec=None, compression=None):
         super(Endpoint, self).__init__()
         self.endpoint = endpoint
 
@@ -282,6 +936,55 @@ class Endpoint(object):
         self.timeout = timeout
         self.context = context or zmq.Context.instance()
         self.logger = logger if logger else package_logger
+        if codec is not None:
+            self.codec = get_codec(codec)
+        if compression is not None:
+            self.compression = get_compressor(compression)
+
+    def _encode(self, o, codec=None, compressor=None):
+        """Encode a message as a list of frames, including any attachments,
+        compressing it with compressor if it's big enough."""
+        attachments = []
+        if isinstance(o, (Request, Response)):
+            # Saves the codec a trip through its default hook
+            o = o.to_dict()
+        frames = [(codec or self.codec).dumps(o, attachments)] + attachments
+        if compressor is not None:
+            frames = compress_frames(frames, compressor,
+                                     self.compression_threshold)
+        return frames
+
+    def _encode_request(self, request):
+        """Encode a request, or a batch of them, to send to a server."""
+        if self.compression is not None:
+            for r in (request if isinstance(request, list) else [request]):
+                if r.id is not None:
+                    r.accept_compression = [self.compression.name]
+        return self._encode(request, compressor=self.compression
+                            if self.compress_requests else None)
+
+    def _decode(self, frames):
+        return decode_frames(frames, self.codec)[0]
+
+    def add_trace_hook(self, hook):
+        """Call hook with a Trace after each message is handled."""
+        self.trace_hooks = list(self.trace_hooks) + [hook]
+
+    def _start_trace(self, stage, at=None):
+        if not self.trace_hooks:
+            return null_trace
+        trace = Trace(self.endpoint)
+        trace.mark(stage, at)
+        return trace
+
+    def _finish_trace(self, trace):
+        if trace is null_trace:
+            return
+        for hook in self.trace_hooks:
+            try:
+                hook(trace)
+            except Exception:
+                self.logger.exception("Exception in trace hook %r", hook)
 
     def close(self):
         self.socket.close()
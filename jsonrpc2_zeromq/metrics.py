@@ -0,0 +1,154 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# Aggregate statistics about a server's calls, collected from its traces.
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+
+import bisect
+import threading
+import time
+
+
+class Histogram(object):
+
+    # Counts of values (in seconds) falling in exponentially growing
+    # buckets, from a microsecond to a couple of minutes, so memory use is
+    # fixed however many values there are. Percentiles are the upper bound
+    # of the bucket they fall in, so are overestimated by up to double.
+
+    bounds = [1e-6 * 2 ** i for i in range(28)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            count=self.count, sum=self.total, max=self.max,
+            p50=self.percentile(0.5), p90=self.percentile(0.9),
+            p99=self.percentile(0.99), p999=self.percentile(0.999),
+            buckets=[[self.bounds[i] if i < len(self.bounds) else None,
+                      count]
+                     for i, count in enumerate(self.counts) if count])
+
+
+class MethodStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return dict(calls=self.calls, errors=dict(self.errors),
+                    latency=self.latency.to_dict())
+
+
+class ServerMetrics(object):
+
+    # A trace hook (see RPCServer.enable_metrics) keeping, per method, the
+    # number of calls, errors by code and a latency histogram, plus a
+    # histogram of the time spent in each stage of handling: "queue"
+    # (waiting for a handler after being read off the socket, where
+    # there's a queue), "parse", "dispatch" (after parsing), "handler",
+    # "serialize" and "send".
+    #
+    # Gauges added with add_gauge, such as the server's queue length, are
+    # read when a snapshot is taken.
+    #
+    # Method names come from clients, so only the first max_methods are
+    # counted separately, to bound memory; the rest are counted together
+    # as other_method. Batches and unreadable messages have no method, and
+    # are counted as no_method.
+
+    max_methods = 1000
+    other_method = '(other)'
+    no_method = '(none)'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.reset()
+
+    def add_gauge(self, name, gauge):
+        """Include gauge(), a number, in snapshots as name."""
+        self.gauges[name] = gauge
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.calls = 0
+            self.errors = {}
+            self.methods = {}
+            self.stages = {}
+
+    def __call__(self, trace):
+        method = trace.method if trace.method is not None \
+            else self.no_method
+        durations = trace.durations()
+        latency = trace.duration if trace.stages else 0.0
+        error_code = None if trace.error_code is None \
+            else str(trace.error_code)
+
+        with self.lock:
+            self.calls += 1
+            stats = self.methods.get(method)
+            if stats is None:
+                if len(self.methods) >= self.max_methods:
+                    method = self.other_method
+                stats = self.methods.setdefault(method, MethodStats())
+            stats.calls += 1
+            stats.latency.observe(latency)
+            if error_code is not None:
+                stats.errors[error_code] = stats.errors.get(error_code, 0) + 1
+                self.errors[error_code] = self.errors.get(error_code, 0) + 1
+            for stage, duration in durations:
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = Histogram()
+                histogram.observe(duration)
+
+    def snapshot(self):
+        """Return the metrics so far as plain data, ready to be serialized.
+        Error codes are given as strings, so they can be JSON keys."""
+        gauges = dict((name, gauge())
+                      for name, gauge in list(self.gauges.items()))
+        with self.lock:
+            return dict(
+                gauges=gauges,
+                uptime=time.time() - self.started,
+                calls=self.calls,
+                errors=dict(self.errors),
+                methods=dict((method, stats.to_dict())
+                             for method, stats in self.methods.items()),
+                stages=dict((stage, histogram.to_dict())
+                            for stage, histogram in self.stages.items()))
@@ -11,12 +11,24 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import *  # NOQA
 
+import collections
+import inspect
+import itertools
+import logging
 import threading
+import time
+import multiprocessing
+import struct
+import tempfile
+import shutil
 import errno
 
 import zmq
 
 from . import common
+from .admission import AdmissionControl
+from .cache import cache_key, ResponseCache, RecentRequests
+from .metrics import ServerMetrics
 
 
 def response_from_exception(e, id_=None):
@@ -27,24 +39,141 @@ def response_from_exception(e, id_=None):
 
 class RPCServer(common.Endpoint, threading.Thread):
 
+    # handle_{method}_method handlers can be generators. Their items are
+    # streamed, stream_chunk_size at a time, to clients that asked for a
+    # stream (see common.STREAM_MORE), when the server's socket can send more
+    # than one reply and stream_results is set; otherwise they're returned as
+    # a list.
+    #
+    # Handlers decorated with cache.cacheable have their results cached by
+    # params, and sent again without calling or re-encoding them. Cached
+    # results aren't streamed.
+    #
+    # Requests whose caller has given up by the time they're dispatched,
+    # judging by their deadline, are answered with DeadlineExceeded without
+    # being handled (unless drop_expired is unset). deadline_grace allows for
+    # clients' clocks being behind. Handlers can call time_remaining() to
+    # see how long their caller will wait.
+    #
+    # With enable_admission_control(), requests beyond the server's limits
+    # are answered with ServerOverloaded straight away. Servers with ROUTER
+    # or DEALER sockets read in everything waiting for them, so they know how
+    # many requests are queued; REP servers can only see one at a time, so
+    # can't have admission control. Method limits only mean something where
+    # handlers run concurrently (see concurrent_handlers).
+
     default_socket_type = zmq.REP
     allow_methods = True
     allow_notifications = False
+    stream_chunk_size = 100  # items
+    max_stream_window = 64  # chunks
+    stream_idle_timeout = 60  # seconds without credit before giving up
+    stream_results = True
+
+    # Methods the server handles itself, whatever allow_notifications says
+    reserved_methods = {
+        common.STREAM_CREDIT_METHOD: '_handle_stream_credit',
+        common.STREAM_CANCEL_METHOD: '_handle_stream_cancel',
+        common.STATS_METHOD: '_handle_stats',
+    }
 
+    metrics = None
+    expose_metrics = False
+    recent_requests = None
+    admission = None
+    drop_expired = True
+    deadline_grace = 0.0  # seconds
+    concurrent_handlers = False
     should_stop = False
 
     def __init__(self, endpoint, context=None, timeout=1000, socket_type=None,
-                 logger=None):
+                 logger=None, codec=None, compression=None):
         super(RPCServer, self).__init__(endpoint, socket_type, timeout,
-                                        context, logger=logger)
+                                        context, logger=logger, codec=codec,
+                                        compression=compression)
         self.socket = self.context.socket(self.socket_type)
         self.socket.bind(self.endpoint)
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
+        # Per-message state: the reply socket of worker threads (see
+        # ThreadPoolRPCServer), plus the trace and codec of the message being
+        # handled.
+        self._thread_state = threading.local()
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        self.response_caches = {}
+        self.response_caches_lock = threading.Lock()
+        self.admitted = collections.deque()
 
     def stop(self):
         self.should_stop = True
 
+    def enable_metrics(self, metrics=None, expose=False):
+        """Collect metrics.ServerMetrics (or the given metrics) about calls
+        from now on, and return them. If expose is set, clients can read them
+        with the rpc.stats method."""
+        self.metrics = metrics or ServerMetrics()
+        self.expose_metrics = expose
+        self.add_trace_hook(self.metrics)
+        for name, gauge in self._gauges().items():
+            self.metrics.add_gauge(name, gauge)
+        return self.metrics
+
+    def _gauges(self):
+        # Requests read off the socket but not yet handled
+        return dict(queued=lambda: len(self.admitted))
+
+    def enable_idempotent_retries(self, window=60, max_size=10000):
+        """Remember responses to requests marked idempotent, for window
+        seconds, so that retries of them (with the same id) are answered
+        without handling them again. A retry arriving while the first attempt
+        is still being handled gets its response when it's done."""
+        self.recent_requests = RecentRequests(window, max_size)
+        return self.recent_requests
+
+    def enable_admission_control(self, max_pending=None, method_limits=None):
+        """Limit the requests queued or being handled to max_pending, and
+        the calls of methods being handled at once to their limits in
+        method_limits, answering any more with ServerOverloaded without
+        handling them. Call before starting the server. Returns the
+        admission.AdmissionControl, whose stats() include the numbers pending
+        and shed.
+
+        Raises ValueError for a REP server, which only sees one request at a
+        time, or for method_limits on a server that only handles one at a
+        time, as neither limit could ever apply."""
+        if self.socket_type == zmq.REP:
+            raise ValueError("Admission control needs a ROUTER or DEALER "
+                             "socket; a REP server only sees one request at "
+                             "a time")
+        if method_limits and not self.concurrent_handlers:
+            raise ValueError("Method limits need a server whose handlers "
+                             "run concurrently, such as ThreadPoolRPCServer")
+        self.admission = AdmissionControl(max_pending, method_limits)
+        return self.admission
+
+    def time_remaining(self):
+        """Seconds until the caller of the request being handled gives up
+        waiting for its response, or None if it didn't say."""
+        req = getattr(self._thread_state, 'request', None)
+        return req.time_remaining() if req is not None else None
+
+    def _expired(self, req):
+        if not self.drop_expired:
+            return False
+        remaining = req.time_remaining()
+        return remaining is not None and remaining < -self.deadline_grace
+
+    def _answered(self, req):
+        # A retry that can be answered from the first attempt's response
+        # costs nothing, and its caller may still be waiting for it
+        return bool(req.idempotent) and self.recent_requests is not None \
+            and self.recent_requests.response(req.id) is not None
+
+    def admission_stats(self):
+        return self.admission.stats() if self.admission is not None \
+            else None
+
     def run(self):
         self.logger.info("^_^ Server now listening on %s", self.endpoint)
         while not self.should_stop:
@@ -56,40 +185,115 @@ class RPCServer(common.Endpoint, threading.Thread):
                 else:
                     raise
 
-    # TODO: decrease complexity
     def _handle_one_message(self):
-        req = client_id = None
+        timeout = 0 if self._streams_ready() or self.admitted \
+            else self.timeout
+        if self.poller.poll(timeout):
+            self._recv_messages()
+        if self.admitted:
+            self._handle_message_parts(*self.admitted.popleft())
+        self._pump_streams()
 
-        if not self.poller.poll(self.timeout):
+    def _recv_messages(self):
+        if self.admission is None:
+            self._handle_message_parts(self.socket.recv_multipart(copy=False))
             return
+        # Read in whatever's waiting, to know how much there is
+        flags = 0 if self.socket_type == zmq.REP else zmq.NOBLOCK
+        while True:
+            try:
+                req_parts = self.socket.recv_multipart(flags, copy=False)
+            except zmq.Again:
+                return
+            self._admit(req_parts)
+            if self.socket_type == zmq.REP:
+                return
+
+    def _admit(self, req_parts):
+        # Queued along with when it was received, to time how long it waits
+        if self.admission is None or self.admission.admit():
+            self.admitted.append((req_parts, time.time()))
+        else:
+            self._shed(req_parts)
 
-        req_parts = self.socket.recv_multipart()
+    def _shed(self, req_parts):
+        # Answer with ServerOverloaded, without handling the request
+        client_id = None
+        if self.socket_type in (zmq.ROUTER, zmq.DEALER):
+            client_id = common.frame_bytes(req_parts[0])
+            req_parts = req_parts[1:]
         try:
-            if len(req_parts) > 1:
-                client_id, req = req_parts[0], req_parts[1:]
-                req = b''.join(req)
-            else:
-                req = req_parts[0]
+            req, codec = common.decode_frames(req_parts, self.codec)
+        except ValueError:
+            req, codec = None, self.codec
+        if isinstance(req, common.Request) and req.is_notification:
+            return
+        id_ = req.id if isinstance(req, common.Request) else None
+        frames = self._encode(
+            common.ServerOverloaded("Server overloaded").to_response(id_),
+            codec)
+        self._send_multipart([client_id] + frames if client_id else frames)
+
+    # TODO: decrease complexity
+    def _handle_message_parts(self, req_parts, received=None):
+        # received is when the message was read off the server's socket, if
+        # it's been waiting since
+        req = client_id = None
+        trace = self._thread_state.trace = self._start_trace('recv', received)
+        if received is not None:
+            trace.mark('queue')
+        self._thread_state.codec = None
+        self._thread_state.compressor = None
+
+        try:
+            if self.socket_type in (zmq.ROUTER, zmq.DEALER):
+                client_id = common.frame_bytes(req_parts[0])
+                req_parts = req_parts[1:]
+            self._thread_state.client_id = client_id
 
             try:
-                req = common.json_rpc_loads(req)
+                req, codec = common.decode_frames(req_parts, self.codec)
             except ValueError:
                 raise common.ParseError()
+            # Reply in whichever codec the request came in, compressed if
+            # the client accepts it
+            self._thread_state.codec = codec
+            self._thread_state.compressor = common.reply_compressor(
+                self.compression, req)
+            trace.mark('parse')
+
+            if isinstance(req, list):
+                self._handle_batch(client_id, req)
+                return
 
             if not isinstance(req, common.Request):
                 raise common.InvalidRequest()
 
-            self.logger.debug("<_< Server received {req_type} \"{method}\""
-                              " on {endpoint} with params:\n{params}".format(
-                                  req_type=("method call" if req.id
-                                            else "notification"),
-                                  method=req.method, endpoint=self.endpoint,
-                                  params=common.debug_log_object_dump(
-                                      req.params)))
+            trace.method = req.method
+            trace.id = req.id
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    "<_< Server received {req_type} \"{method}\" on "
+                    "{endpoint} with params:\n{params}".format(
+                        req_type=("method call" if req.id
+                                  else "notification"),
+                        method=req.method, endpoint=self.endpoint,
+                        params=common.debug_log_object_dump(req.params)))
+
+            self._thread_state.request = req
+            if self._is_reserved(req):
+                self._handle_reserved(req)
 
-            if (req.is_method and self.allow_methods) or \
+            elif self._expired(req) and not self._answered(req):
+                raise common.DeadlineExceeded()
+
+            elif (req.is_method and self.allow_methods) or \
                     (req.is_notification and self.allow_notifications):
-                self._handle_method_and_response(client_id, req)
+                if self.admission is None:
+                    self._handle_method_and_response(client_id, req)
+                else:
+                    with self.admission.method_slot(req.method):
+                        self._handle_method_and_response(client_id, req)
 
             elif req.is_method and not self.allow_methods and \
                     self.socket.socket_type in (zmq.REP, zmq.ROUTER):
@@ -100,6 +304,8 @@ class RPCServer(common.Endpoint, threading.Thread):
             # forbids it.
 
         except Exception as e:
+            if not isinstance(req, common.Request):
+                req = None
             req_id = req.id if req else None
             self._send_response(client_id, req,
                                 response_from_exception(e, req_id))
@@ -107,30 +313,386 @@ class RPCServer(common.Endpoint, threading.Thread):
                 self.logger.exception("Exception handling message in %s",
                                       self.__class__.__name__)
 
-    def _handle_method_and_response(self, client_id, req):
+        finally:
+            self._thread_state.trace = common.null_trace
+            self._thread_state.codec = None
+            self._thread_state.compressor = None
+            self._thread_state.client_id = None
+            self._thread_state.request = None
+            if self.admission is not None:
+                self.admission.release()
+            self._finish_trace(trace)
+
+    def _current_trace(self):
+        return getattr(self._thread_state, 'trace', common.null_trace)
+
+    def _handle_method(self, req):
+        trace = self._current_trace()
+        trace.mark('dispatch')
         result = common.handle_request(self, 'handle_{method}_method', req)
+        trace.mark('handler')
+        return result
+
+    def _handle_method_and_response(self, client_id, req):
+        if req.idempotent and req.is_method and not req.stream and \
+                self.recent_requests is not None:
+            self._handle_idempotent(client_id, req)
+            return
+
+        cache = self._response_cache(req.method) if req.is_method else None
+        if cache is not None:
+            self._handle_cacheable(client_id, req, cache)
+            return
+
+        result = self._handle_method(req)
+        if inspect.isgenerator(result):
+            if req.stream and req.is_method and client_id is not None and \
+                    self.stream_results:
+                self._start_stream(client_id, req, result)
+                return
+            result = list(result)
         self._send_response(client_id, req, common.Response(result, None,
                                                             req.id))
 
+    def _handle_idempotent(self, client_id, req):
+        resp = self.recent_requests.start(req.id, client_id)
+        if resp is RecentRequests.IN_PROGRESS:
+            return  # Sent when the first attempt finishes
+        if resp is not None:
+            self._send_response(client_id, req, resp)
+            return
+
+        try:
+            result = self._handle_method(req)
+            if inspect.isgenerator(result):
+                result = list(result)
+            resp = common.Response(result, None, req.id)
+        except Exception as e:
+            resp = response_from_exception(e, req.id)
+            if not isinstance(e, common.RPCError):
+                self.logger.exception("Exception handling message in %s",
+                                      self.__class__.__name__)
+        for waiting_id in [client_id] + self.recent_requests.finish(req.id,
+                                                                    resp):
+            self._send_response(waiting_id, req, resp)
+
+    def _response_cache(self, method):
+        # The cache for method's handler, if it's cacheable
+        try:
+            handler, signature = common.dispatch_table(
+                self, 'handle_{method}_method').lookup(method)
+        except common.MethodNotFound:
+            return None
+        options = getattr(handler, 'cache_options', None)
+        if options is None:
+            return None
+        name = handler.__name__
+        with self.response_caches_lock:
+            cache = self.response_caches.get(name)
+            if cache is None:
+                cache = self.response_caches[name] = ResponseCache(*options)
+        return cache
+
+    def _handle_cacheable(self, client_id, req, cache):
+        key = cache_key(req.params)
+        entry = cache.get(key) if key is not None else None
+        if entry is None:
+            result = self._handle_method(req)
+            if inspect.isgenerator(result):
+                result = list(result)
+            if key is None:
+                self._send_response(client_id, req,
+                                    common.Response(result, None, req.id))
+                return
+            entry = cache.put(key, result)
+        self._send_cached(client_id, req, entry)
+
+    def _send_cached(self, client_id, req, entry):
+        codec = getattr(self._thread_state, 'codec', None) or self.codec
+        encoded = entry.encoded.get(codec.name)
+        if encoded is None:
+            attachments = []
+            body = codec.dumps_result(entry.result, attachments)
+            if body is None:
+                # The codec can't reuse encoded results
+                self._send_response(client_id, req, common.Response(
+                    entry.result, None, req.id))
+                return
+            encoded = entry.encoded[codec.name] = (body, attachments)
+
+        trace = self._current_trace()
+        body, attachments = encoded
+        frames = common.compress_frames(
+            [codec.dumps_response(body, req.id)] + attachments,
+            getattr(self._thread_state, 'compressor', None),
+            self.compression_threshold)
+        trace.mark('serialize')
+        self._send_multipart([client_id] + frames if client_id else frames)
+        trace.mark('send')
+
+    def invalidate_cache(self, method, params=None):
+        """Drop the cached results of method (as it's called by clients),
+        or just the one for params if given."""
+        cache = self._response_cache(method)
+        if cache is None:
+            return
+        if params is None:
+            cache.invalidate()
+        else:
+            key = cache_key(params)
+            if key is not None:
+                cache.invalidate(key)
+
+    def cache_stats(self):
+        """Sizes and hit, miss and eviction counts of response caches, by
+        handler name."""
+        with self.response_caches_lock:
+            caches = list(self.response_caches.items())
+        return dict((name, cache.stats()) for name, cache in caches)
+
+    def _is_reserved(self, req):
+        try:
+            return req.method in self.reserved_methods
+        except TypeError:
+            return False  # Unhashable, so not a valid method name anyway
+
+    def _handle_reserved(self, req):
+        params = req.params if isinstance(req.params, list) else []
+        try:
+            result = getattr(self, self.reserved_methods[req.method])(*params)
+        except TypeError as e:
+            raise common.InvalidParams(str(e))
+        if req.is_method:
+            self._send_response(self._thread_state.client_id, req,
+                                common.Response(result, None, req.id))
+
+    def _handle_stats(self):
+        if self.metrics is None or not self.expose_metrics:
+            raise common.MethodNotFound()
+        snapshot = self.metrics.snapshot()
+        if self.admission is not None:
+            snapshot['admission'] = self.admission.stats()
+        return snapshot
+
+    def _start_stream(self, client_id, req, generator):
+        try:
+            window = max(1, min(int(req.stream), self.max_stream_window))
+        except (TypeError, ValueError):
+            window = 1
+        stream = ServerStream(client_id, req.id, generator,
+                              self._thread_state.codec,
+                              self._thread_state.compressor, window)
+        with self.streams_lock:
+            self.streams[(client_id, req.id)] = stream
+        self._pump_stream(stream)
+
+    def _find_stream(self, id_):
+        with self.streams_lock:
+            return self.streams.get((self._thread_state.client_id, id_))
+
+    def _handle_stream_credit(self, id_, credit):
+        stream = self._find_stream(id_)
+        if stream is not None:
+            with stream.lock:
+                stream.credit += int(credit)
+                stream.last_active = time.time()
+
+    def _handle_stream_cancel(self, id_):
+        stream = self._find_stream(id_)
+        if stream is not None:
+            with stream.lock:
+                self._end_stream(stream)
+
+    def _streams_ready(self):
+        if not self.streams:
+            return False
+        with self.streams_lock:
+            return any(stream.credit > 0 and not stream.lock.locked()
+                       for stream in self.streams.values())
+
+    def _pump_streams(self):
+        # Send a chunk of each stream with credit. Streams that have gone
+        # without credit for too long have probably lost their client.
+        if not self.streams:
+            return
+        with self.streams_lock:
+            streams = list(self.streams.values())
+        now = time.time()
+        for stream in streams:
+            if stream.credit > 0:
+                self._pump_stream(stream)
+            elif now - stream.last_active > self.stream_idle_timeout and \
+                    stream.lock.acquire(False):
+                try:
+                    self.logger.warning("v_v Server dropping idle stream %s "
+                                        "on %s", stream.id, self.endpoint)
+                    self._end_stream(stream)
+                finally:
+                    stream.lock.release()
+
+    def _pump_stream(self, stream):
+        # Another thread may be producing this stream's next chunk already
+        if not stream.lock.acquire(False):
+            return
+        codec = getattr(self._thread_state, 'codec', None)
+        compressor = getattr(self._thread_state, 'compressor', None)
+        try:
+            if stream.finished or stream.credit <= 0:
+                return
+            self._thread_state.codec = stream.codec
+            self._thread_state.compressor = stream.compressor
+            try:
+                items = list(itertools.islice(stream.generator,
+                                              self.stream_chunk_size))
+            except Exception as e:
+                if not isinstance(e, common.RPCError):
+                    self.logger.exception("Exception streaming from %s",
+                                          self.__class__.__name__)
+                resp = response_from_exception(e, stream.id)
+                finished = True
+            else:
+                finished = len(items) < self.stream_chunk_size
+                resp = common.Response(
+                    items, None, stream.id,
+                    stream=common.STREAM_END if finished
+                    else common.STREAM_MORE)
+            stream.credit -= 1
+            stream.last_active = time.time()
+            if finished:
+                self._end_stream(stream)
+            self._send_serialized(stream.client_id, resp)
+        finally:
+            self._thread_state.codec = codec
+            self._thread_state.compressor = compressor
+            stream.lock.release()
+
+    def _end_stream(self, stream):
+        # Called with stream.lock held
+        with self.streams_lock:
+            self.streams.pop((stream.client_id, stream.id), None)
+        stream.finished = True
+        stream.generator.close()
+
+    def _handle_batch(self, client_id, reqs):
+        if not reqs:
+            raise common.InvalidRequest("Empty batch")
+
+        self.logger.debug("<_< Server received batch of %d on %s",
+                          len(reqs), self.endpoint)
+
+        resps = [resp for resp in (self._handle_batch_item(req)
+                                   for req in reqs) if resp is not None]
+
+        # A batch of only notifications gets no response at all
+        if resps:
+            self._send_batch_response(client_id, resps)
+
+    def _handle_batch_item(self, req):
+        if not isinstance(req, common.Request):
+            return common.InvalidRequest().to_response()
+
+        self._thread_state.request = req
+        try:
+            if self._expired(req):
+                raise common.DeadlineExceeded()
+
+            elif (req.is_method and self.allow_methods) or \
+                    (req.is_notification and self.allow_notifications):
+                # Each call in a batch counts towards its method's limit
+                if self.admission is None:
+                    result = self._handle_batch_call(req)
+                else:
+                    with self.admission.method_slot(req.method):
+                        result = self._handle_batch_call(req)
+                if req.is_method:
+                    return common.Response(result, None, req.id)
+
+            elif req.is_method and not self.allow_methods:
+                raise common.InvalidRequest(
+                    "Methods not accepted by this server")
+
+        except Exception as e:
+            if not isinstance(e, common.RPCError):
+                self.logger.exception("Exception handling message in %s",
+                                      self.__class__.__name__)
+            if req.is_method:
+                return response_from_exception(e, req.id)
+
+    def _handle_batch_call(self, req):
+        # Cached results are used, but not their encodings, as the batch's
+        # response is encoded as a whole
+        cache = self._response_cache(req.method) if req.is_method else None
+        key = cache_key(req.params) if cache is not None else None
+        entry = cache.get(key) if key is not None else None
+        if entry is not None:
+            return entry.result
+
+        result = self._handle_method(req)
+        if inspect.isgenerator(result):
+            result = list(result)  # Batches can't be streamed
+        if key is not None:
+            cache.put(key, result)
+        return result
+
+    def _send_batch_response(self, client_id, resps):
+        self.logger.debug(">_> Server sending batch of %d responses on %s",
+                          len(resps), self.endpoint)
+
+        self._send_serialized(client_id, resps)
+
     def _send_response(self, client_id, req, resp):
         # Notifications must not return anything
         if req and req.is_notification:
             return
 
-        debug_msg_parts = [">_> Server sending"]
-        debug_msg_parts.append("error" if resp.is_error else "return")
-        if req:
-            debug_msg_parts.append("from \"{0}\"".format(req.method))
-        debug_msg_parts.append("on {0}:\n".format(self.endpoint))
-        debug_msg_result = ("{indent}{0} {1}".format(
-            resp.error['code'], resp.error['message'],
-            indent=common.debug_log_object_indent) if resp.is_error
-            else common.debug_log_object_dump(resp.result))
+        if resp.is_error:
+            self._current_trace().error_code = resp.error['code']
 
-        self.logger.debug(' '.join(debug_msg_parts) + debug_msg_result)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            debug_msg_parts = [">_> Server sending"]
+            debug_msg_parts.append("error" if resp.is_error else "return")
+            if req:
+                debug_msg_parts.append("from \"{0}\"".format(req.method))
+            debug_msg_parts.append("on {0}:\n".format(self.endpoint))
+            debug_msg_result = ("{indent}{0} {1}".format(
+                resp.error['code'], resp.error['message'],
+                indent=common.debug_log_object_indent) if resp.is_error
+                else common.debug_log_object_dump(resp.result))
 
-        self.socket.send_multipart(
-            [_f for _f in [client_id, common.json_rpc_dumps(resp)] if _f])
+            self.logger.debug(' '.join(debug_msg_parts) + debug_msg_result)
+
+        self._send_serialized(client_id, resp)
+
+    def _send_serialized(self, client_id, resp):
+        trace = self._current_trace()
+        codec = getattr(self._thread_state, 'codec', None) or self.codec
+        frames = self._encode(resp, codec,
+                              getattr(self._thread_state, 'compressor', None))
+        trace.mark('serialize')
+        self._send_multipart([client_id] + frames if client_id else frames)
+        trace.mark('send')
+
+    def _send_multipart(self, parts):
+        socket = getattr(self._thread_state, 'socket', None) or self.socket
+        socket.send_multipart(parts, copy=common.should_copy(parts))
+
+
+class ServerStream(object):
+
+    # A generator result being streamed to a client. credit is how many
+    # more chunks the client has room for.
+
+    def __init__(self, client_id, id_, generator, codec, compressor,
+                 credit):
+        self.client_id = client_id
+        self.id = id_
+        self.generator = generator
+        self.codec = codec
+        self.compressor = compressor
+        self.credit = credit
+        self.finished = False
+        self.last_active = time.time()
+        self.lock = threading.Lock()
 
 
 class RPCNotificationServer(RPCServer):
@@ -143,3 +705,538 @@ class NotificationOnlyPullServer(RPCNotificationServer):
 
     default_socket_type = zmq.PULL
     allow_methods = False
+
+
+class Subscriber(object):
+
+    # A client subscribed to a SubscriptionServer's topics, with whatever's
+    # waiting to be sent to it while it's slow to receive: replies to its
+    # calls, which are sent first and never dropped, and notifications.
+
+    def __init__(self, client_id, codec, compressor=None):
+        self.client_id = client_id
+        self.codec = codec
+        self.compressor = compressor
+        self.topics = set()
+        self.replies = collections.deque()
+        self.queue = collections.deque()
+        self.dropped = 0
+
+
+class SubscriptionServer(RPCNotificationServer):
+
+    # The server side of NotificationReceiverClient. Clients call subscribe
+    # (and unsubscribe) with a topic, then are sent the notifications
+    # published to it with publish(), which can be called from any thread.
+    # The server's own thread does the sending, encoding each notification
+    # once for all its subscribers (well, once per codec and compression
+    # they use).
+    #
+    # Notifications a subscriber isn't receiving quickly enough wait in a
+    # queue of up to subscriber_queue_size, on top of ZeroMQ's own high water
+    # mark. When that's full, slow_consumer_policy decides what happens:
+    # "drop_oldest" or "drop_newest" notification, or "disconnect" the
+    # subscriber, ending all its subscriptions.
+    #
+    # Given a pub_endpoint, notifications are also published on a PUB socket
+    # bound there, with the topic as the first frame, for
+    # NotificationSubscriberClient. ZeroMQ then does the fan-out, dropping
+    # notifications for subscribers that fall behind, which scales to many
+    # more subscribers.
+    #
+    # The subscription registry belongs to the server's thread, so
+    # subscribe() and unsubscribe() are for calling from handlers.
+
+    subscriber_queue_size = 1000
+    slow_consumer_policy = 'drop_oldest'
+    backlog_poll_interval = 10  # milliseconds
+
+    def __init__(self, endpoint, context=None, timeout=1000, socket_type=None,
+                 logger=None, codec=None, pub_endpoint=None,
+                 compression=None):
+        super(SubscriptionServer, self).__init__(
+            endpoint, context=context, timeout=timeout,
+            socket_type=socket_type, logger=logger, codec=codec,
+            compression=compression)
+        if self.socket_type == zmq.ROUTER:
+            # Have sends to slow or vanished clients fail rather than
+            # silently drop the message, so it can be queued or the
+            # subscriber forgotten
+            self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+
+        self.topics = {}  # topic -> set of client ids
+        self.subscribers = {}  # client id -> Subscriber
+        self.backlog = set()  # client ids of subscribers with queues
+        self.dropped_notifications = 0
+        self.disconnected_subscribers = 0
+
+        # Published notifications wait in a deque for the server's thread,
+        # which is woken by a message on an inproc socket
+        self.published = collections.deque()
+        self.wakeup_endpoint = \
+            "inproc://jsonrpc2-subscription-server-%x" % id(self)
+        self.wakeup_receiver = self.context.socket(zmq.PULL)
+        self.wakeup_receiver.bind(self.wakeup_endpoint)
+        self.wakeup_sender = self.context.socket(zmq.PUSH)
+        self.wakeup_sender.setsockopt(zmq.LINGER, 0)
+        self.wakeup_sender.setsockopt(zmq.SNDHWM, 1)
+        self.wakeup_sender.connect(self.wakeup_endpoint)
+        self.wakeup_lock = threading.Lock()
+        self.poller.register(self.wakeup_receiver, zmq.POLLIN)
+
+        self.pub_socket = None
+        if pub_endpoint is not None:
+            self.pub_socket = self.context.socket(zmq.PUB)
+            self.pub_socket.setsockopt(zmq.LINGER, 0)
+            self.pub_socket.bind(pub_endpoint)
+
+    def handle_subscribe_method(self, topic):
+        self.subscribe(topic)
+
+    def handle_unsubscribe_method(self, topic):
+        self.unsubscribe(topic)
+
+    def subscribe(self, topic, client_id=None):
+        """Subscribe client_id, by default the client whose request is being
+        handled, to topic."""
+        if not isinstance(topic, str):
+            raise common.InvalidParams("Topics must be strings")
+        client_id = client_id or self._thread_state.client_id
+        if client_id is None:
+            raise common.InvalidRequest(
+                "Subscriptions need a ROUTER socket")
+        subscriber = self.subscribers.get(client_id)
+        if subscriber is None:
+            codec = getattr(self._thread_state, 'codec', None) or self.codec
+            subscriber = self.subscribers[client_id] = Subscriber(
+                client_id, codec,
+                getattr(self._thread_state, 'compressor', None))
+        subscriber.topics.add(topic)
+        self.topics.setdefault(topic, set()).add(client_id)
+
+    def unsubscribe(self, topic, client_id=None):
+        client_id = client_id or self._thread_state.client_id
+        subscriber = self.subscribers.get(client_id)
+        if subscriber is None or topic not in subscriber.topics:
+            return
+        subscriber.topics.discard(topic)
+        self._forget_topic(topic, client_id)
+        if not subscriber.topics and not subscriber.queue and \
+                not subscriber.replies:
+            del self.subscribers[client_id]
+
+    def _forget_topic(self, topic, client_id):
+        client_ids = self.topics.get(topic)
+        if client_ids is not None:
+            client_ids.discard(client_id)
+            if not client_ids:
+                del self.topics[topic]
+
+    def _remove_subscriber(self, client_id):
+        subscriber = self.subscribers.pop(client_id, None)
+        self.backlog.discard(client_id)
+        if subscriber is not None:
+            for topic in subscriber.topics:
+                self._forget_topic(topic, client_id)
+
+    def publish(self, topic, method, params=None):
+        """Send a notification of method with params to topic's
+        subscribers. Thread-safe."""
+        if params is None:
+            params = []
+        self.published.append(
+            (topic, common.Request(method, params, notify=True)))
+        with self.wakeup_lock:
+            try:
+                self.wakeup_sender.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # The server's already due to wake up
+
+    def _handle_one_message(self):
+        if self._streams_ready() or self.admitted:
+            timeout = 0
+        elif self.backlog:
+            timeout = self.backlog_poll_interval
+        else:
+            timeout = self.timeout
+        socks = dict(self.poller.poll(timeout))
+        if socks.get(self.socket) == zmq.POLLIN:
+            self._recv_messages()
+        if self.admitted:
+            self._handle_message_parts(*self.admitted.popleft())
+        if socks.get(self.wakeup_receiver) == zmq.POLLIN:
+            self._drain_wakeups()
+        self._send_published()
+        for client_id in list(self.backlog):
+            self._flush(self.subscribers[client_id])
+        self._pump_streams()
+
+    def _drain_wakeups(self):
+        while True:
+            try:
+                self.wakeup_receiver.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+    def _send_published(self):
+        while self.published:
+            topic, notification = self.published.popleft()
+            encoded = {}
+            for client_id in list(self.topics.get(topic, ())):
+                subscriber = self.subscribers.get(client_id)
+                if subscriber is None:
+                    continue  # Disconnected by an earlier one
+                key = (subscriber.codec.name, subscriber.compressor)
+                frames = encoded.get(key)
+                if frames is None:
+                    frames = encoded[key] = self._encode(
+                        notification, subscriber.codec, subscriber.compressor)
+                self._enqueue(subscriber, frames)
+
+            if self.pub_socket is not None:
+                # SUB clients can't say what they accept, so are sent
+                # notifications uncompressed
+                frames = encoded.get((self.codec.name, None)) or \
+                    self._encode(notification)
+                self.pub_socket.send_multipart(
+                    [topic.encode('utf-8')] + frames,
+                    copy=common.should_copy(frames))
+
+    def _enqueue(self, subscriber, frames):
+        if len(subscriber.queue) >= self.subscriber_queue_size:
+            subscriber.dropped += 1
+            self.dropped_notifications += 1
+            if self.slow_consumer_policy == 'disconnect':
+                self.logger.warning("v_v Server disconnecting slow "
+                                    "subscriber on %s", self.endpoint)
+                self.disconnected_subscribers += 1
+                self._remove_subscriber(subscriber.client_id)
+                return
+            elif self.slow_consumer_policy == 'drop_newest':
+                return
+            subscriber.queue.popleft()
+        subscriber.queue.append(frames)
+        self._flush(subscriber)
+
+    def _flush(self, subscriber):
+        # Send what's waiting for subscriber, until it's full up
+        client_id = subscriber.client_id
+        for queue in (subscriber.replies, subscriber.queue):
+            while queue:
+                frames = queue[0]
+                try:
+                    self.socket.send_multipart(
+                        [client_id] + frames, zmq.NOBLOCK,
+                        copy=common.should_copy(frames))
+                except zmq.Again:
+                    self.backlog.add(client_id)
+                    return
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EHOSTUNREACH:
+                        raise
+                    self._remove_subscriber(client_id)  # It's gone
+                    return
+                queue.popleft()
+        self.backlog.discard(client_id)
+        if not subscriber.topics:
+            self.subscribers.pop(client_id, None)
+
+    def _send_multipart(self, parts):
+        if self.socket_type != zmq.ROUTER:
+            return super(SubscriptionServer, self)._send_multipart(parts)
+        # Replies wait with the subscriber's notifications, if it has any,
+        # so a slow subscriber doesn't hold up the server
+        client_id = parts[0]
+        subscriber = self.subscribers.get(client_id)
+        if subscriber is not None:
+            subscriber.replies.append(parts[1:])
+            self._flush(subscriber)
+            return
+        try:
+            self.socket.send_multipart(parts, zmq.NOBLOCK,
+                                       copy=common.should_copy(parts))
+        except zmq.Again:
+            self.logger.warning("v_v Server dropping reply to a client not "
+                                "receiving on %s", self.endpoint)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+
+    def close(self):
+        self.wakeup_sender.close()
+        self.wakeup_receiver.close()
+        if self.pub_socket is not None:
+            self.pub_socket.close()
+        super(SubscriptionServer, self).close()
+
+
+# Sent by pool workers to say they're free to take a request
+WORKER_READY = b'\x01'
+
+
+class ThreadPoolRPCServer(RPCNotificationServer):
+
+    # Requests arriving on the ROUTER front socket are passed through an
+    # inproc ROUTER socket to a pool of worker threads, each with its own
+    # DEALER socket. Workers say when they're free (see WORKER_READY), and
+    # requests are only passed to free ones, so a slow handler holds up no
+    # more than its own worker. Until then, requests wait in a queue here,
+    # and their traces have a "queue" stage for the time spent there. A
+    # worker receives the client id along with the request and sends it back
+    # with the response, so the front socket can route replies to the right
+    # client in whatever order they finish.
+    #
+    # Handlers run concurrently, so must be thread-safe.
+
+    default_workers = 4
+    max_queued = 1000  # requests
+    concurrent_handlers = True
+
+    def __init__(self, endpoint, context=None, timeout=1000, socket_type=None,
+                 logger=None, workers=None, codec=None, compression=None):
+        super(ThreadPoolRPCServer, self).__init__(
+            endpoint, context=context, timeout=timeout,
+            socket_type=socket_type, logger=logger, codec=codec,
+            compression=compression)
+        self.num_workers = workers or self.default_workers
+        self.workers = []
+        self.free_workers = collections.deque()
+        self.busy_workers = set()
+        self.backend = self.context.socket(zmq.ROUTER)
+        self.backend.setsockopt(zmq.LINGER, 0)
+        self._setup_backend()
+        self.poller.register(self.backend, zmq.POLLIN)
+        # For when there's no free worker to take a request
+        self.backend_poller = zmq.Poller()
+        self.backend_poller.register(self.backend, zmq.POLLIN)
+
+    def _setup_backend(self):
+        self.backend_endpoint = "inproc://jsonrpc2-server-workers-%x" % \
+            id(self)
+        self.backend.bind(self.backend_endpoint)
+
+    def _start_workers(self):
+        self.workers = [ServerWorkerThread(self, self.backend_endpoint)
+                        for i in range(self.num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            worker.join()
+
+    def run(self):
+        self._start_workers()
+        try:
+            super(ThreadPoolRPCServer, self).run()
+        finally:
+            self.should_stop = True
+            self._stop_workers()
+
+    def _handle_one_message(self):
+        # Requests are read in and queued here, to be passed to workers as
+        # they come free, so the queue can be measured. Beyond max_queued of
+        # them (unless admission control is shedding them instead) they're
+        # left in the front socket's queue.
+        if self.admission is not None or \
+                len(self.admitted) < self.max_queued:
+            poller = self.poller
+        else:
+            poller = self.backend_poller
+        socks = dict(poller.poll(self.timeout))
+        if socks.get(self.backend) == zmq.POLLIN:
+            self._recv_from_workers()
+        # Frames are passed through without copying them. Workers release
+        # admitted requests when they're done with them.
+        if socks.get(self.socket) == zmq.POLLIN:
+            self._recv_requests()
+        while self.admitted and self.free_workers:
+            self._dispatch(*self.admitted.popleft())
+
+    def _recv_requests(self):
+        while self.admission is not None or \
+                len(self.admitted) < self.max_queued:
+            try:
+                req_parts = self.socket.recv_multipart(zmq.NOBLOCK,
+                                                       copy=False)
+            except zmq.Again:
+                return
+            self._admit(req_parts)
+
+    def _recv_from_workers(self):
+        while True:
+            try:
+                parts = self.backend.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            if len(parts) == 2 and parts[1].bytes == WORKER_READY:
+                self._worker_ready(parts[0].bytes)
+            else:
+                self.socket.send_multipart(parts[1:], copy=False)
+
+    def _worker_ready(self, worker_id):
+        self.busy_workers.discard(worker_id)
+        self.free_workers.append(worker_id)
+
+    def _dispatch(self, req_parts, received):
+        # Workers are told when the request was received
+        worker_id = self.free_workers.popleft()
+        self.busy_workers.add(worker_id)
+        self.backend.send_multipart(
+            [worker_id, struct.pack('!d', received)] + req_parts, copy=False)
+
+    def _gauges(self):
+        gauges = super(ThreadPoolRPCServer, self)._gauges()
+        gauges['busy_workers'] = lambda: len(self.busy_workers)
+        return gauges
+
+    def close(self):
+        self.backend.close()
+        super(ThreadPoolRPCServer, self).close()
+
+
+class ProcessPoolRPCServer(ThreadPoolRPCServer):
+
+    # Like ThreadPoolRPCServer, but each worker is a separate process running
+    # its own instance of handler_class (an RPCServer subclass) on a DEALER
+    # socket bound to an ipc:// endpoint. The front-end only relays
+    # messages, passing each request to a worker that's free, so handlers
+    # don't share a GIL. Workers run their handler_class instance with
+    # run_worker rather than starting it as a thread.
+    #
+    # Workers don't stream results, as a stream's credit from its client
+    # would go to whichever worker is free rather than the one with the
+    # stream; generators' items are returned as a list instead.
+    #
+    # Workers are spawned rather than forked by default, so handler_class
+    # must be importable and handler_kwargs picklable.
+
+    start_method = 'spawn'
+
+    def __init__(self, handler_class, endpoint, context=None, timeout=1000,
+                 socket_type=None, logger=None, workers=None,
+                 handler_kwargs=None):
+        self.handler_class = handler_class
+        self.handler_kwargs = handler_kwargs or {}
+        self.worker_dir = tempfile.mkdtemp(prefix='jsonrpc2-zeromq-')
+        super(ProcessPoolRPCServer, self).__init__(
+            endpoint, context=context, timeout=timeout,
+            socket_type=socket_type, logger=logger,
+            workers=workers or multiprocessing.cpu_count())
+
+    def enable_admission_control(self, max_pending=None, method_limits=None):
+        """Limit the requests queued or being handled by workers to
+        max_pending, answering any more with ServerOverloaded. The front-end
+        only relays messages, without reading them, so method_limits aren't
+        supported."""
+        if method_limits:
+            raise ValueError("ProcessPoolRPCServer doesn't support method "
+                             "limits")
+        return super(ProcessPoolRPCServer, self).enable_admission_control(
+            max_pending)
+
+    def enable_metrics(self, metrics=None, expose=False):
+        """Collect the front-end's queued and busy_workers gauges. Calls are
+        handled by the workers, so there are no per-method metrics, and
+        rpc.stats would go to a worker, so they can't be exposed."""
+        if expose:
+            raise ValueError("ProcessPoolRPCServer can't expose metrics, as "
+                             "rpc.stats would be handled by a worker")
+        return super(ProcessPoolRPCServer, self).enable_metrics(metrics)
+
+    def enable_idempotent_retries(self, window=60, max_size=10000):
+        """Not supported: each worker process would need to see every retry
+        of the requests it handled, but retries go to whichever worker is
+        free."""
+        raise ValueError("ProcessPoolRPCServer doesn't support idempotent "
+                         "retries")
+
+    def _worker_ready(self, worker_id):
+        # Workers have their own instances of handler_class, without
+        # admission control, so requests are released here when done
+        if self.admission is not None and worker_id in self.busy_workers:
+            self.admission.release()
+        super(ProcessPoolRPCServer, self)._worker_ready(worker_id)
+
+    def _setup_backend(self):
+        self.worker_endpoints = [
+            "ipc://{0}/worker-{1}".format(self.worker_dir, i)
+            for i in range(self.num_workers)]
+        for worker_endpoint in self.worker_endpoints:
+            self.backend.connect(worker_endpoint)
+
+    def _start_workers(self):
+        if hasattr(multiprocessing, 'get_context'):
+            mp = multiprocessing.get_context(self.start_method)
+        else:
+            mp = multiprocessing
+        self.workers_stop_event = mp.Event()
+        self.workers = [
+            mp.Process(target=run_process_worker,
+                       args=(self.handler_class, worker_endpoint,
+                             self.handler_kwargs, self.workers_stop_event))
+            for worker_endpoint in self.worker_endpoints]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _stop_workers(self):
+        self.workers_stop_event.set()
+        for worker in self.workers:
+            worker.join()
+
+    def close(self):
+        super(ProcessPoolRPCServer, self).close()
+        shutil.rmtree(self.worker_dir, ignore_errors=True)
+
+
+def run_process_worker(handler_class, endpoint, handler_kwargs, stop_event):
+    server = handler_class(endpoint, socket_type=zmq.DEALER, **handler_kwargs)
+    server.stream_results = False
+    try:
+        run_worker(server, server.socket, stop_event.is_set)
+    finally:
+        server.close()
+
+
+def run_worker(server, socket, should_stop):
+    """Handle requests from a pool's backend socket on socket, saying when
+    ready for each one, until should_stop() is true."""
+    server._thread_state.socket = socket
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    socket.send(WORKER_READY)
+
+    while not should_stop():
+        try:
+            timeout = 0 if server._streams_ready() else server.timeout
+            if poller.poll(timeout):
+                parts = socket.recv_multipart(copy=False)
+                received = struct.unpack('!d', parts[0].bytes)[0]
+                server._handle_message_parts(parts[1:], received)
+                socket.send(WORKER_READY)
+            server._pump_streams()
+        except zmq.ZMQError as e:
+            if e.errno == errno.EINTR:
+                continue
+            else:
+                raise
+
+
+class ServerWorkerThread(threading.Thread):
+
+    def __init__(self, server, endpoint):
+        super(ServerWorkerThread, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.endpoint = endpoint
+
+    def run(self):
+        server = self.server
+        socket = server.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        try:
+            run_worker(server, socket, lambda: server.should_stop)
+        finally:
+            socket.close()
@@ -0,0 +1,35 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+# Test helpers needing Python 3 syntax.
+
+import asyncio
+
+import jsonrpc2_zeromq.aio
+
+
+class AsyncRPCTestServer(jsonrpc2_zeromq.aio.AsyncRPCNotificationServer):
+
+    long_time = 500  # milliseconds
+
+    async def handle_echo_method(self, msg):
+        return msg
+
+    def handle_sync_echo_method(self, msg):
+        return msg
+
+    async def handle_take_a_long_time_method(self):
+        await asyncio.sleep(self.long_time / 1000.0)
+
+    async def handle_fail_method(self):
+        raise ValueError("Broken")
+
+    async def handle_time_remaining_method(self):
+        return self.time_remaining()
+
+    async def handle_async_count_method(self, n):
+        for i in range(n):
+            await asyncio.sleep(0)
+            yield i
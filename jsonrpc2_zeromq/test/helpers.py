@@ -22,12 +22,28 @@ import jsonrpc2_zeromq.common
 class LongTimeServerMixin(object):
 
     long_time = 500  # milliseconds
+    long_time_calls = 0
 
     def handle_take_a_long_time_method(self):
+        self.long_time_calls += 1
         sleep(old_div(self.long_time, 1000.0))
+        return self.long_time_calls
 
 
-class RPCTestServer(jsonrpc2_zeromq.RPCServer, LongTimeServerMixin):
+class StreamingServerMixin(object):
+
+    produced = 0
+
+    def handle_count_method(self, n, fail_at=None):
+        for i in range(n):
+            if i == fail_at:
+                raise ValueError("Failed at {0}".format(i))
+            self.produced = i + 1
+            yield i
+
+
+class RPCTestServer(jsonrpc2_zeromq.RPCServer, LongTimeServerMixin,
+                    StreamingServerMixin):
 
     def handle_echo_method(self, msg):
         return msg
@@ -39,6 +55,25 @@ class RPCTestServer(jsonrpc2_zeromq.RPCServer, LongTimeServerMixin):
     def handle_return_null_method(self):
         return None
 
+    def handle_raise_type_error_method(self):
+        return len(None)
+
+    def handle_describe_binary_method(self, blob):
+        return dict(type=type(blob).__name__, length=len(blob))
+
+    def handle_time_remaining_method(self):
+        return self.time_remaining()
+
+    lookups = 0
+
+    @jsonrpc2_zeromq.cacheable(ttl=60, max_size=2)
+    def handle_lookup_method(self, key):
+        self.lookups += 1
+        return dict(key=key, lookups=self.lookups)
+
+    def handle_forget_method(self, key):
+        self.invalidate_cache('lookup', [key])
+
 
 class RPCNotificationTestServer(jsonrpc2_zeromq.RPCNotificationServer):
 
@@ -46,6 +81,27 @@ class RPCNotificationTestServer(jsonrpc2_zeromq.RPCNotificationServer):
         return msg
 
 
+class WorkerTestError(jsonrpc2_zeromq.ApplicationError):
+    error_code = 1001
+
+
+class ProcessWorkerTestServer(jsonrpc2_zeromq.RPCNotificationServer,
+                              LongTimeServerMixin, StreamingServerMixin):
+
+    def handle_echo_method(self, msg):
+        return msg
+
+    def handle_fail_method(self):
+        raise WorkerTestError("Failed", {"in": "worker"})
+
+
+class ThreadPoolRPCTestServer(jsonrpc2_zeromq.ThreadPoolRPCServer,
+                              LongTimeServerMixin, StreamingServerMixin):
+
+    def handle_echo_method(self, msg):
+        return msg
+
+
 class NotificationOnlyPullTestServer(
         jsonrpc2_zeromq.NotificationOnlyPullServer):
 
@@ -55,42 +111,41 @@ class NotificationOnlyPullTestServer(
 
 
 class NotificationReceiverClientTestServer(
-        jsonrpc2_zeromq.RPCNotificationServer, LongTimeServerMixin):
+        jsonrpc2_zeromq.SubscriptionServer, LongTimeServerMixin):
 
     notification_reply_sleep_time = 0.5
 
     reply_thread = None
+    subscriptions = 0
 
-    def _send_back_notifications(self, client_id, method, num_notifications):
+    def _send_back_notifications(self, topic, method, num_notifications):
         for i in range(num_notifications):
             sleep(self.notification_reply_sleep_time)
-            notification = jsonrpc2_zeromq.common.Request(method, params=[i],
-                                                          notify=True)
-            self.socket.send_multipart(
-                [client_id,
-                 jsonrpc2_zeromq.common.json_rpc_dumps(notification)])
-
-    def _start_sending_notifications_thread(self, client_id, method,
-                                            num_notifications):
+            self.publish(topic, method, [i])
+
+    def _start_sending_notifications_thread(self, method, num_notifications):
+        # Each subscriber gets its own topic
+        self.subscriptions += 1
+        topic = "events-{0}".format(self.subscriptions)
+        self.subscribe(topic)
         self.reply_thread = threading.Thread(
-            target=lambda: self._send_back_notifications(client_id, method,
+            target=lambda: self._send_back_notifications(topic, method,
                                                          num_notifications))
         self.reply_thread.start()
 
-    def _handle_method_and_response(self, client_id, req):
-        # Slight hack to keep the client_id for _send_back_notifications
-        self.client_id = client_id
-        return super(NotificationReceiverClientTestServer,
-                     self)._handle_method_and_response(client_id, req)
-
     def handle_subscribe_method(self, num_notifications):
-        self._start_sending_notifications_thread(self.client_id, "event",
-                                                 num_notifications)
+        self._start_sending_notifications_thread("event", num_notifications)
 
     def handle_subscribe_bad_event_method(self, num_notifications):
-        self._start_sending_notifications_thread(self.client_id, "bad_event",
+        self._start_sending_notifications_thread("bad_event",
                                                  num_notifications)
 
+    def handle_subscribe_topic_method(self, topic):
+        self.subscribe(topic)
+
+    def handle_echo_method(self, msg):
+        return msg
+
     def stop(self):
         if self.reply_thread and self.reply_thread.is_alive:
             self.reply_thread.join()
@@ -104,3 +159,48 @@ class NotificationReceiverTestClient(
 
     def handle_event_notification(self, num):
         self.num_notifications_received += 1
+
+
+class NotificationRecorderMixin(object):
+
+    def handle_event_notification(self, *params):
+        self.events.append(params)
+
+
+class NotificationRecorderClient(NotificationRecorderMixin,
+                                 jsonrpc2_zeromq.NotificationReceiverClient):
+
+    def __init__(self, *args, **kwargs):
+        self.events = []
+        self.unblocked = threading.Event()
+        super(NotificationRecorderClient, self).__init__(*args, **kwargs)
+
+    def handle_block_notification(self):
+        self.unblocked.wait(5)
+
+
+class SmallQueueRecorderClient(NotificationRecorderClient):
+
+    notification_queue_size = 2
+
+
+class NotificationBatchRecorderClient(NotificationRecorderClient):
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super(NotificationBatchRecorderClient, self).__init__(*args,
+                                                              **kwargs)
+
+    def handle_event_notifications(self, params_list):
+        self.batches.append(params_list)
+        self.unblocked.wait(5)
+
+
+class NotificationRecorderSubscriberClient(
+        NotificationRecorderMixin,
+        jsonrpc2_zeromq.NotificationSubscriberClient):
+
+    def __init__(self, *args, **kwargs):
+        self.events = []
+        super(NotificationRecorderSubscriberClient, self).__init__(*args,
+                                                                   **kwargs)
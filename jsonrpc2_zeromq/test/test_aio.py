@@ -0,0 +1,254 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+
+import unittest
+import threading
+import time
+
+import jsonrpc2_zeromq
+
+from .helpers import *  # NOQA
+
+try:
+    import asyncio
+    from jsonrpc2_zeromq.aio import AsyncRPCClient
+    from .aio_helpers import *  # NOQA
+except (ImportError, SyntaxError):
+    AsyncRPCClient = None
+
+
+@unittest.skipIf(AsyncRPCClient is None, "asyncio support not available")
+class AsyncRPCClientTestCase(unittest.TestCase):
+
+    endpoint = "inproc://jsonrpc2-zeromq-tests"
+    logger = None
+
+    def setUp(self):
+        self.server = ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                              logger=self.logger, workers=4)
+        self.server.daemon = True
+        self.server.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = AsyncRPCClient(endpoint=self.endpoint,
+                                     logger=self.logger)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.run_until_complete(asyncio.sleep(0))  # Let tasks cancel
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.stop()
+        self.server.join()
+        self.server.close()
+        sleep(0.1)  # Wait for socket to actually close
+
+    def test_echo(self):
+        msg = "Test message"
+        result = self.loop.run_until_complete(self.client.echo(msg))
+        self.assertEqual(msg, result)
+
+    def test_many_in_flight(self):
+        msgs = ["message {0}".format(i) for i in range(200)]
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[self.client.echo(msg) for msg in msgs]))
+        self.assertEqual(msgs, results)
+
+    def test_notify_then_rpc(self):
+        self.loop.run_until_complete(
+            self.client.notify.echo("a message into the void"))
+        result = self.loop.run_until_complete(self.client.echo("clowns"))
+        self.assertEqual("clowns", result)
+
+    def test_method_not_found(self):
+        with self.assertRaises(jsonrpc2_zeromq.MethodNotFound):
+            self.loop.run_until_complete(self.client.non_existent_method())
+
+    def test_response_while_sending(self):
+        send = self.client._send
+
+        async def slow_send(*args):
+            await send(*args)
+            await asyncio.sleep(0.2)  # The response arrives meanwhile
+
+        self.client._send = slow_send
+        self.client.timeout = 1000
+        self.assertEqual("quick", self.loop.run_until_complete(
+            self.client.echo("quick")))
+
+    def test_timeout(self):
+        self.client.timeout = ThreadPoolRPCTestServer.long_time // 10
+        with self.assertRaises(jsonrpc2_zeromq.client.TimeoutError):
+            self.loop.run_until_complete(self.client.take_a_long_time())
+
+    def test_stream(self):
+        async def collect():
+            return [i async for i in self.client.stream.count(1050)]
+        self.assertEqual(list(range(1050)),
+                         self.loop.run_until_complete(collect()))
+
+
+@unittest.skipIf(AsyncRPCClient is None, "asyncio support not available")
+class AsyncRPCServerTestCase(unittest.TestCase):
+
+    endpoint = "inproc://jsonrpc2-zeromq-tests"
+    logger = None
+    max_concurrency = 10
+
+    def setUp(self):
+        self.server_loop = asyncio.new_event_loop()
+        self.server = AsyncRPCTestServer(endpoint=self.endpoint,
+                                         logger=self.logger,
+                                         max_concurrency=self.max_concurrency)
+        self.server_thread = threading.Thread(
+            target=self.server_loop.run_until_complete,
+            args=(self.server.run(),))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = AsyncRPCClient(endpoint=self.endpoint,
+                                     logger=self.logger)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.run_until_complete(asyncio.sleep(0))  # Let tasks cancel
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.stop()
+        self.server_thread.join()
+        self.server.close()
+        self.server_loop.close()
+        sleep(0.1)  # Wait for socket to actually close
+
+    def test_echo(self):
+        for method in (self.client.echo, self.client.sync_echo):
+            self.assertEqual("hello", self.loop.run_until_complete(
+                method("hello")))
+
+    def test_attachments(self):
+        blob = b"\x00\x01binary" * 10000
+        result = self.loop.run_until_complete(self.client.echo([blob]))
+        self.assertEqual(blob, bytes(result[0]))
+
+    def test_req_client(self):
+        client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                           logger=self.logger)
+        self.assertEqual("hello", client.echo("hello"))
+        client.close()
+
+    def test_batch(self):
+        client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                           logger=self.logger)
+        with client.batch() as batch:
+            batch.echo("one")
+            batch.notify.echo("into the void")
+            batch.sync_echo("two")
+        client.close()
+        self.assertEqual(["one", "two"], batch.results)
+
+    def test_concurrent_slow_calls(self):
+        start = time.time()
+        self.loop.run_until_complete(asyncio.gather(
+            *[self.client.take_a_long_time()
+              for i in range(self.max_concurrency)]))
+        elapsed = time.time() - start
+        self.assertTrue(elapsed < 2 * AsyncRPCTestServer.long_time / 1000.0)
+
+    def test_concurrency_limit(self):
+        start = time.time()
+        self.loop.run_until_complete(asyncio.gather(
+            *[self.client.take_a_long_time()
+              for i in range(self.max_concurrency + 1)]))
+        elapsed = time.time() - start
+        self.assertTrue(elapsed >= 2 * AsyncRPCTestServer.long_time / 1000.0)
+
+    def test_stream(self):
+        async def collect():
+            return [i async for i in self.client.stream.async_count(250)]
+        self.assertEqual(list(range(250)),
+                         self.loop.run_until_complete(collect()))
+        self.assertEqual(list(range(250)), self.loop.run_until_complete(
+            self.client.async_count(250)))
+
+    def test_stream_close(self):
+        async def take_one():
+            async with self.client.stream.async_count(100000) as stream:
+                return await stream.__anext__()
+        self.assertEqual(0, self.loop.run_until_complete(take_one()))
+        self.assertEqual("still here", self.loop.run_until_complete(
+            self.client.echo("still here")))
+        for i in range(10):
+            if not self.server.streams:
+                break
+            # The cancellation's handled concurrently with the echo
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual({}, self.server.streams)
+
+    def test_deadlines(self):
+        self.assertEqual(None, self.loop.run_until_complete(
+            self.client.time_remaining()))
+        self.client.send_deadlines = True
+        remaining = self.loop.run_until_complete(self.client.time_remaining())
+        self.assertTrue(0 < remaining <= 5)
+        self.client.send_deadlines = False
+        expired = jsonrpc2_zeromq.common.Request(
+            "echo", ["too late"], deadline=time.time() - 1)
+        with self.assertRaises(jsonrpc2_zeromq.DeadlineExceeded):
+            self.loop.run_until_complete(self.client.request(expired))
+
+    def test_compression(self):
+        self.server.compression = jsonrpc2_zeromq.common.get_compressor(
+            'zlib')
+        client = AsyncRPCClient(endpoint=self.endpoint, logger=self.logger,
+                                compression='zlib')
+        client.compress_requests = True
+        big = "x" * 10000
+        self.assertEqual(big, self.loop.run_until_complete(client.echo(big)))
+        self.assertEqual(list(range(2000)), self.loop.run_until_complete(
+            client.async_count(2000)))
+        client.close()
+
+    def test_trace_hooks(self):
+        server_traces = []
+        client_traces = []
+        self.server.add_trace_hook(server_traces.append)
+        self.client.add_trace_hook(client_traces.append)
+
+        self.loop.run_until_complete(self.client.echo("traced"))
+        with self.assertRaises(jsonrpc2_zeromq.MethodNotFound):
+            self.loop.run_until_complete(self.client.non_existent_method())
+
+        self.assertEqual(2, len(client_traces))
+        self.assertEqual(["request", "serialize", "send", "recv", "parse"],
+                         [stage for stage, t in client_traces[0].stages])
+        self.assertEqual("echo", client_traces[0].method)
+        self.assertEqual(-32601, client_traces[1].error_code)
+
+        sleep(0.1)  # Server finishes its trace after replying
+        self.assertEqual(2, len(server_traces))
+        self.assertEqual(["recv", "parse", "dispatch", "handler",
+                          "serialize", "send"],
+                         [stage for stage, t in server_traces[0].stages])
+        self.assertEqual(client_traces[0].id, server_traces[0].id)
+        self.assertEqual(-32601, server_traces[1].error_code)
+        self.assertTrue(all(d >= 0 for stage, d
+                            in server_traces[0].durations()))
+
+    def test_errors(self):
+        with self.assertRaises(jsonrpc2_zeromq.MethodNotFound):
+            self.loop.run_until_complete(self.client.non_existent_method())
+        with self.assertRaises(jsonrpc2_zeromq.InvalidParams):
+            self.loop.run_until_complete(self.client.echo())
+        with self.assertRaises(jsonrpc2_zeromq.ServerError):
+            self.loop.run_until_complete(self.client.fail())
@@ -0,0 +1,322 @@
+# Part of the jsonrpc2-zeromq-python project.
+# (c) 2012 Dan Brown, All Rights Reserved.
+# Please see the LICENSE file in the root of this project for license
+# information.
+
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *  # NOQA
+
+import time
+import unittest
+
+import zmq
+
+import jsonrpc2_zeromq
+from jsonrpc2_zeromq import common
+from jsonrpc2_zeromq.metrics import Histogram, ServerMetrics
+from jsonrpc2_zeromq.cache import ResponseCache, RecentRequests, cache_key
+from jsonrpc2_zeromq.admission import AdmissionControl
+from jsonrpc2_zeromq.common import Request, handle_request, dispatch_table
+
+
+class Handlers(object):
+
+    def handle_plain_method(self, a, b=2):
+        return [a, b]
+
+    def handle_var_method(self, *args, **kwargs):
+        return [list(args), kwargs]
+
+    def handle_mixed_Case_method(self):
+        pass
+
+    handle_not_callable_method = "nope"
+
+
+class DispatchTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = Handlers()
+
+    def call(self, method, params):
+        return handle_request(self.handlers, 'handle_{method}_method',
+                              Request(method, params))
+
+    def test_lookup(self):
+        table = dispatch_table(self.handlers, 'handle_{method}_method')
+        self.assertEqual(set(['plain', 'var', 'mixed_Case']),
+                         set(table.handlers))
+        self.assertTrue(table is dispatch_table(self.handlers,
+                                                'handle_{method}_method'))
+
+    def test_normalised_method(self):
+        self.assertEqual([1, 2], self.call('Plain', [1]))
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound, self.call,
+                          'mixed-case', [])
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound, self.call,
+                          'not_callable', [])
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound, self.call,
+                          ['plain'], [])
+
+    def test_positional(self):
+        self.assertEqual([1, 3], self.call('plain', [1, 3]))
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.call,
+                          'plain', [])
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.call,
+                          'plain', [1, 2, 3])
+
+    def test_named(self):
+        self.assertEqual([1, 2], self.call('plain', {'a': 1}))
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.call,
+                          'plain', {'b': 1})
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.call,
+                          'plain', {'a': 1, 'c': 1})
+
+    def test_var(self):
+        self.assertEqual([[1, 2, 3], {}], self.call('var', [1, 2, 3]))
+        self.assertEqual([[], {'x': 1}], self.call('var', {'x': 1}))
+
+    def test_unexpected_params_type(self):
+        self.assertRaises(jsonrpc2_zeromq.InternalError, self.call,
+                          'plain', "a")
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        for codec in common.codecs.values():
+            req = common.Request("echo", [{"a": [1, 2.5, None]}])
+            out = common.codec_for_message(codec.dumps(req)).loads(
+                codec.dumps(req))
+            self.assertTrue(isinstance(out, common.Request))
+            self.assertEqual((req.method, req.params, req.id),
+                             (out.method, out.params, out.id))
+
+            batch = codec.loads(codec.dumps(
+                [common.Response("ok", None, "1"),
+                 common.InvalidRequest().to_response()]))
+            self.assertEqual(["ok", None], [r.result for r in batch])
+            self.assertEqual([None, -32600],
+                             [r.error and r.error['code'] for r in batch])
+
+    def test_nested_messages_left_alone(self):
+        nested = {"jsonrpc": "2.0", "method": "inner", "params": []}
+        for codec in common.codecs.values():
+            req = codec.loads(codec.dumps(
+                common.Request("outer", [nested, [nested]])))
+            self.assertEqual("outer", req.method)
+            self.assertEqual([nested, [nested]], req.params)
+
+    def test_attachments(self):
+        endpoint = common.Endpoint("inproc://unused", zmq.REQ, 0)
+        blob = b"\x00\xffbinary"
+        frames = endpoint._encode(common.Request(
+            "echo", [blob, {"nested": bytearray(blob)}, "text"]))
+        self.assertEqual(3, len(frames))
+        req = endpoint._decode([b""] + frames)
+        self.assertEqual([blob, {"nested": blob}, "text"],
+                         [req.params[0], req.params[1], req.params[2]])
+        self.assertTrue(isinstance(req.params[0], memoryview))
+
+        frames[0] = frames[0].replace(b'1}', b'5}')
+        self.assertRaises(ValueError, endpoint._decode, frames)
+
+    def test_codec_for_message(self):
+        self.assertTrue(common.codec_for_message(b'{}') is common.json_codec)
+        self.assertRaises(ValueError, common.codec_for_message, b'\x00?{}')
+        if 'msgpack' in common.codecs:
+            msgpack_codec = common.get_codec('msgpack')
+            self.assertTrue(common.codec_for_message(
+                msgpack_codec.dumps({})) is msgpack_codec)
+            # Unmarked messages aren't read as msgpack
+            self.assertTrue(common.codec_for_message(b'{}', msgpack_codec)
+                            is common.json_codec)
+
+    def test_get_codec(self):
+        self.assertTrue(common.get_codec('json') is common.json_codec)
+        self.assertTrue(common.get_codec(common.json_codec) is
+                        common.json_codec)
+        self.assertRaises(ValueError, common.get_codec, 'smoke-signals')
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = common.Endpoint("inproc://unused", zmq.REQ, 0,
+                                        compression='zlib')
+        self.endpoint.compress_requests = True
+
+    def test_round_trip(self):
+        blob = b"\x00\xffbinary"
+        req = common.Request("echo", ["x" * 10000, blob])
+        frames = self.endpoint._encode_request(req)
+        self.assertEqual(b'\x00Z', bytes(frames[0][:2]))
+        self.assertTrue(len(frames[0]) < 1000)
+        self.assertEqual(blob, frames[1])  # Attachments left alone
+        out = self.endpoint._decode(frames)
+        self.assertEqual("x" * 10000, out.params[0])
+        self.assertEqual(blob, bytes(out.params[1]))
+        self.assertEqual(['zlib'], out.accept_compression)
+
+    def test_threshold(self):
+        frames = self.endpoint._encode_request(common.Request("echo", ["x"]))
+        self.assertEqual(b'{', bytes(frames[0][:1]))
+        self.assertEqual(None, common.reply_compressor(
+            self.endpoint.compression, common.Request("echo", [])))
+
+    def test_corrupt(self):
+        frames = self.endpoint._encode_request(
+            common.Request("echo", ["x" * 10000]))
+        self.assertRaises(ValueError, self.endpoint._decode,
+                          [frames[0][:-10]])
+        self.assertRaises(ValueError, self.endpoint._decode,
+                          [b'\x00Znot zlib'])
+        self.assertRaises(ValueError, common.get_compressor, 'carrier-pigeon')
+
+
+class MessageTestCase(unittest.TestCase):
+
+    def test_ids(self):
+        ids = set(Request("echo", []).id for i in range(1000))
+        self.assertEqual(1000, len(ids))
+        generator = common.IDGenerator()
+        self.assertNotEqual(generator.prefix, common.generate_id.prefix)
+        self.assertEqual(None, Request("echo", [], notify=True).id)
+        self.assertEqual(0, Request("echo", [], id_=0).to_dict()['id'])
+
+    def test_response_dict(self):
+        self.assertEqual({"jsonrpc": "2.0", "result": None, "id": "1"},
+                         common.Response(None, None, "1").to_dict())
+        error = common.InvalidRequest().to_response()
+        self.assertEqual(["error", "id", "jsonrpc"],
+                         sorted(error.to_dict()))
+        self.assertEqual(None, error.to_dict()['id'])
+
+    def test_deadline(self):
+        request = Request("echo", [], deadline=time.time() + 10)
+        data = common.json_codec.dumps(request)
+        parsed = common.json_codec.loads(data)
+        self.assertEqual(request.deadline, parsed.deadline)
+        self.assertTrue(9 < parsed.time_remaining() <= 10)
+        self.assertFalse('deadline' in Request("echo", []).to_dict())
+        self.assertEqual(None, Request("echo", [],
+                                       deadline="soon").time_remaining())
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, Request("echo", []),
+                          "surprise", True)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_null_trace(self):
+        trace = common.null_trace
+        trace.method = "echo"
+        trace.error_code = -32601
+        trace.mark("recv")
+        self.assertEqual((None, None, ()),
+                         (trace.method, trace.error_code, trace.stages))
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(None, histogram.percentile(0.5))
+        for i in range(1000):
+            histogram.observe(0.001)
+        histogram.observe(10)
+        self.assertEqual(1001, histogram.count)
+        self.assertEqual(10, histogram.max)
+        # Within a factor of two
+        self.assertTrue(0.001 <= histogram.percentile(0.5) < 0.002)
+        self.assertTrue(histogram.percentile(1) >= 10)
+        self.assertEqual(len(Histogram.bounds) + 1, len(histogram.counts))
+        histogram.observe(1e6)
+        self.assertEqual(1e6, histogram.percentile(1))
+
+    def test_method_limit(self):
+        metrics = ServerMetrics()
+        metrics.max_methods = 2
+        for method in ("a", "b", "c", "d", "a"):
+            trace = common.Trace("inproc://unused")
+            trace.method = method
+            trace.mark("recv")
+            trace.mark("send")
+            metrics(trace)
+        snapshot = metrics.snapshot()
+        self.assertEqual(5, snapshot['calls'])
+        self.assertEqual({"a": 2, "b": 1, "(other)": 2},
+                         dict((m, s['calls'])
+                              for m, s in snapshot['methods'].items()))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def test_expiry(self):
+        cache = ResponseCache(ttl=0, max_size=10)
+        cache.put("k", 1)
+        self.assertEqual(None, cache.get("k"))
+        cache.ttl = 60
+        cache.put("k", 1)
+        self.assertEqual(1, cache.get("k").result)
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key({"a": 1, "b": 2}),
+                         cache_key({"b": 2, "a": 1}))
+        self.assertEqual(None, cache_key([b"binary"]))
+
+
+class RecentRequestsTestCase(unittest.TestCase):
+
+    def test_start_finish(self):
+        recent = RecentRequests(window=60, max_size=2)
+        self.assertEqual(None, recent.start("1", b"a"))
+        self.assertTrue(recent.start("1", b"b") is RecentRequests.IN_PROGRESS)
+        response = common.Response("done", None, "1")
+        self.assertEqual([b"b"], recent.finish("1", response))
+        self.assertTrue(recent.start("1", b"c") is response)
+        self.assertEqual(2, recent.retries)
+        self.assertTrue(recent.response("1") is response)
+        self.assertEqual(None, recent.response("unknown"))
+
+        recent.start("2", b"a")
+        recent.start("3", b"a")
+        # Too many to remember "1" as well
+        self.assertEqual(None, recent.start("1", b"a"))
+
+    def test_window(self):
+        recent = RecentRequests(window=0)
+        recent.start("1", b"a")
+        recent.finish("1", common.Response("done", None, "1"))
+        self.assertEqual(None, recent.start("1", b"a"))
+
+
+class AdmissionControlTestCase(unittest.TestCase):
+
+    def test_max_pending(self):
+        admission = AdmissionControl(max_pending=2)
+        self.assertEqual([True, True, False],
+                         [admission.admit() for i in range(3)])
+        admission.release()
+        self.assertTrue(admission.admit())
+        self.assertEqual(2, admission.stats()['pending'])
+        self.assertEqual(1, admission.stats()['shed'])
+
+    def test_method_limits(self):
+        admission = AdmissionControl(method_limits={"slow": 1})
+        with admission.method_slot("slow"):
+            with admission.method_slot("fast"):
+                pass
+            try:
+                with admission.method_slot("slow"):
+                    self.fail("Over the limit")
+            except jsonrpc2_zeromq.ServerOverloaded as e:
+                self.assertEqual(-32001, e.error_code)
+        with admission.method_slot("slow"):
+            pass
+        stats = admission.stats()
+        self.assertEqual({"slow": 0}, stats['in_flight'])
+        self.assertEqual({"slow": 1}, stats['shed_by_method'])
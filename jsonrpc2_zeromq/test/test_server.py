@@ -12,10 +12,16 @@ standard_library.install_aliases()
 from builtins import *  # NOQA
 from past.utils import old_div
 
+import concurrent.futures
 import unittest
 import logging
+import threading
+import time
+
+import zmq
 
 import jsonrpc2_zeromq
+import jsonrpc2_zeromq.bench
 
 from .helpers import *  # NOQA FIXME: probably addreess this
 
@@ -73,6 +79,21 @@ class RPCServerTestCase(BaseServerTestCase):
         else:
             self.fail("Non-existent method allowed")
 
+    def test_invalid_params(self):
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.client.echo)
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams, self.client.echo,
+                          "too", "many")
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams,
+                          self.client.dict_args, a_cheese="brie")
+
+    def test_handler_type_error(self):
+        self.assertRaises(jsonrpc2_zeromq.ServerError,
+                          self.client.raise_type_error)
+
+    def test_generator_result(self):
+        # REP sockets can't stream, so the items come back as a list
+        self.assertEqual([0, 1, 2], self.client.count(3))
+
     def test_return_null(self):
         result = self.client.return_null()
         self.assertEqual(None, result)
@@ -86,6 +107,187 @@ class RPCServerTestCase(BaseServerTestCase):
         else:
             self.fail("Client didn't timeout")
 
+    def test_batch(self):
+        with self.client.batch() as batch:
+            echo = batch.echo("Test message")
+            null = batch.return_null()
+            not_found = batch.non_existent_method()
+            batch.dict_args(an_int=1)
+
+        self.assertEqual("Test message", echo.result())
+        self.assertEqual(None, null.result())
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound, not_found.result)
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound,
+                          lambda: batch.results)
+
+    def test_batch_results(self):
+        with self.client.batch() as batch:
+            for msg in ("one", "two", "three"):
+                batch.echo(msg)
+        self.assertEqual(["one", "two", "three"], batch.results)
+
+    def test_empty_batch(self):
+        self.client.socket.send(b'[]')
+        response = jsonrpc2_zeromq.common.json_rpc_loads(
+            self.client.socket.recv())
+        self.assertIsInstance(response.error_exception(),
+                              jsonrpc2_zeromq.InvalidRequest)
+
+    def test_attachments(self):
+        blob = bytes(bytearray(range(256))) * 1024
+        result = self.client.echo({"name": "blob", "data": [blob, b"small"]})
+        self.assertEqual("blob", result["name"])
+        self.assertEqual(blob, bytes(result["data"][0]))
+        self.assertEqual(b"small", bytes(result["data"][1]))
+
+        self.assertEqual(dict(type="memoryview", length=len(blob)),
+                         self.client.describe_binary(blob))
+
+    def test_codecs(self):
+        msg = {"numbers": [1, 2.5, -3], "text": "caf\u00e9", "none": None}
+        for name in jsonrpc2_zeromq.common.codecs:
+            client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                               logger=self.logger,
+                                               codec=name)
+            self.assertEqual(msg, client.echo(msg))
+            self.assertRaises(jsonrpc2_zeromq.MethodNotFound,
+                              client.non_existent_method)
+            client.close()
+
+    def test_compression(self):
+        self.server.compression = jsonrpc2_zeromq.common.get_compressor(
+            'zlib')
+        big = ["x" * 10000, {"n": list(range(1000))}]
+
+        client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                           logger=self.logger,
+                                           compression='zlib')
+        self.assertEqual(big, client.echo(big))
+        client.compress_requests = True
+        self.assertEqual(big, client.echo(big))
+        client.close()
+
+        # Clients that don't say they accept it get uncompressed replies
+        self.assertEqual(big, self.client.echo(big))
+        req = jsonrpc2_zeromq.common.Request("echo", [big])
+        self.client.socket.send_multipart(self.client._encode(req))
+        self.assertEqual(b'{', self.client.socket.recv()[:1])
+        req.accept_compression = ['zlib']
+        self.client.socket.send_multipart(self.client._encode(req))
+        self.assertEqual(b'\x00Z', self.client.socket.recv()[:2])
+
+    def test_trace_hooks(self):
+        server_traces = []
+        client_traces = []
+        self.server.add_trace_hook(server_traces.append)
+        self.client.add_trace_hook(client_traces.append)
+
+        self.client.echo("traced")
+        try:
+            self.client.non_existent_method()
+        except jsonrpc2_zeromq.MethodNotFound:
+            pass
+
+        self.assertEqual(2, len(client_traces))
+        self.assertEqual(["request", "serialize", "send", "recv", "parse"],
+                         [stage for stage, t in client_traces[0].stages])
+        self.assertEqual("echo", client_traces[0].method)
+        self.assertEqual(-32601, client_traces[1].error_code)
+
+        sleep(0.1)  # Server finishes its trace after replying
+        self.assertEqual(2, len(server_traces))
+        self.assertEqual(["recv", "parse", "dispatch", "handler",
+                          "serialize", "send"],
+                         [stage for stage, t in server_traces[0].stages])
+        self.assertEqual(client_traces[0].id, server_traces[0].id)
+        self.assertEqual(-32601, server_traces[1].error_code)
+        self.assertTrue(all(d >= 0 for stage, d
+                            in server_traces[0].durations()))
+
+    def test_idempotent_retries(self):
+        recent = self.server.enable_idempotent_retries()
+        self.client.timeout = old_div(RPCTestServer.long_time, 2)
+        self.client.retries = 3
+        self.assertEqual(1, self.client.take_a_long_time())
+        self.assertEqual(1, self.server.long_time_calls)
+        self.assertTrue(recent.retries >= 1)
+
+        # Retries arriving too late are still answered, if they can be
+        # without handling them again
+        req = jsonrpc2_zeromq.common.Request("echo", ["once"],
+                                             idempotent=True)
+        self.assertEqual("once", self.client.request(req))
+        req.deadline = time.time() - 1
+        self.assertEqual("once", self.client.request(req))
+
+    def test_cache(self):
+        self.assertEqual(dict(key="a", lookups=1), self.client.lookup("a"))
+        self.assertEqual(dict(key="a", lookups=1), self.client.lookup("a"))
+        self.assertEqual(dict(key="b", lookups=2), self.client.lookup("b"))
+        self.assertEqual(dict(key="c", lookups=3), self.client.lookup("c"))
+        # Evicted as least recently used
+        self.assertEqual(dict(key="a", lookups=4), self.client.lookup("a"))
+
+        self.client.forget("a")
+        self.assertEqual(dict(key="a", lookups=5), self.client.lookup("a"))
+        self.assertEqual(dict(size=2, hits=1, misses=5, evictions=2),
+                         self.server.cache_stats()['handle_lookup_method'])
+
+        if 'msgpack' in jsonrpc2_zeromq.common.codecs:
+            client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                               codec="msgpack")
+            self.assertEqual(dict(key="a", lookups=5), client.lookup("a"))
+            client.close()
+
+    def test_cache_in_batch(self):
+        self.assertEqual(dict(key="a", lookups=1), self.client.lookup("a"))
+        with self.client.batch() as batch:
+            cached = batch.lookup("a")
+            new = batch.lookup("b")
+        self.assertEqual(dict(key="a", lookups=1), cached.result())
+        self.assertEqual(dict(key="b", lookups=2), new.result())
+        self.assertEqual(dict(key="b", lookups=2), self.client.lookup("b"))
+        self.assertEqual(dict(size=2, hits=2, misses=2, evictions=0),
+                         self.server.cache_stats()['handle_lookup_method'])
+
+    def test_deadlines(self):
+        # Only sent when asked for, as they rely on clocks agreeing
+        self.assertEqual(None, self.client.time_remaining())
+        self.client.send_deadlines = True
+        remaining = self.client.time_remaining()
+        self.assertTrue(0 < remaining <= 5)
+        self.client.send_deadlines = False
+
+        expired = jsonrpc2_zeromq.common.Request(
+            "take_a_long_time", [], deadline=time.time() - 1)
+        self.assertRaises(jsonrpc2_zeromq.DeadlineExceeded,
+                          self.client.request, expired)
+        self.assertEqual(0, self.server.long_time_calls)
+
+    def test_metrics(self):
+        stats = jsonrpc2_zeromq.common.Request(
+            jsonrpc2_zeromq.common.STATS_METHOD, [])
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound,
+                          self.client.request, stats)
+
+        metrics = self.server.enable_metrics(expose=True)
+        self.client.echo("one")
+        self.client.echo("two")
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound,
+                          self.client.non_existent_method)
+
+        snapshot = self.client.request(stats)
+        self.assertEqual(3, snapshot['calls'])
+        self.assertEqual({"-32601": 1}, snapshot['errors'])
+        self.assertEqual(2, snapshot['methods']['echo']['calls'])
+        self.assertEqual(2, snapshot['methods']['echo']['latency']['count'])
+        self.assertEqual(
+            {"-32601": 1},
+            snapshot['methods']['non_existent_method']['errors'])
+        for stage in ('parse', 'handler', 'serialize'):
+            self.assertTrue(snapshot['stages'][stage]['count'] >= 2)
+        self.assertTrue(metrics is self.server.metrics)
+
     def test_invalid_type(self):
 
         class Cheese:
@@ -121,6 +323,640 @@ class RPCNotificationServerTestCase(BaseServerTestCase):
         self.test_rpc()
         self.test_rpc("and lions and tigers")
 
+    def test_batch_of_notifications(self):
+        with self.client.batch() as batch:
+            batch.notify.echo("into")
+            batch.notify.echo("the void")
+        self.assertEqual([], batch.results)
+        self.test_rpc()
+
+    def test_mixed_batch(self):
+        with self.client.batch() as batch:
+            batch.notify.echo("into the void")
+            batch.echo("back again")
+        self.assertEqual(["back again"], batch.results)
+
+
+class ThreadPoolRPCServerTestCase(BaseServerTestCase):
+
+    num_workers = 4
+
+    def setUp(self):
+        self.server = ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                              logger=self.logger,
+                                              workers=self.num_workers)
+        self.server.daemon = True
+        self.server.start()
+        self.client = jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                        logger=self.logger)
+
+    def test_echo(self):
+        msg = "Test message"
+        self.assertEqual(msg, self.client.echo(msg))
+
+    def test_notify_then_rpc(self):
+        self.client.notify.echo("a message into the void")
+        self.assertEqual("clowns", self.client.echo("clowns"))
+
+    def test_idempotent_retries(self):
+        self.server.enable_idempotent_retries()
+        # The retry arrives while the first attempt is still running
+        client = jsonrpc2_zeromq.RPCNotifierClient(
+            endpoint=self.endpoint, logger=self.logger, retries=3,
+            timeout=old_div(ThreadPoolRPCTestServer.long_time, 3))
+        self.assertEqual(1, client.take_a_long_time())
+        self.assertEqual(1, self.server.long_time_calls)
+        client.close()
+
+    def test_concurrent_slow_calls(self):
+        clients = [jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                     logger=self.logger)
+                   for i in range(self.num_workers)]
+        threads = [threading.Thread(target=c.take_a_long_time)
+                   for c in clients]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        for c in clients:
+            c.close()
+
+        # Run serially, these would take num_workers * long_time.
+        self.assertTrue(elapsed < (self.num_workers - 1) *
+                        ThreadPoolRPCTestServer.long_time / 1000.0)
+
+    def test_queue_metrics(self):
+        metrics = self.server.enable_metrics()
+        clients = [jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                     logger=self.logger)
+                   for i in range(self.num_workers)]
+        threads = [threading.Thread(target=c.take_a_long_time)
+                   for c in clients]
+        for t in threads:
+            t.start()
+        sleep(0.1)  # Every worker is busy
+
+        waiting = threading.Thread(target=self.client.echo, args=("wait",))
+        waiting.start()
+        sleep(0.1)
+        gauges = metrics.snapshot()['gauges']
+        self.assertEqual(dict(queued=1, busy_workers=self.num_workers),
+                         gauges)
+
+        for t in threads + [waiting]:
+            t.join()
+        for c in clients:
+            c.close()
+        sleep(0.1)  # Server finishes its trace after replying
+        snapshot = metrics.snapshot()
+        self.assertEqual(0, snapshot['gauges']['queued'])
+        # The echo waited for a worker for most of long_time
+        self.assertTrue(snapshot['stages']['queue']['max'] >
+                        ThreadPoolRPCTestServer.long_time / 2000.0)
+
+    def test_fast_calls_not_held_up(self):
+        slow = threading.Thread(target=self.client.take_a_long_time)
+        slow.start()
+        sleep(0.05)  # The slow call has a worker
+
+        latencies = []
+
+        def call_fast(client):
+            start = time.time()
+            client.echo("quick")
+            latencies.append(time.time() - start)
+
+        clients = [jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                     logger=self.logger)
+                   for i in range(2 * self.num_workers)]
+        threads = [threading.Thread(target=call_fast, args=(c,))
+                   for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        slow.join()
+        for c in clients:
+            c.close()
+
+        # None waits for the slow call while other workers are free
+        self.assertEqual(len(clients), len(latencies))
+        self.assertTrue(max(latencies) <
+                        ThreadPoolRPCTestServer.long_time / 2000.0,
+                        latencies)
+
+
+class ProcessPoolRPCServerTestCase(BaseServerTestCase):
+
+    num_workers = 3
+
+    def setUp(self):
+        self.server = jsonrpc2_zeromq.ProcessPoolRPCServer(
+            ProcessWorkerTestServer, endpoint=self.endpoint,
+            logger=self.logger, workers=self.num_workers)
+        self.server.daemon = True
+        self.server.start()
+        self._wait_for_workers()
+        self.clients = [
+            jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                              logger=self.logger)
+            for i in range(self.num_workers)]
+        self.client = self.clients[0]
+
+    def _wait_for_workers(self, timeout=30):
+        # Spawning processes can take longer than a client's timeout,
+        # especially on a busy machine
+        give_up = time.time() + timeout
+        while len(self.server.free_workers) < self.num_workers:
+            if time.time() > give_up:
+                self.fail("Workers not ready after {0}s".format(timeout))
+            sleep(0.05)
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        super(ProcessPoolRPCServerTestCase, self).tearDown()
+
+    def _call_all_clients(self, method, *args):
+        threads = [threading.Thread(target=getattr(c, method), args=args)
+                   for c in self.clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_echo(self):
+        msg = "Test message"
+        self.assertEqual(msg, self.client.echo(msg))
+
+    def test_error(self):
+        try:
+            self.client.fail()
+        except WorkerTestError as e:
+            self.assertEqual({"in": "worker"}, e.error_data)
+        else:
+            self.fail("Worker error not passed back")
+
+    def test_concurrent_slow_calls(self):
+        start = time.time()
+        self._call_all_clients('take_a_long_time')
+        elapsed = time.time() - start
+
+        self.assertTrue(elapsed < (self.num_workers - 1) *
+                        ProcessWorkerTestServer.long_time / 1000.0)
+
+    def test_metrics(self):
+        # Only the front-end's gauges: workers handle the calls
+        metrics = self.server.enable_metrics()
+        self.assertEqual("ok", self.client.echo("ok"))
+        snapshot = metrics.snapshot()
+        self.assertEqual({}, snapshot['methods'])
+        self.assertEqual(0, snapshot['gauges']['queued'])
+        self.assertRaises(ValueError, self.server.enable_metrics,
+                          expose=True)
+
+    def test_idempotent_retries(self):
+        # Retries would go to workers that don't know about the first attempt
+        self.assertRaises(ValueError, self.server.enable_idempotent_retries)
+
+    def test_stream(self):
+        # Workers return the whole result rather than streaming it
+        client = jsonrpc2_zeromq.PipelinedRPCClient(endpoint=self.endpoint,
+                                                    logger=self.logger)
+        try:
+            self.assertEqual(list(range(5000)),
+                             list(client.stream.count(5000)))
+        finally:
+            client.close()
+
+
+class PipelinedRPCClientTestCase(BaseServerTestCase):
+
+    num_workers = 4
+
+    def setUp(self):
+        self.server = ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                              logger=self.logger,
+                                              workers=self.num_workers)
+        self.server.daemon = True
+        self.server.start()
+        self.client = jsonrpc2_zeromq.PipelinedRPCClient(
+            endpoint=self.endpoint, logger=self.logger)
+
+    def tearDown(self):
+        self.client.close()
+        super(PipelinedRPCClientTestCase, self).tearDown()
+
+    def test_echo(self):
+        msg = "Test message"
+        self.assertEqual(msg, self.client.echo(msg))
+        self.assertEqual(msg, self.client.call_async.echo(msg).result())
+
+    def test_many_in_flight(self):
+        msgs = ["message {0}".format(i) for i in range(200)]
+        futures = [self.client.call_async.echo(msg) for msg in msgs]
+        self.assertEqual(msgs, [f.result() for f in futures])
+
+    def test_attachments(self):
+        blobs = [bytes(bytearray([i])) * 100000 for i in range(10)]
+        futures = [self.client.call_async.echo(blob) for blob in blobs]
+        self.assertEqual(blobs, [bytes(f.result()) for f in futures])
+
+    def test_many_threads(self):
+        results = {}
+
+        def call(i):
+            results[i] = [self.client.echo(j) for j in range(20)]
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(dict((i, list(range(20))) for i in range(10)),
+                         results)
+
+    def test_concurrent_slow_calls(self):
+        start = time.time()
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(self.num_workers)]
+        for f in futures:
+            f.result()
+        elapsed = time.time() - start
+        self.assertTrue(elapsed < (self.num_workers - 1) *
+                        ThreadPoolRPCTestServer.long_time / 1000.0)
+
+    def test_notify_then_rpc(self):
+        self.client.notify.echo("a message into the void")
+        self.assertEqual("clowns", self.client.echo("clowns"))
+
+    def test_method_not_found(self):
+        future = self.client.call_async.non_existent_method()
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound, future.result)
+
+    def test_timeout(self):
+        self.client.timeout = old_div(ThreadPoolRPCTestServer.long_time, 10)
+        future = self.client.call_async.take_a_long_time()
+        self.assertRaises(jsonrpc2_zeromq.client.TimeoutError, future.result)
+        self.client.timeout = 5000
+        self.assertEqual("still here", self.client.echo("still here"))
+
+    def test_stream(self):
+        self.assertEqual(list(range(1050)),
+                         list(self.client.stream.count(1050)))
+        self.assertEqual([0, 1, 2], self.client.count(3))
+        # Results of other handlers are iterated over all the same
+        self.assertEqual([1, 2], list(self.client.stream.echo([1, 2])))
+
+    def test_stream_flow_control(self):
+        stream = self.client.stream.count(100000)
+        self.assertEqual(0, next(stream))
+        sleep(0.2)
+        # No more than the client's window of chunks is sent ahead
+        self.assertTrue(self.server.produced <=
+                        (self.client.stream_window + 1) *
+                        self.server.stream_chunk_size)
+        stream.close()
+        for i in range(10):
+            if not self.server.streams:
+                break
+            sleep(0.1)  # The cancellation may reach another worker
+        self.assertEqual({}, self.server.streams)
+
+    def test_stream_error(self):
+        stream = self.client.stream.count(500, 250)
+        self.assertEqual(list(range(200)),
+                         [next(stream) for i in range(200)])
+        self.assertRaises(jsonrpc2_zeromq.ServerError, list, stream)
+
+
+class RPCClientPoolTestCase(BaseServerTestCase):
+
+    num_workers = 4
+    pool_size = 3
+
+    def setUp(self):
+        self.server = ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                              logger=self.logger,
+                                              workers=self.num_workers)
+        self.server.daemon = True
+        self.server.start()
+        self.pool = jsonrpc2_zeromq.RPCClientPool(
+            endpoint=self.endpoint, size=self.pool_size,
+            socket_type=zmq.DEALER, logger=self.logger)
+
+    def tearDown(self):
+        self.pool.close()
+        super(RPCClientPoolTestCase, self).tearDown()
+
+    def test_echo(self):
+        self.assertEqual("hello", self.pool.echo("hello"))
+        self.pool.notify.echo("into the void")
+        with self.pool.batch() as batch:
+            batch.echo("one")
+        self.assertEqual(["one"], batch.results)
+
+    def test_many_threads(self):
+        results = {}
+
+        def call(i):
+            results[i] = [self.pool.echo(j) for j in range(20)]
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(dict((i, list(range(20))) for i in range(10)),
+                         results)
+        self.assertTrue(self.pool.num_clients <= self.pool_size)
+
+    def test_checkout_timeout(self):
+        clients = [self.pool.checkout() for i in range(self.pool_size)]
+        self.assertRaises(jsonrpc2_zeromq.client.TimeoutError,
+                          self.pool.checkout, 50)
+        self.pool.checkin(clients[0])
+        with self.pool.connection(50) as client:
+            self.assertEqual("hello", client.echo("hello"))
+
+    def test_timeout(self):
+        self.pool.client_kwargs['timeout'] = \
+            old_div(ThreadPoolRPCTestServer.long_time, 10)
+        self.assertRaises(jsonrpc2_zeromq.client.TimeoutError,
+                          self.pool.take_a_long_time)
+        self.assertEqual("still here", self.pool.echo("still here"))
+        self.assertEqual(1, self.pool.num_clients)
+
+    def test_method_not_found(self):
+        self.assertRaises(jsonrpc2_zeromq.MethodNotFound,
+                          self.pool.non_existent_method)
+        self.assertEqual(1, len(self.pool.idle))
+
+
+class AdmissionControlTestCase(BaseServerTestCase):
+
+    def _start(self, server, **limits):
+        self.server = server
+        self.admission = server.enable_admission_control(**limits)
+        server.daemon = True
+        server.start()
+        self.client = jsonrpc2_zeromq.PipelinedRPCClient(
+            endpoint=self.endpoint, logger=self.logger)
+
+    def tearDown(self):
+        self.client.close()
+        super(AdmissionControlTestCase, self).tearDown()
+
+    def _outcomes(self, futures):
+        outcomes = []
+        for future in futures:
+            try:
+                future.result()
+                outcomes.append("ok")
+            except jsonrpc2_zeromq.ServerOverloaded:
+                outcomes.append("shed")
+        return sorted(outcomes)
+
+    def test_max_pending(self):
+        self._start(ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                            logger=self.logger, workers=1),
+                    max_pending=2)
+        start = time.time()
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(5)]
+        # Shed straight away, without waiting for a worker
+        shed = futures[2:]
+        concurrent.futures.wait(shed, timeout=5)
+        self.assertTrue(time.time() - start <
+                        ThreadPoolRPCTestServer.long_time / 1000.0)
+        self.assertEqual(["ok", "ok", "shed", "shed", "shed"],
+                         self._outcomes(futures))
+        self.assertEqual(2, self.server.long_time_calls)
+
+        sleep(0.1)  # Requests are released after replying
+        stats = self.server.admission_stats()
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(3, stats['shed'])
+        # Back under the limit
+        self.assertEqual("ok", self.client.echo("ok"))
+
+    def test_method_limits(self):
+        self._start(ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                            logger=self.logger),
+                    method_limits={"take_a_long_time": 1})
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(3)]
+        sleep(0.1)
+        self.assertEqual("other methods", self.client.echo("other methods"))
+        self.assertEqual(["ok", "shed", "shed"], self._outcomes(futures))
+        sleep(0.1)
+        stats = self.server.admission_stats()
+        self.assertEqual({"take_a_long_time": 2}, stats['shed_by_method'])
+        self.assertEqual({"take_a_long_time": 0}, stats['in_flight'])
+
+    def test_method_limits_in_batch(self):
+        self._start(ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                            logger=self.logger),
+                    method_limits={"take_a_long_time": 1})
+        future = self.client.call_async.take_a_long_time()
+        sleep(0.1)
+        client = jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                   logger=self.logger)
+        try:
+            with client.batch() as batch:
+                slow = batch.take_a_long_time()
+                echo = batch.echo("in batch")
+        finally:
+            client.close()
+        # Only the call over the limit is shed
+        self.assertRaises(jsonrpc2_zeromq.ServerOverloaded, slow.result)
+        self.assertEqual("in batch", echo.result())
+        self.assertEqual(["ok"], self._outcomes([future]))
+        self.assertEqual({"take_a_long_time": 1},
+                         self.server.admission_stats()['shed_by_method'])
+
+    def test_single_threaded(self):
+        # Waiting requests are read in when the handler's done
+        self._start(ProcessWorkerTestServer(endpoint=self.endpoint,
+                                            logger=self.logger),
+                    max_pending=1)
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(3)]
+        self.assertEqual(["ok", "ok", "shed"], self._outcomes(futures))
+        sleep(0.1)
+        self.assertEqual(0, self.server.admission_stats()['pending'])
+
+    def test_process_pool(self):
+        server = jsonrpc2_zeromq.ProcessPoolRPCServer(
+            ProcessWorkerTestServer, endpoint=self.endpoint,
+            logger=self.logger, workers=1)
+        self.assertRaises(ValueError, server.enable_admission_control,
+                          method_limits={"echo": 1})
+        self._start(server, max_pending=2)
+        give_up = time.time() + 30
+        while not server.free_workers and time.time() < give_up:
+            sleep(0.05)  # Wait for the worker process to start
+
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(5)]
+        self.assertEqual(["ok", "ok", "shed", "shed", "shed"],
+                         self._outcomes(futures))
+        sleep(0.1)
+        self.assertEqual(0, self.server.admission_stats()['pending'])
+        self.assertEqual("ok", self.client.echo("ok"))
+
+    def test_unenforceable_limits(self):
+        self.server = RPCTestServer(endpoint=self.endpoint,
+                                    logger=self.logger)
+        self.server.daemon = True
+        self.server.start()
+        self.client = jsonrpc2_zeromq.RPCClient(endpoint=self.endpoint,
+                                                logger=self.logger)
+        # A REP server only ever sees one request
+        self.assertRaises(ValueError, self.server.enable_admission_control,
+                          max_pending=10)
+        # Nor is it handling more than one at once
+        server = ProcessWorkerTestServer(
+            endpoint=self.endpoint + "-router", logger=self.logger)
+        self.assertRaises(ValueError, server.enable_admission_control,
+                          method_limits={"echo": 1})
+        server.close()
+
+    def test_stats_method(self):
+        self._start(ThreadPoolRPCTestServer(endpoint=self.endpoint,
+                                            logger=self.logger),
+                    max_pending=10)
+        self.server.enable_metrics(expose=True)
+        stats = self.client.request(jsonrpc2_zeromq.common.Request(
+            jsonrpc2_zeromq.common.STATS_METHOD, []))
+        self.assertEqual(10, stats['admission']['max_pending'])
+
+
+class DeadlineTestCase(BaseServerTestCase):
+
+    def setUp(self):
+        self.server = ProcessWorkerTestServer(endpoint=self.endpoint,
+                                              logger=self.logger)
+        self.server.daemon = True
+        self.server.start()
+        self.client = jsonrpc2_zeromq.PipelinedRPCClient(
+            endpoint=self.endpoint, logger=self.logger, timeout=300)
+        self.client.send_deadlines = True
+
+    def tearDown(self):
+        self.client.close()
+        super(DeadlineTestCase, self).tearDown()
+
+    def test_backlog_dropped(self):
+        futures = [self.client.call_async.take_a_long_time()
+                   for i in range(3)]
+        for future in futures:
+            self.assertRaises(jsonrpc2_zeromq.client.TimeoutError,
+                              future.result)
+        sleep(ProcessWorkerTestServer.long_time / 1000.0)
+        # Only the first was handled: the others had expired by then
+        self.assertEqual(1, self.server.long_time_calls)
+        self.assertEqual("live", self.client.echo("live"))
+
+    def test_deadline_matches_wait(self):
+        client = jsonrpc2_zeromq.RPCNotifierClient(
+            endpoint=self.endpoint, logger=self.logger, timeout=300)
+        client.send_deadlines = True
+        # Waiting to send and for the response share the timeout, so the
+        # client gives up when its deadline passes
+        start = time.time()
+        self.assertRaises(jsonrpc2_zeromq.client.TimeoutError,
+                          client.take_a_long_time)
+        self.assertTrue(time.time() - start < 0.4)
+        client.close()
+
+
+class LoadBalancingRPCClientTestCase(BaseServerTestCase):
+
+    other_endpoint = BaseServerTestCase.endpoint + "-other"
+    dead_endpoint = BaseServerTestCase.endpoint + "-dead"
+
+    def setUp(self):
+        self.calls = {}
+        self.servers = [self._start_server(e) for e in (self.endpoint,
+                                                        self.other_endpoint)]
+        self.server = self.servers[0]
+        self.client = jsonrpc2_zeromq.LoadBalancingRPCClient(
+            [self.endpoint, self.other_endpoint, self.dead_endpoint],
+            socket_type=zmq.DEALER, timeout=200, retry_on_timeout=True,
+            logger=self.logger)
+        self.client.probe_interval = 100
+
+    def _start_server(self, endpoint):
+        server = ThreadPoolRPCTestServer(endpoint=endpoint,
+                                         logger=self.logger)
+        self.calls[endpoint] = 0
+
+        def count_call(trace):
+            self.calls[endpoint] += 1
+        server.add_trace_hook(count_call)
+        server.daemon = True
+        server.start()
+        return server
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers[1:]:
+            server.stop()
+            server.join()
+            server.close()
+        super(LoadBalancingRPCClientTestCase, self).tearDown()
+
+    def test_failover(self):
+        self.assertEqual(list(range(20)),
+                         [self.client.echo(i) for i in range(20)])
+        dead = self.client.endpoints[2]
+        self.assertTrue(dead.benched)
+        self.assertEqual(1, dead.failures)
+
+    def test_overloaded_failover(self):
+        admission = self.server.enable_admission_control(max_pending=0)
+        self.assertEqual(list(range(20)),
+                         [self.client.echo(i) for i in range(20)])
+        self.assertEqual(0, self.calls[self.endpoint])
+        self.assertTrue(admission.shed > 0)
+        self.assertFalse(self.client.endpoints[0].benched)
+
+    def test_spreads_load(self):
+        threads = [threading.Thread(
+            target=lambda: [self.client.echo(i) for i in range(20)])
+            for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(self.calls[self.endpoint] > 0)
+        self.assertTrue(self.calls[self.other_endpoint] > 0)
+
+    def test_probe_restores_endpoint(self):
+        for i in range(20):
+            self.client.echo(i)
+        dead = self.client.endpoints[2]
+        self.assertTrue(dead.benched)
+
+        self.servers.append(self._start_server(self.dead_endpoint))
+        for i in range(20):
+            if not dead.benched:
+                break
+            sleep(0.1)
+        self.assertFalse(dead.benched)
+
+    def test_no_retry(self):
+        self.client.retry_on_timeout = False
+        self.assertRaises(jsonrpc2_zeromq.client.TimeoutError,
+                          self.client.take_a_long_time)
+        self.assertEqual(1, len([s for s in self.client.endpoints
+                                 if s.benched]))
+
 
 class NotificationOnlyPullServerTestCase(BaseServerTestCase):
 
@@ -180,3 +1016,242 @@ class NotificationReceiverClientTestCase(BaseServerTestCase):
             pass
         else:
             self.fail("Client didn't timeout")
+
+    def test_concurrent_calls(self):
+        results = {}
+
+        def call(n):
+            results[n] = [self.client.echo([n, i]) for i in range(20)]
+
+        threads = [threading.Thread(target=call, args=(n,))
+                   for n in range(8)]
+        for t in threads:
+            t.start()
+        # A slow call doesn't hold up the others' replies
+        self.assertEqual(1, self.client.take_a_long_time())
+        for t in threads:
+            t.join()
+        for n in range(8):
+            self.assertEqual([[n, i] for i in range(20)], results[n])
+
+    def test_batch(self):
+        with self.client.batch() as batch:
+            one = batch.echo("one")
+            two = batch.echo("two")
+        self.assertEqual(("one", "two"), (one.result(), two.result()))
+
+
+class SubscriptionServerTestCase(BaseServerTestCase):
+
+    pub_endpoint = "inproc://jsonrpc2-zeromq-tests-pub"
+
+    def setUp(self):
+        self.clients = []
+        self.server = NotificationReceiverClientTestServer(
+            endpoint=self.endpoint, logger=self.logger,
+            pub_endpoint=self.pub_endpoint)
+
+    def tearDown(self):
+        for client in self.clients:
+            if isinstance(client, threading.Thread):
+                client.stop()
+            client.close()
+        return super(SubscriptionServerTestCase, self).tearDown()
+
+    def _start(self):
+        self.server.daemon = True
+        self.server.start()
+
+    def _client(self, client_class, *args, **kwargs):
+        client = client_class(*args, logger=self.logger, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def _wait_for(self, condition, timeout=5):
+        give_up = time.time() + timeout
+        while not condition() and time.time() < give_up:
+            sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_shed_after_client_gone(self):
+        self.server.enable_admission_control(max_pending=0)
+        client = jsonrpc2_zeromq.RPCNotifierClient(endpoint=self.endpoint,
+                                                   logger=self.logger)
+        client.socket.send_multipart(client._encode(
+            jsonrpc2_zeromq.common.Request("echo", ["gone"])))
+        client.close()
+        sleep(0.1)
+        self._start()
+        # The shed request can't be answered, but the server carries on
+        client = self._client(jsonrpc2_zeromq.RPCNotifierClient,
+                              self.endpoint)
+        self.assertRaises(jsonrpc2_zeromq.ServerOverloaded, client.echo,
+                          "still here?")
+        self.assertTrue(self.server.is_alive())
+
+    def test_fan_out(self):
+        self._start()
+        subscribers = [self._client(NotificationRecorderClient,
+                                    self.endpoint) for i in range(3)]
+        bystander = self._client(NotificationRecorderClient, self.endpoint)
+        for subscriber in subscribers:
+            subscriber.subscribe_topic("news")
+        bystander.subscribe_topic("sport")
+
+        self.server.publish("news", "event", ["one"])
+        self.server.publish("news", "event", ["two"])
+        for subscriber in subscribers:
+            self._wait_for(lambda: len(subscriber.events) == 2)
+            self.assertEqual([("one",), ("two",)], subscriber.events)
+
+        subscribers[0].unsubscribe("news")
+        self.server.publish("news", "event", ["three"])
+        self._wait_for(lambda: len(subscribers[1].events) == 3)
+        sleep(0.1)
+        self.assertEqual(2, len(subscribers[0].events))
+        self.assertEqual([], bystander.events)
+
+    def test_slow_notification_handler(self):
+        self._start()
+        client = self._client(NotificationRecorderClient, self.endpoint)
+        client.subscribe_topic("news")
+        self.server.publish("news", "block")
+        self.server.publish("news", "event", ["after"])
+        sleep(0.1)
+        # The handler's still blocked, but calls aren't held up
+        start = time.time()
+        client.subscribe_topic("sport")
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([], client.events)
+        client.unblocked.set()
+        self._wait_for(lambda: client.events == [("after",)])
+
+    def test_notification_overflow(self):
+        self._start()
+        client = self._client(SmallQueueRecorderClient, self.endpoint)
+        client.subscribe_topic("news")
+        self.server.publish("news", "block")
+        sleep(0.1)  # The handler's blocked
+        for i in range(10):
+            self.server.publish("news", "event", [i])
+        sleep(0.1)
+        # The queue's full, but calls aren't held up
+        start = time.time()
+        self.assertEqual("still here", client.echo("still here"))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(8, client.dropped_notifications)
+        client.unblocked.set()
+        self._wait_for(lambda: client.events == [(8,), (9,)])
+
+    def test_batched_notifications(self):
+        self._start()
+        client = self._client(NotificationBatchRecorderClient, self.endpoint)
+        client.subscribe_topic("news")
+        self.server.publish("news", "event", [0])
+        self._wait_for(lambda: client.batches)
+        # These queue up while the first batch is being handled
+        for i in range(1, 50):
+            self.server.publish("news", "event", [i])
+        sleep(0.2)
+        client.unblocked.set()
+        self._wait_for(lambda: sum(len(b) for b in client.batches) == 50)
+        self.assertEqual([[0]], client.batches[0][:1])
+        self.assertEqual([[i] for i in range(50)],
+                         [params for b in client.batches for params in b])
+        self.assertTrue(len(client.batches) < 50)
+
+    def test_bad_topic(self):
+        self._start()
+        client = self._client(jsonrpc2_zeromq.RPCNotifierClient,
+                              self.endpoint)
+        self.assertRaises(jsonrpc2_zeromq.InvalidParams,
+                          client.subscribe_topic, ["not", "a", "string"])
+
+    def _flood_slow_subscriber(self):
+        self._start()
+        # Subscribes, then never reads
+        client = self._client(jsonrpc2_zeromq.RPCNotifierClient,
+                              self.endpoint)
+        client.subscribe_topic("news")
+        for i in range(5000):
+            self.server.publish("news", "event", [i])
+        self._wait_for(lambda: not self.server.published and
+                       self.server.dropped_notifications)
+
+    def test_slow_subscriber_drop(self):
+        self.server.subscriber_queue_size = 10
+        self._flood_slow_subscriber()
+        subscriber, = self.server.subscribers.values()
+        self.assertEqual(10, len(subscriber.queue))
+        self.assertTrue(subscriber.dropped > 0)
+        # The oldest were dropped
+        newest, codec = jsonrpc2_zeromq.common.decode_frames(
+            subscriber.queue[-1])
+        self.assertEqual([4999], newest.params)
+
+    def test_slow_subscriber_reply_kept(self):
+        self.server.subscriber_queue_size = 2
+        self._flood_slow_subscriber()
+        subscriber, = self.server.subscribers.values()
+        client = self.clients[0]
+        client.socket.send_multipart(client._encode(
+            jsonrpc2_zeromq.common.Request("echo", ["kept"])))
+        self._wait_for(lambda: subscriber.replies)
+        dropped = subscriber.dropped
+        for i in range(2):
+            self.server.publish("news", "event", [i])
+        self._wait_for(lambda: subscriber.dropped == dropped + 2)
+        # Notifications are dropped, but not the reply
+        self.assertEqual(2, len(subscriber.queue))
+        reply, codec = jsonrpc2_zeromq.common.decode_frames(
+            subscriber.replies[0])
+        self.assertEqual("kept", reply.result)
+
+    def test_slow_subscriber_disconnect(self):
+        self.server.subscriber_queue_size = 10
+        self.server.slow_consumer_policy = 'disconnect'
+        self._flood_slow_subscriber()
+        self.assertEqual({}, self.server.subscribers)
+        self.assertEqual({}, self.server.topics)
+        self.assertEqual(1, self.server.disconnected_subscribers)
+
+    def test_pub_socket(self):
+        self._start()
+        subscriber = self._client(NotificationRecorderSubscriberClient,
+                                  self.pub_endpoint, ["news"])
+        # PUB subscriptions take a moment to get through
+        give_up = time.time() + 5
+        while not subscriber.events and time.time() < give_up:
+            self.server.publish("newsletters", "event", ["other"])
+            self.server.publish("news", "event", ["news"])
+            sleep(0.05)
+        self._wait_for(lambda: subscriber.events)
+        self.assertEqual(set([("news",)]), set(subscriber.events))
+
+    def test_subscriber_close(self):
+        self._start()
+        subscriber = jsonrpc2_zeromq.NotificationSubscriberClient(
+            self.pub_endpoint, ["news"], logger=self.logger)
+        # Stops receiving, and handling notifications, first
+        subscriber.close()
+        self.assertFalse(subscriber.is_alive())
+        self.assertFalse(any(thread.is_alive()
+                             for thread in subscriber.notification_threads))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_run_rpc(self):
+        for pattern in sorted(jsonrpc2_zeromq.bench.patterns):
+            calls, seconds, latencies = jsonrpc2_zeromq.bench.run_rpc(
+                pattern, "inproc", 16, 2, min_time=0.05)
+            self.assertTrue(calls > 0)
+            self.assertEqual(calls, len(latencies))
+
+    def test_times_per_call(self):
+        calls = []
+        fast, slow = jsonrpc2_zeromq.bench._times_per_call(
+            [lambda: calls.append(1), lambda: sleep(0.001)],
+            min_time=0.05, repeat=3)
+        self.assertTrue(0 < fast < slow)
+        self.assertTrue(slow >= 0.001)
@@ -46,7 +46,12 @@ setup(
         "setuptools",
         "pyzmq>=2.1.11,<17",
         "future>=0.14.3",
+        "futures>=3.0; python_version < '3'",
         ],
+    extras_require={
+        "msgpack": ["msgpack>=0.6"],
+        "orjson": ["orjson"],
+        },
     tests_require=[
         "nose>=1.3.4,<2",
         ],